@@ -0,0 +1,88 @@
+import os
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+import sqlalchemy as db
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import schema
+from database_connection import DB_BACKEND, database_url, _set_sqlite_pragmas
+
+
+# The asyncio counterpart of DatabaseConnection, for code running on the bot's event loop.
+class AsyncDatabaseConnection:
+    drivers = {"mysql": "aiomysql", "sqlite": "aiosqlite"}
+    _engine = None
+    _metadata = schema.metadata
+    _scoped_connection = ContextVar("async_scoped_connection", default=None)
+
+    def __init__(self):
+        self._connection = None
+        self._owns_connection = False
+
+    @classmethod
+    def get_engine(cls):
+        if cls._engine is None:
+            if DB_BACKEND == "sqlite":
+                cls._engine = create_async_engine(
+                    database_url(DB_BACKEND, cls.drivers[DB_BACKEND]), poolclass=db.pool.AsyncAdaptedQueuePool,
+                    pool_size=int(os.getenv("DB_POOL_SIZE", 5)), max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)))
+                db.event.listen(cls._engine.sync_engine, "connect", _set_sqlite_pragmas)
+            else:
+                cls._engine = create_async_engine(
+                    database_url(DB_BACKEND, cls.drivers[DB_BACKEND]),
+                    pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+                    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+                    pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", 30)),
+                    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 3600)),
+                    pool_pre_ping=True)
+        return cls._engine
+
+    async def __aenter__(self):
+        self._connection = self._scoped_connection.get()
+        self._owns_connection = self._connection is None
+        if self._owns_connection:
+            self._connection = await self.get_engine().connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._owns_connection and self._connection is not None:
+            await self._connection.close()
+        self._connection = None
+
+    @classmethod
+    @asynccontextmanager
+    async def scope(cls):
+        if cls._scoped_connection.get() is not None:
+            yield
+            return
+        connection = await cls.get_engine().connect()
+        token = cls._scoped_connection.set(connection)
+        try:
+            yield
+        finally:
+            cls._scoped_connection.reset(token)
+            await connection.close()
+
+    async def execute(self, query):
+        try:
+            result_proxy = await self._connection.execute(query)
+            # Async connections never autocommit.
+            if getattr(query, "is_dml", False):
+                await self._connection.commit()
+        except Exception as e:
+            logging.error(e)
+            if self._connection.in_transaction():
+                await self._connection.rollback()
+            return None
+        return result_proxy
+
+    def get_table(self, table_name) -> db.Table | None:
+        return self._metadata.tables.get(table_name)
+
+    @classmethod
+    async def dispose(cls):
+        if cls._engine is not None:
+            await cls._engine.dispose()
+            cls._engine = None
@@ -0,0 +1,86 @@
+import sqlalchemy as db
+
+from users import User
+from user_cache import user_cache
+from async_database_connection import AsyncDatabaseConnection
+
+
+# Same queries as the User static methods, awaited on the event loop instead of blocking it.
+class AsyncUser:
+    @staticmethod
+    async def get_all_users():
+        async with AsyncDatabaseConnection() as connection:
+            users = connection.get_table("user")
+            query = db.select([users])
+            result_proxy = await connection.execute(query)
+            if result_proxy is None:
+                return []
+            result_set = result_proxy.fetchall()
+
+        return [User.from_row(row) for row in result_set]
+
+    @staticmethod
+    async def get_user(user_id):
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
+        async with AsyncDatabaseConnection() as connection:
+            users = connection.get_table("user")
+            query = db.select([users]).where(users.columns.user_id == user_id)
+            result_proxy = await connection.execute(query)
+            if result_proxy is None:
+                return None
+            row = result_proxy.fetchone()
+            if row is None:
+                return None
+
+        user = User.from_row(row)
+        user_cache.put(user)
+        return user
+
+    @staticmethod
+    async def get_users_by(key, value):
+        if key == "chat_id":
+            user = user_cache.get_by_chat_id(value)
+            if user is not None:
+                return [user]
+        async with AsyncDatabaseConnection() as connection:
+            users = connection.get_table("user")
+            query = db.select([users]).where(users.columns[key] == value)
+            result_proxy = await connection.execute(query)
+            if result_proxy is None:
+                return None
+            result_set = result_proxy.fetchall()
+
+        user_list = [User.from_row(row) for row in result_set]
+        if key == "chat_id" and len(user_list) == 1:
+            user_cache.put(user_list[0])
+        return user_list
+
+    @staticmethod
+    async def insert_user(user):
+        async with AsyncDatabaseConnection() as connection:
+            users = connection.get_table("user")
+            query = db.insert(users).values(user.to_row())
+            result = await connection.execute(query)
+
+        if result is None:
+            user_cache.invalidate(user.get_user_id())
+            return False
+        user_cache.put(user)
+        return True
+
+    @staticmethod
+    async def update_user(user) -> int:
+        async with AsyncDatabaseConnection() as connection:
+            users = connection.get_table("user")
+            row = user.to_row()
+            del row["user_id"]
+            query = db.update(users).where(users.columns.user_id == user.get_user_id()).values(row)
+            result = await connection.execute(query)
+
+        if result is None:
+            user_cache.invalidate(user.get_user_id())
+            return 0
+        user_cache.put(user)
+        return result.rowcount
@@ -0,0 +1,85 @@
+import asyncio
+import argparse
+import statistics
+from time import perf_counter
+
+import sqlalchemy as db
+
+from users import User
+from async_users import AsyncUser
+from async_database_connection import AsyncDatabaseConnection
+from database_connection import DatabaseConnection
+from metrics import percentile
+
+
+# Chat ids far away from real Telegram ids, so seeded rows are easy to find and remove.
+_first_chat_id = -9_000_000_000
+
+
+def seed(chats):
+    users = [User(chat_id=_first_chat_id - i) for i in range(chats)]
+    with DatabaseConnection() as connection:
+        table = connection.get_table("user")
+        connection.execute(db.insert(table).values([user.to_row() for user in users]))
+
+
+def cleanup(chats):
+    with DatabaseConnection() as connection:
+        table = connection.get_table("user")
+        connection.execute(db.delete(table).where(
+            table.c.chat_id <= _first_chat_id, table.c.chat_id > _first_chat_id - chats))
+
+
+# What /toggle_notifications does: look the user up by chat id and write it back.
+async def toggle_async(chat_id):
+    async with AsyncDatabaseConnection.scope():
+        user = (await AsyncUser.get_users_by("chat_id", chat_id))[0]
+        user.set_is_active(not user.get_is_active())
+        await AsyncUser.update_user(user)
+
+
+async def toggle_blocking(chat_id):
+    user = User.get_users_by("chat_id", chat_id)[0]
+    user.set_is_active(not user.get_is_active())
+    User.update_user(user)
+
+
+async def run_chats(command, chats, commands):
+    latencies = []
+
+    async def chat(chat_id):
+        for _ in range(commands):
+            start = perf_counter()
+            await command(chat_id)
+            latencies.append(perf_counter() - start)
+            # Let other chats interleave, like separate Telegram updates would.
+            await asyncio.sleep(0)
+
+    start = perf_counter()
+    await asyncio.gather(*(chat(_first_chat_id - i) for i in range(chats)))
+    return latencies, perf_counter() - start
+
+
+def report(name, latencies, duration):
+    print(f"{name}: {len(latencies)} commands in {duration:.2f}s ({len(latencies) / duration:.0f}/s)  "
+          f"p50 {percentile(latencies, 50) * 1000:.1f} ms  p99 {percentile(latencies, 99) * 1000:.1f} ms  "
+          f"mean {statistics.mean(latencies) * 1000:.1f} ms")
+
+
+async def main(chats, commands):
+    report("blocking", *await run_chats(toggle_blocking, chats, commands))
+    report("async", *await run_chats(toggle_async, chats, commands))
+    await AsyncDatabaseConnection.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Command latency under many concurrent chats, blocking vs async data access.")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--commands", type=int, default=5)
+    args = parser.parse_args()
+    print("Seeding users into the configured database (DB_BACKEND)...")
+    seed(args.chats)
+    try:
+        asyncio.run(main(args.chats, args.commands))
+    finally:
+        cleanup(args.chats)
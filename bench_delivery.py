@@ -0,0 +1,127 @@
+import os
+import sys
+import argparse
+import tempfile
+import statistics
+import threading
+from time import perf_counter, sleep
+from pathlib import Path
+
+from PIL import Image
+
+from metrics import percentile
+from dispatcher import MessageDispatcher
+from media_cache import MediaCache
+from telegram_fixture import TelegramFixture
+
+# Chat ids far away from real Telegram ids.
+_first_chat_id = 7_000_000_000
+
+
+def make_photos(directory, count):
+    paths = []
+    for i in range(count):
+        path = Path(directory) / f"photo{i}.png"
+        Image.new("RGB", (360, 740), (i * 40 % 256, 120, 200)).save(path)
+        paths.append(path)
+    return paths
+
+
+# What a burst of notifications to `chats` chats looks like: per chat, `messages` texts and
+# one media group of the photos, submitted at once, like a cycle that found changes for everyone.
+def burst(dispatcher, chats, messages, photos):
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    pending = threading.Semaphore(0)
+    expected = {}
+    submitted = 0
+
+    def done(future, start):
+        with lock:
+            if future.exception() is not None:
+                failures.append(future.exception())
+            else:
+                latencies.append(perf_counter() - start)
+        pending.release()
+
+    start = perf_counter()
+    for i in range(chats):
+        chat_id = _first_chat_id + i
+        expected[chat_id] = []
+        for j in range(messages):
+            text = f"Update {j + 1} for chat {chat_id}"
+            expected[chat_id].append(text)
+            future = dispatcher.send_message(chat_id, text)
+            future.add_done_callback(lambda future, start=perf_counter(): done(future, start))
+            submitted += 1
+        if photos:
+            media = [(photo, f"Photo {k + 1} for chat {chat_id}") for k, photo in enumerate(photos)]
+            expected[chat_id] += [caption for _, caption in media]
+            if len(media) == 1:
+                future = dispatcher.send_photo(chat_id, media[0][0], caption=media[0][1])
+            else:
+                future = dispatcher.send_media_group(chat_id, media)
+            future.add_done_callback(lambda future, start=perf_counter(): done(future, start))
+            submitted += 1
+    for _ in range(submitted):
+        pending.acquire()
+    return perf_counter() - start, submitted, latencies, failures, expected
+
+
+# Returns False if a check failed: with a media cache, photos every chat gets are uploaded
+# fewer times than they are sent.
+def report(fixture, dispatcher, chats, photos, duration, submitted, latencies, failures, expected) -> bool:
+    stats = dispatcher.get_stats()
+    out_of_order = sum(1 for chat_id, texts in expected.items() if fixture.received.get(chat_id) != texts)
+    print(f"{chats} chats: {submitted} calls ({fixture.stats['messages']} messages) in {duration:.1f}s, "
+          f"{submitted / duration:.1f} calls/s, {fixture.stats['messages'] / duration:.1f} messages/s")
+    if latencies:
+        print(f"  latency p50 {percentile(latencies, 50):.2f}s  p95 {percentile(latencies, 95):.2f}s  "
+              f"p99 {percentile(latencies, 99):.2f}s  max {max(latencies):.2f}s  mean {statistics.mean(latencies):.2f}s")
+    print(f"  send p50/p99 {stats['send_p50'] * 1000:.0f}/{stats['send_p99'] * 1000:.0f} ms, "
+          f"429s {fixture.stats['flood']}, flood waits {stats['retry_after']}, network retries {stats['retries']}, "
+          f"uploads {fixture.stats['uploads']}")
+    print(f"  failed {len(failures)}, chats out of order or incomplete {out_of_order}")
+    if dispatcher.media_cache is None or not photos:
+        return True
+    sent = chats * len(photos)
+    print(f"  photos sent {sent}, uploaded {fixture.stats['uploads']}, reused {stats['media']['hits']}")
+    if chats > 1 and fixture.stats["uploads"] >= sent:
+        print("  FAILED: every photo was uploaded again, the media cache reused none.")
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark notification delivery against the fake Bot API in telegram_fixture.py.")
+    parser.add_argument("--chats", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--messages", type=int, default=1, help="text messages per chat")
+    parser.add_argument("--photos", type=int, default=0, help="photos per chat, sent as one media group")
+    parser.add_argument("--latency", type=float, default=0.05, help="Bot API response time in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--server-rate", type=float, default=30, help="messages/s the fake API accepts before answering 429")
+    parser.add_argument("--flood", type=float, default=0, help="share of requests answered with a 429 regardless of rate")
+    parser.add_argument("--rate", type=float, default=MessageDispatcher.global_rate, help="the dispatcher's global rate")
+    parser.add_argument("--workers", type=int, default=MessageDispatcher.workers)
+    parser.add_argument("--media-cache", action="store_true", help="reuse the file_ids of photos uploaded before, needs the database")
+    args = parser.parse_args()
+
+    passed = True
+    with tempfile.TemporaryDirectory() as directory:
+        photos = make_photos(directory, args.photos)
+        for chats in args.chats:
+            fixture = TelegramFixture(args.latency, args.jitter, args.server_rate, 1, args.flood, seed=chats)
+            fixture.start()
+            dispatcher = MessageDispatcher(os.getenv("TELEGRAM_TOKEN", "123456:benchmark"), workers=args.workers,
+                                           global_rate=args.rate, base_url=fixture.base_url,
+                                           media_cache=MediaCache() if args.media_cache else None)
+            try:
+                passed = report(fixture, dispatcher, chats, photos, *burst(dispatcher, chats, args.messages, photos)) and passed
+            finally:
+                dispatcher.stop()
+                fixture.stop()
+            # Let the next burst start from an empty flood window.
+            sleep(1)
+    if not passed:
+        sys.exit(1)
@@ -0,0 +1,229 @@
+import sys
+import json
+import random
+import asyncio
+import argparse
+import resource
+import statistics
+import tracemalloc
+from time import perf_counter
+
+import sqlalchemy as db
+
+import metrics
+from users import User
+from database_connection import DatabaseConnection
+from session_store import SessionStore, TokenStore
+from scrapper import ElearnScrapper
+from browser_pool import BrowserPool
+from scrapper_backends import HTTPBackend, WebServiceBackend
+from scrape_workers import ScrapeWorkerPool
+from moodle_fixture import MoodleFixture
+
+# Chat ids far away from real Telegram ids, so seeded rows are easy to find and remove.
+_first_chat_id = -8_000_000_000
+_password = "benchmark-password"
+
+# Lower is better for every result; a result more than `tolerance` above the baseline fails.
+RESULTS = ["cold_cycle_s", "cycle_s", "course_p50_ms", "course_p99_ms", "db_queries_per_cycle", "course_loads_per_cycle", "peak_memory_mb"]
+# Activities reported although nothing about them changed; anything but 0 fails.
+CHECKS = ["renotified"]
+
+
+# Every user gets a session of their own, with their own completion marks.
+def session(fixture, i):
+    return f"{fixture.session_id}.bench{i}"
+
+
+def seed(fixture, users, backend):
+    seeded = []
+    for i in range(users):
+        user = User(email=f"bench{i}@just.edu.jo", password=_password, chat_id=_first_chat_id - i, active=True)
+        User.insert_user(user)
+        if backend == "ws":
+            TokenStore.save(user.get_user_id(), fixture.ws_token)
+        elif backend == "http":
+            # The HTTP backend can't do the SSO login itself, it starts from a saved session.
+            SessionStore.save(user.get_user_id(), [{"name": fixture.session_cookie, "value": session(fixture, i), "path": "/"}])
+        seeded.append(user)
+    return seeded
+
+
+def cleanup(users):
+    user_ids = [user.get_user_id() for user in users]
+    chat_ids = [user.get_chat_id() for user in users]
+    with DatabaseConnection() as connection:
+        for name in ["last_updated", "user_session", "user_token", "course_subscriber", "user"]:
+            table = connection.get_table(name)
+            if table is not None:
+                connection.execute(db.delete(table).where(table.c.user_id.in_(user_ids)))
+        table = connection.get_table("outbox")
+        if table is not None:
+            connection.execute(db.delete(table).where(table.c.chat_id.in_(chat_ids)))
+
+
+# Returns the cycle's duration, queries, course timings and the names of the activities reported.
+async def run_cycle(scrape, users):
+    queries = DatabaseConnection.get_stats()["queries"]
+    start = perf_counter()
+    reported = []
+    async for user, courses_data, error in scrape(users):
+        if error is not None:
+            raise error
+        reported += [activity["text"].splitlines()[0] for course in courses_data
+                     for section in course["course_sections"] for activity in section["activities"]]
+    duration = perf_counter() - start
+    courses = list(metrics.cycle_log.last(1)[0]["courses"].values())
+    return duration, DatabaseConnection.get_stats()["queries"] - queries, courses, reported
+
+
+# Activity names as the fixture renders them, `touched` holds (course_id, section, activity).
+def activity_names(fixture, touched):
+    names = set()
+    for course_id, section, activity in touched:
+        name = f"Lecture {activity + 1} of week {section + 1}"
+        if fixture.revisions.get((course_id, section, activity)):
+            name += f" (rev {fixture.revisions[(course_id, section, activity)]})"
+        names.add(name)
+    return names
+
+
+async def benchmark(args):
+    fixture = MoodleFixture(args.courses, args.sections, args.activities, password=_password)
+    fixture.start()
+    ElearnScrapper.elearn_url = fixture.courses_url
+    ElearnScrapper.default_backend = "selenium" if args.backend == "selenium" else "http"
+    ElearnScrapper.use_web_service = args.backend == "ws"
+    BrowserPool.reset_url = f"{fixture.origin}/robots.txt"
+    HTTPBackend.screenshots = WebServiceBackend.screenshots = args.screenshots
+    random.seed(args.seed)
+
+    users = seed(fixture, args.users, args.backend)
+    pool = ScrapeWorkerPool(args.workers)
+    scrape = pool.scrape_shared if args.shared else pool.scrape
+    renotified = 0
+    tracemalloc.start()
+    try:
+        if args.shared:
+            # A bot that ran per-user scrapes before SHARED_COURSES=1 was turned on.
+            await run_cycle(pool.scrape, users)
+        # The first cycle logs in and finds every activity new, or with --shared nothing.
+        cold_cycle, _, _, reported = await run_cycle(scrape, users)
+        if args.shared:
+            renotified += len(reported)
+        cycles = []
+        queries = []
+        loads = []
+        courses = []
+        for _ in range(args.cycles):
+            touched = set()
+            for _ in range(args.changes):
+                activity = (random.randint(1, args.courses), random.randrange(args.sections), random.randrange(args.activities))
+                fixture.touch(*activity)
+                touched.add(activity)
+                # Users mark activities done, which must not be reported to anyone.
+                fixture.mark_done(random.randint(1, args.courses), random.randrange(args.sections), random.randrange(args.activities),
+                                  session(fixture, random.randrange(args.users)))
+            if args.shared:
+                # Another subscriber fetches the courses, with their own completion marks.
+                pool._fetchers = {random.choice(users).get_user_id()}
+            duration, cycle_queries, course_times, reported = await run_cycle(scrape, users)
+            expected = activity_names(fixture, touched)
+            renotified += sum(1 for name in reported if name not in expected)
+            cycles.append(duration)
+            queries.append(cycle_queries)
+            loads.append(len(course_times))
+            courses += course_times
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        pool.shutdown()
+        cleanup(users)
+        fixture.stop()
+
+    return {
+        "cold_cycle_s": round(cold_cycle, 3),
+        "cycle_s": round(statistics.median(cycles), 3),
+        "course_p50_ms": round(metrics.percentile(courses, 50) * 1000, 2),
+        "course_p99_ms": round(metrics.percentile(courses, 99) * 1000, 2),
+        "db_queries_per_cycle": statistics.median(queries),
+        # With --shared each course is loaded once per cycle, not once per subscriber.
+        "course_loads_per_cycle": statistics.median(loads),
+        "peak_memory_mb": round(peak / 1024 / 1024, 2),
+        # Includes the interpreter and, with Selenium, nothing of the browsers; not compared.
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "fixture_requests": fixture.requests,
+        "fixture_logins": fixture.logins,
+        "renotified": renotified,
+    }
+
+
+def compare(results, baseline, tolerance) -> list:
+    regressions = []
+    print(f"{'result':<24}{'baseline':>12}{'current':>12}{'change':>10}")
+    for key in RESULTS:
+        if key not in baseline:
+            continue
+        change = (results[key] - baseline[key]) / baseline[key] * 100 if baseline[key] else 0
+        regressed = results[key] > baseline[key] * (1 + tolerance) and results[key] - baseline[key] > 1e-3
+        print(f"{key:<24}{baseline[key]:>12}{results[key]:>12}{change:>+9.0f}%{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark scrape cycles against the synthetic Moodle in moodle_fixture.py.")
+    parser.add_argument("--backend", choices=["http", "ws", "selenium"], default="http")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--courses", type=int, default=6)
+    parser.add_argument("--sections", type=int, default=10)
+    parser.add_argument("--activities", type=int, default=6)
+    parser.add_argument("--cycles", type=int, default=5, help="cycles measured after the first, cold one")
+    parser.add_argument("--changes", type=int, default=3, help="activities edited before each cycle")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--screenshots", action="store_true", help="capture screenshots with the http and ws backends, needs Firefox")
+    parser.add_argument("--shared", action="store_true", help="scrape shared courses once per cycle, like SHARED_COURSES=1")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default="bench_baseline.json")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown over the baseline, 0.25 is 25%%")
+    parser.add_argument("--save-baseline", action="store_true", help="record this run as the baseline for its settings")
+    args = parser.parse_args()
+    if args.shared and args.backend == "ws":
+        parser.error("shared courses are fetched with the HTML backends, use --backend http or selenium")
+
+    settings = {key: getattr(args, key) for key in ["backend", "users", "courses", "sections", "activities", "cycles", "changes", "workers", "screenshots", "shared"]}
+    name = f"{args.backend}-{args.users}u-{args.courses}x{args.sections}x{args.activities}{'-shared' if args.shared else ''}"
+    results = asyncio.run(benchmark(args))
+    print(json.dumps(results, indent=2))
+    failed = [key for key in CHECKS if results[key]]
+    if failed:
+        print(f"Failed: {', '.join(f'{key} {results[key]}' for key in failed)}")
+        sys.exit(1)
+
+    try:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    if args.save_baseline:
+        baselines[name] = {"settings": settings, "results": results}
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baseline {name} to {args.baseline}")
+        sys.exit(0)
+
+    baseline = baselines.get(name)
+    if baseline is None:
+        print(f"No baseline {name} in {args.baseline}, run with --save-baseline to record one.")
+        sys.exit(0)
+    if baseline["settings"] != settings:
+        print(f"Baseline {name} was recorded with {baseline['settings']}, not comparable.")
+        sys.exit(2)
+    regressions = compare(results, baseline["results"], args.tolerance)
+    if regressions:
+        print(f"Regressed: {', '.join(regressions)}")
+        sys.exit(1)
+    print("No regressions.")
@@ -0,0 +1,120 @@
+import os
+import queue
+import logging
+import threading
+from urllib.parse import urljoin, urlparse
+
+
+class BrowserPool:
+    size = int(os.getenv("BROWSER_POOL_SIZE", 4))
+    max_pages = int(os.getenv("BROWSER_MAX_PAGES", 200))
+    # How long a scrape waits for a browser when all of them are in use.
+    acquire_timeout = float(os.getenv("BROWSER_ACQUIRE_TIMEOUT", 300))
+    # The elearn session is the only state kept between users; the SSO login is never
+    # remembered, its cookies end with the session.
+    reset_url = urljoin(os.getenv("ELEARN_URL", r"https://learn.ejust.org/"), "/robots.txt")
+
+    def __init__(self, factory, size=None, max_pages=None):
+        self._factory = factory
+        if size is not None:
+            self.size = size
+        if max_pages is not None:
+            self.max_pages = max_pages
+        self._idle = queue.LifoQueue()
+        self._pages = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close_all()
+
+    def _discard(self, browser):
+        with self._lock:
+            if self._pages.pop(browser, None) is not None:
+                self._count -= 1
+        try:
+            browser.quit()
+        except Exception as e:
+            logging.error(e)
+
+    def _reserve_slot(self):
+        # Counting launches in progress keeps concurrent acquires from overshooting the pool size.
+        with self._lock:
+            if self._closed or self._count >= self.size:
+                return False
+            self._count += 1
+            return True
+
+    def _launch_reserved(self):
+        try:
+            browser = self._factory()
+        except Exception:
+            with self._lock:
+                self._count -= 1
+            raise
+        with self._lock:
+            self._pages[browser] = 0
+        return browser
+
+    def acquire(self, timeout=None):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        if self._reserve_slot():
+            return self._launch_reserved()
+        timeout = self.acquire_timeout if timeout is None else timeout
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No browser was released in {timeout:.0f}s, all {self.size} are in use.") from None
+
+    def release(self, browser, pages=0):
+        if browser is None:
+            return
+        with self._lock:
+            pages_loaded = self._pages.get(browser, 0) + pages
+            if browser in self._pages:
+                self._pages[browser] = pages_loaded
+        if self._closed or pages_loaded >= self.max_pages:
+            logging.info(f"Recycling browser after {pages_loaded} pages.")
+            self._discard(browser)
+            return
+        try:
+            self.reset(browser)
+        except Exception as e:
+            logging.error(e)
+            self._discard(browser)
+            return
+        self._idle.put(browser)
+
+    # Cookies can only be deleted for the current origin; scrapes end on the elearn site.
+    def reset(self, browser):
+        if urlparse(browser.current_url).netloc != urlparse(self.reset_url).netloc:
+            browser.get(self.reset_url)
+        browser.delete_all_cookies()
+        browser.execute_script("window.localStorage.clear(); window.sessionStorage.clear();")
+        browser.get("about:blank")
+
+    def warm_up(self):
+        launched = 0
+        while self._reserve_slot():
+            self._idle.put(self._launch_reserved())
+            launched += 1
+        return launched
+
+    def idle_count(self):
+        return self._idle.qsize()
+
+    def close_all(self):
+        self._closed = True
+        while True:
+            try:
+                browser = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(browser)
@@ -0,0 +1,79 @@
+import os
+from datetime import datetime, timedelta
+
+import sqlalchemy as db
+
+import schema
+from database_connection import DatabaseConnection
+
+
+# course_url -> subscribed user ids, refreshed from each user's course list every `max_age` hours.
+# A user with no courses gets a row with an empty course_url so they are not re-listed every cycle.
+class CourseIndex:
+    table = schema.course_subscriber
+    max_age = timedelta(hours=float(os.getenv("COURSE_INDEX_MAX_AGE", 24)))
+    _table_ready = False
+
+    @classmethod
+    def _get_table(cls, connection: DatabaseConnection):
+        if not cls._table_ready:
+            cls._table_ready = connection.create_table(cls.table)
+        return cls.table
+
+    @classmethod
+    def load(cls, user_ids=None) -> dict:
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            query = db.select([table.c.course_url, table.c.user_id]).where(table.c.course_url != "")
+            if user_ids is not None:
+                query = query.where(table.c.user_id.in_(list(user_ids)))
+            result_proxy = connection.execute(query)
+            if result_proxy is None:
+                raise Exception("Could not load the course index")
+            index = {}
+            for row in result_proxy.fetchall():
+                index.setdefault(row["course_url"], []).append(row["user_id"])
+        return index
+
+    # The user's cached course list, or None if it is missing or older than max_age.
+    @classmethod
+    def user_courses(cls, user_id) -> list | None:
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            query = db.select([table.c.course_url, table.c.updated_at]).where(table.c.user_id == user_id)
+            result_proxy = connection.execute(query)
+            if result_proxy is None:
+                return None
+            rows = result_proxy.fetchall()
+        if not rows or min(row["updated_at"] for row in rows) < datetime.utcnow() - cls.max_age:
+            return None
+        return [row["course_url"] for row in rows if row["course_url"] != ""]
+
+    @classmethod
+    def stale_users(cls, user_ids) -> list:
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            query = db.select([table.c.user_id, db.func.min(table.c.updated_at).label("updated_at")]).group_by(table.c.user_id)
+            result_proxy = connection.execute(query)
+            if result_proxy is None:
+                return list(user_ids)
+            updated = {row["user_id"]: row["updated_at"] for row in result_proxy.fetchall()}
+        oldest = datetime.utcnow() - cls.max_age
+        return [user_id for user_id in user_ids if updated.get(user_id) is None or updated[user_id] < oldest]
+
+    @classmethod
+    def save_user(cls, user_id, courses_urls) -> bool:
+        now = datetime.utcnow()
+        rows = [{"course_url": url, "user_id": user_id, "updated_at": now} for url in courses_urls or [""]]
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            return connection.execute_in_transaction([
+                (db.delete(table).where(table.c.user_id == user_id), None),
+                (db.insert(table), rows),
+            ])
+
+    @classmethod
+    def remove_user(cls, user_id) -> bool:
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            return connection.execute(db.delete(table).where(table.c.user_id == user_id)) is not None
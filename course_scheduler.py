@@ -0,0 +1,171 @@
+import os
+import heapq
+import logging
+import threading
+from time import time
+
+import sqlalchemy as db
+
+import schema
+from database_connection import DatabaseConnection
+
+
+# What a worker node needs of the scheduler for one job: the courses due this cycle and the
+# ones the scheduler already knows. Observations travel back with the job's result.
+class ScheduleSnapshot:
+    def __init__(self, due, known):
+        self.due = set(due)
+        self.known = set(known)
+        self.observed = {}
+
+    def should_check(self, url) -> bool:
+        return url in self.due or url not in self.known
+
+    def observe(self, url, changed: bool):
+        self.observed[url] = self.observed.get(url, False) or changed
+
+
+# Decides which courses are checked in a cycle. Each course keeps an EWMA of the time
+# between its changes; it is checked `checks_per_change` times per expected change,
+# but never more often than `floor` or less often than `ceiling`. A course that has been
+# quiet for longer than its average gap backs off further.
+class CourseScheduler:
+    enabled = os.getenv("ADAPTIVE_SCHEDULE", "0") == "1"
+    floor = float(os.getenv("COURSE_INTERVAL_MIN", 5)) * 60
+    ceiling = float(os.getenv("COURSE_INTERVAL_MAX", 360)) * 60
+    checks_per_change = float(os.getenv("COURSE_CHECKS_PER_CHANGE", 4))
+    alpha = 0.3
+    # A course nobody checked for this long is dropped from the schedule.
+    forget_after = 30 * 24 * 3600
+    table = schema.course_schedule
+
+    def __init__(self, default_interval=15 * 60):
+        self.default_interval = default_interval
+        self._courses = {}
+        self._heap = []
+        self._due = set()
+        self._observed = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._table_ready = False
+
+    def _get_table(self, connection: DatabaseConnection):
+        if not self._table_ready:
+            self._table_ready = connection.create_table(self.table)
+        return self.table
+
+    def load(self):
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            result_proxy = connection.execute(db.select([table]))
+            if result_proxy is None:
+                raise Exception("Could not load the course schedule")
+            rows = result_proxy.fetchall()
+        with self._lock:
+            self._courses = {row["course_url"]: dict(row) for row in rows}
+            self._heap = [(course["next_due"], url) for url, course in self._courses.items()]
+            heapq.heapify(self._heap)
+        self._loaded = True
+
+    def save(self, urls) -> bool:
+        rows = [self._courses[url] for url in urls if url in self._courses]
+        if not rows:
+            return True
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            return connection.upsert(table, rows, ["change_gap", "last_checked", "last_changed", "next_due"])
+
+    def interval(self, course, now=None) -> float:
+        now = time() if now is None else now
+        quiet = now - (course["last_changed"] or course["first_seen"])
+        return min(self.ceiling, max(self.floor, max(course["change_gap"], quiet) / self.checks_per_change))
+
+    # Pops every course that is due from the heap; they stay due until end_cycle().
+    def begin_cycle(self, now=None) -> set:
+        if not self._loaded:
+            self.load()
+        now = time() if now is None else now
+        with self._lock:
+            self._observed = {}
+            self._due = set()
+            while self._heap and self._heap[0][0] <= now:
+                next_due, url = heapq.heappop(self._heap)
+                course = self._courses.get(url)
+                # Entries are replaced by pushing a new one; skip the outdated copies.
+                if course is not None and course["next_due"] == next_due:
+                    self._due.add(url)
+            return set(self._due)
+
+    # Courses the scheduler has never seen are always checked.
+    def should_check(self, url) -> bool:
+        with self._lock:
+            return url in self._due or url not in self._courses
+
+    def observe(self, url, changed: bool):
+        with self._lock:
+            self._observed[url] = self._observed.get(url, False) or changed
+
+    def end_cycle(self, now=None):
+        now = time() if now is None else now
+        with self._lock:
+            updated = []
+            for url, changed in self._observed.items():
+                course = self._courses.get(url)
+                if course is None:
+                    course = self._courses[url] = {
+                        "course_url": url, "change_gap": self.default_interval * self.checks_per_change,
+                        "first_seen": now, "last_checked": None, "last_changed": None, "next_due": now}
+                if changed:
+                    if course["last_changed"] is not None:
+                        gap = now - course["last_changed"]
+                        course["change_gap"] = self.alpha * gap + (1 - self.alpha) * course["change_gap"]
+                    course["last_changed"] = now
+                course["last_checked"] = now
+                course["next_due"] = now + self.interval(course, now)
+                heapq.heappush(self._heap, (course["next_due"], url))
+                updated.append(url)
+            # Due but not checked, e.g. the only subscriber's login failed: try again soon.
+            forgotten = []
+            for url in self._due - set(self._observed):
+                course = self._courses[url]
+                if now - (course["last_checked"] or course["first_seen"]) > self.forget_after:
+                    del self._courses[url]
+                    forgotten.append(url)
+                    continue
+                course["next_due"] = now + self.floor
+                heapq.heappush(self._heap, (course["next_due"], url))
+                updated.append(url)
+            self._due = set()
+            self._observed = {}
+        if not self.save(updated):
+            logging.error(f"Could not save the schedule of {len(updated)} courses")
+        if forgotten:
+            with DatabaseConnection() as connection:
+                table = self._get_table(connection)
+                connection.execute(db.delete(table).where(table.c.course_url.in_(forgotten)))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"due": list(self._due), "known": list(self._courses)}
+
+    def seconds_until_next_due(self, now=None) -> float:
+        now = time() if now is None else now
+        with self._lock:
+            while self._heap:
+                next_due, url = self._heap[0]
+                course = self._courses.get(url)
+                if course is not None and course["next_due"] == next_due:
+                    return max(0, next_due - now)
+                heapq.heappop(self._heap)
+        return self.ceiling
+
+    def get_stats(self, now=None) -> dict:
+        now = time() if now is None else now
+        with self._lock:
+            intervals = [course["next_due"] - (course["last_checked"] or now) for course in self._courses.values()]
+        return {
+            "courses": len(intervals),
+            "min_interval": min(intervals, default=0),
+            "max_interval": max(intervals, default=0),
+            "checks_per_hour": sum(3600 / interval for interval in intervals if interval > 0),
+        }
@@ -0,0 +1,116 @@
+import os
+import sys
+import logging
+import argparse
+import threading
+from time import monotonic
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+import sqlalchemy as db
+from cryptography.fernet import Fernet, MultiFernet
+
+import schema
+
+
+load_dotenv()
+
+
+# Holds the Fernet keys for the process and caches decrypted values for a short while.
+# ENCRYPTION_KEY encrypts; ENCRYPTION_OLD_KEYS (comma separated) are only tried when decrypting,
+# until rotate() has re-encrypted everything under the new key.
+class CredentialVault:
+    ttl = float(os.getenv("CREDENTIAL_CACHE_TTL", 60))
+    max_size = int(os.getenv("CREDENTIAL_CACHE_SIZE", 1000))
+    _fernet = None
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_fernet(cls) -> MultiFernet:
+        if cls._fernet is None:
+            keys = [os.getenv("ENCRYPTION_KEY")]
+            keys += [key for key in os.getenv("ENCRYPTION_OLD_KEYS", "").split(",") if key.strip()]
+            cls._fernet = MultiFernet([Fernet(key.strip().encode()) for key in keys])
+        return cls._fernet
+
+    @classmethod
+    def encrypt(cls, data: bytes) -> bytes:
+        return cls.get_fernet().encrypt(data)
+
+    @classmethod
+    def decrypt(cls, token: bytes) -> bytes:
+        return cls.get_fernet().decrypt(token)
+
+    # The ciphertext is the cache key, so changing a password never returns the old one.
+    @classmethod
+    def decrypt_cached(cls, token: bytes) -> bytes:
+        now = monotonic()
+        with cls._lock:
+            entry = cls._cache.get(token)
+            if entry is not None and entry[0] > now:
+                cls._cache.move_to_end(token)
+                return entry[1]
+        data = cls.decrypt(token)
+        with cls._lock:
+            cls._cache[token] = (now + cls.ttl, data)
+            while len(cls._cache) > cls.max_size:
+                cls._cache.popitem(last=False)
+        return data
+
+    @classmethod
+    def clear_cache(cls):
+        with cls._lock:
+            cls._cache.clear()
+
+    @classmethod
+    def rotate_table(cls, engine, table: db.Table, column: str, batch_size=500) -> int:
+        key = table.c.user_id
+        rotated = 0
+        last = None
+        query = db.update(table).where(key == db.bindparam("_key")).values({column: db.bindparam("_value")})
+        with engine.connect() as connection:
+            while True:
+                select = db.select([key, table.c[column]]).where(table.c[column].isnot(None)).order_by(key).limit(batch_size)
+                if last is not None:
+                    select = select.where(key > last)
+                rows = connection.execute(select).fetchall()
+                if not rows:
+                    break
+                values = [{"_key": row[0], "_value": cls.get_fernet().rotate(row[1])} for row in rows]
+                with connection.begin():
+                    connection.execute(query, values)
+                rotated += len(rows)
+                last = rows[-1][0]
+                print(f"{table.name}: {rotated} rows", end="\r")
+        print(f"{table.name}: {rotated} rows")
+        return rotated
+
+    # Re-encrypts every stored secret under ENCRYPTION_KEY. Run it after moving the
+    # previous key to ENCRYPTION_OLD_KEYS; the old key can be dropped once it finishes.
+    @classmethod
+    def rotate(cls, engine, batch_size=500) -> int:
+        schema.metadata.create_all(engine)
+        rotated = 0
+        for table, column in [(schema.user, "password"), (schema.user_session, "cookies"), (schema.user_token, "token")]:
+            rotated += cls.rotate_table(engine, table, column, batch_size)
+        cls.clear_cache()
+        return rotated
+
+
+if __name__ == "__main__":
+    from database_connection import make_engine
+
+    parser = argparse.ArgumentParser(description="Re-encrypt stored credentials under ENCRYPTION_KEY.")
+    parser.add_argument("command", choices=["rotate", "generate-key"])
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    if args.command == "generate-key":
+        print(Fernet.generate_key().decode())
+        sys.exit(0)
+    try:
+        CredentialVault.rotate(make_engine(), args.batch_size)
+    except Exception as e:
+        print(e)
+        logging.error(e)
+        sys.exit(1)
@@ -1,11 +1,17 @@
 import os
 import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
 from urllib.parse import quote_plus as qp
 from dotenv import load_dotenv
 
 import sqlalchemy as db
+from sqlalchemy.dialects import mysql, sqlite
 from pymysql import err as sqlError
 
+import schema
+
 load_dotenv()
 
 def main():
@@ -13,30 +19,125 @@ def main():
                         filename="./logs/database.log", format=f"%(levelname)s   %(asctime)s  \n%(message)s \n{'='*100}\n", filemode="w")
 
 
-class DatabaseConnection:
-    _db_login = {
-        "host": os.getenv("DB_HOST"), 
-        "port": os.getenv("DB_PORT"), 
-        "user": os.getenv("DB_USER"), 
-        "password": os.getenv("DB_PASSWORD"), 
-        "database": os.getenv("DB_NAME")
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "./data/elearn.db")
+
+_sqlite_pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "foreign_keys": "ON",
+    "busy_timeout": 5000,
+    "cache_size": -20000,
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,
+}
+
+
+def database_url(backend=DB_BACKEND, driver=None) -> str:
+    if backend == "sqlite":
+        return f"sqlite+{driver or 'pysqlite'}:///{SQLITE_PATH}"
+    if backend == "mysql":
+        return (f"mysql+{driver or 'pymysql'}://{qp(os.getenv('DB_USER', ''))}:{qp(os.getenv('DB_PASSWORD', ''))}"
+                f"@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}")
+    raise ValueError(f"Unknown database backend: {backend}")
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in _sqlite_pragmas.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+def make_engine(backend=DB_BACKEND):
+    pool_args = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", 30)),
     }
-    _engine = db.create_engine(
-        f"mysql+pymysql://{_db_login['user']}:{_db_login['password']}@{_db_login['host']}:{_db_login['port']}/{_db_login['database']}")
-    _metadata = db.MetaData()
-    del _db_login
+    if backend == "sqlite":
+        directory = os.path.dirname(SQLITE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        engine = db.create_engine(database_url(backend), poolclass=db.pool.QueuePool,
+                                  connect_args={"check_same_thread": False, "timeout": 30}, **pool_args)
+        db.event.listen(engine, "connect", _set_sqlite_pragmas)
+        # Embedded databases bootstrap their own schema.
+        schema.metadata.create_all(engine)
+        return engine
+    return db.create_engine(database_url(backend), pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 3600)),
+                            pool_pre_ping=True, **pool_args)
+
+
+# With no update_columns, rows that already exist are left as they are.
+def upsert_query(dialect_name, table: db.Table, rows: list, update_columns: list):
+    if dialect_name == "sqlite":
+        query = sqlite.insert(table).values(rows)
+        if not update_columns:
+            return query.on_conflict_do_nothing()
+        return query.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={column: query.excluded[column] for column in update_columns})
+    query = mysql.insert(table).values(rows)
+    if not update_columns:
+        return query.prefix_with("IGNORE")
+    return query.on_duplicate_key_update({column: query.inserted[column] for column in update_columns})
+
+
+class DatabaseConnection:
+    _engine = make_engine()
+    _metadata = schema.metadata
+
+    # Connection shared by every DatabaseConnection opened inside scope(), per thread and per asyncio task.
+    _scoped_connection = ContextVar("scoped_connection", default=None)
+    _reflect_lock = threading.Lock()
+    _stats_lock = threading.Lock()
+    stats = {"checkouts": 0, "connects": 0, "reflections": 0, "scopes": 0, "queries": 0}
 
     def __init__(self):
-        self._connection = self._engine.connect()
+        self._connection = self._scoped_connection.get()
+        self._owns_connection = self._connection is None
+        if self._owns_connection:
+            self._connection = self._engine.connect()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._connection.close()
+        self.close()
 
     def __del__(self):
-        self._connection.close()
+        self.close()
+
+    def close(self):
+        if getattr(self, "_owns_connection", False) and self._connection is not None:
+            self._connection.close()
+        self._connection = None
+
+    @classmethod
+    @contextmanager
+    def scope(cls):
+        if cls._scoped_connection.get() is not None:
+            yield
+            return
+        connection = cls._engine.connect()
+        token = cls._scoped_connection.set(connection)
+        cls._count("scopes")
+        try:
+            yield
+        finally:
+            cls._scoped_connection.reset(token)
+            connection.close()
+
+    @classmethod
+    def _count(cls, key, value=1):
+        with cls._stats_lock:
+            cls.stats[key] += value
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        with cls._stats_lock:
+            return dict(cls.stats)
 
     def execute(self, query):
         try:
@@ -46,15 +147,59 @@ class DatabaseConnection:
             return None
         return result_proxy
 
-    def get_table(self, table_name) -> db.Table | None:
+    # Insert-or-update for all rows, in one transaction.
+    def upsert(self, table: db.Table, rows: list, update_columns: list, chunk_size=1000) -> bool:
+        return self.execute_in_transaction(self.upsert_statements(table, rows, update_columns, chunk_size))
+
+    # The upsert as (query, params) pairs, to run along other statements in execute_in_transaction().
+    def upsert_statements(self, table: db.Table, rows: list, update_columns: list, chunk_size=1000) -> list:
+        return [(upsert_query(self._engine.dialect.name, table, rows[i:i + chunk_size], update_columns), None)
+                for i in range(0, len(rows), chunk_size)]
+
+    # For queries that must share one transaction, e.g. SELECT ... FOR UPDATE and the UPDATE after it.
+    def transaction(self):
+        return self._connection.begin()
+
+    # Runs (query, params) pairs in one transaction; nothing is kept if one fails.
+    def execute_in_transaction(self, statements: list) -> bool:
         try:
-            table = db.Table(table_name, self._metadata,
-                             autoload=True, autoload_with=self._engine)
+            with self._connection.begin():
+                for query, params in statements:
+                    if params is None:
+                        self._connection.execute(query)
+                    else:
+                        self._connection.execute(query, params)
         except Exception as e:
             logging.error(e)
-            return None
+            return False
+        return True
+
+    def get_table(self, table_name) -> db.Table | None:
+        table = self._metadata.tables.get(table_name)
+        if table is not None:
+            return table
+        # Tables that are not declared in schema.py are reflected once and kept in the metadata.
+        with self._reflect_lock:
+            table = self._metadata.tables.get(table_name)
+            if table is not None:
+                return table
+            try:
+                table = db.Table(table_name, self._metadata,
+                                 autoload=True, autoload_with=self._engine)
+            except Exception as e:
+                logging.error(e)
+                return None
+            self._count("reflections")
         return table
 
+    def create_table(self, table: db.Table) -> bool:
+        try:
+            table.create(self._connection, checkfirst=True)
+        except Exception as e:
+            logging.error(e)
+            return False
+        return True
+
     def get_table_names(self):
         return self._engine.table_names()
 
@@ -65,5 +210,10 @@ class DatabaseConnection:
         return table.columns.keys()
 
 
+db.event.listen(DatabaseConnection._engine, "checkout", lambda *args: DatabaseConnection._count("checkouts"))
+db.event.listen(DatabaseConnection._engine, "connect", lambda *args: DatabaseConnection._count("connects"))
+db.event.listen(DatabaseConnection._engine, "before_cursor_execute", lambda *args: DatabaseConnection._count("queries"))
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,77 @@
+import logging
+
+import sqlalchemy as db
+
+from database_connection import DatabaseConnection
+from outbox import Outbox
+import metrics
+
+
+# Holds all of a user's last_updated hashes in memory for one scrape and
+# writes every change back in a single transaction at the end.
+class DiffSession:
+    def __init__(self, user_id):
+        self._user_id = user_id
+        self._hashes = None
+        self._pending = {}
+        self._previous = {}
+
+    def load(self):
+        with metrics.diff_load.time(), DatabaseConnection() as connection:
+            table = connection.get_table("last_updated")
+            query = db.select([table.c.id, table.c.hash]).where(table.c.user_id == self._user_id)
+            result_proxy = connection.execute(query)
+            if result_proxy is None:
+                raise Exception("Could not load last_updated hashes")
+            self._hashes = {row["id"]: row["hash"] for row in result_proxy.fetchall()}
+
+    # Which of item_ids other owners have a hash for.
+    @staticmethod
+    def known_to_others(user_id, item_ids) -> set:
+        if not item_ids:
+            return set()
+        with DatabaseConnection() as connection:
+            table = connection.get_table("last_updated")
+            query = db.select([table.c.id]).distinct().where(table.c.id.in_(list(item_ids))).where(table.c.user_id != user_id)
+            result_proxy = connection.execute(query)
+            if result_proxy is None:
+                raise Exception("Could not load last_updated hashes")
+            return {row["id"] for row in result_proxy.fetchall()}
+
+    def get_hash(self, item_id):
+        if self._hashes is None:
+            self.load()
+        return self._hashes.get(item_id)
+
+    def is_changed(self, item_id, hash, type=None) -> bool:
+        if self.get_hash(item_id) == hash:
+            return False
+        self._previous.setdefault(item_id, self._hashes.get(item_id))
+        self._hashes[item_id] = hash
+        self._pending[item_id] = {"id": item_id, "user_id": self._user_id, "hash": hash, "type": type}
+        return True
+
+    # The hash an item had before this session changed it.
+    def previous_hash(self, item_id):
+        if item_id in self._previous:
+            return self._previous[item_id]
+        return self.get_hash(item_id)
+
+    def pending_count(self):
+        return len(self._pending)
+
+    # `notifications` are outbox rows, saved with the hashes or not at all.
+    def flush(self, notifications=None) -> bool:
+        if not self._pending and not notifications:
+            return True
+        with metrics.diff_flush.time(), DatabaseConnection() as connection:
+            table = connection.get_table("last_updated")
+            statements = connection.upsert_statements(table, list(self._pending.values()), ["hash"])
+            if notifications:
+                statements += Outbox.statements(connection, notifications)
+            if not connection.execute_in_transaction(statements):
+                logging.error(f"Could not save {len(self._pending)} hashes and {len(notifications or [])} notifications for user {self._user_id}")
+                return False
+        self._pending = {}
+        self._previous = {}
+        return True
@@ -0,0 +1,307 @@
+import os
+import asyncio
+import itertools
+import logging
+import heapq
+import threading
+from pathlib import Path
+from time import monotonic, perf_counter
+from collections import deque
+from concurrent.futures import Future
+
+from telegram import Bot as BotAPI, InputMediaPhoto
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+from telegram.request import HTTPXRequest
+
+import metrics
+
+
+# Owns one long-lived Bot (and its keep-alive connection pool) on a loop in its own thread,
+# so the notifier thread and the bot's handlers can both enqueue without sharing a loop.
+# Messages to one chat are delivered one at a time in the order they were submitted, while
+# other chats keep the workers busy.
+class MessageDispatcher:
+    # Telegram allows about 30 messages/s overall and 1 message/s to the same chat.
+    global_rate = float(os.getenv("TELEGRAM_GLOBAL_RATE", 25))
+    chat_rate = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+    workers = int(os.getenv("TELEGRAM_SEND_WORKERS", 8))
+    pool_size = int(os.getenv("TELEGRAM_POOL_SIZE", 8))
+    max_retries = int(os.getenv("TELEGRAM_MAX_RETRIES", 5))
+    backoff = float(os.getenv("TELEGRAM_BACKOFF", 1))
+    # Another Bot API server, e.g. telegram_fixture.py for load tests.
+    base_url = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+    latency_window = 1000
+
+    def __init__(self, token, workers=None, global_rate=None, chat_rate=None, media_cache=None, base_url=None):
+        if workers is not None:
+            self.workers = workers
+        if global_rate is not None:
+            self.global_rate = global_rate
+        if chat_rate is not None:
+            self.chat_rate = chat_rate
+        if base_url is not None:
+            self.base_url = base_url
+        self.media_cache = media_cache
+        self._uploading = {}
+        self._request = HTTPXRequest(connection_pool_size=self.pool_size)
+        self.bot = BotAPI(token=token, request=self._request, base_url=self.base_url)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._loop = None
+        # Set once the loop runs; every submit() waits for it, not only the one that started the thread.
+        self._started = threading.Event()
+        self._tasks = []
+        # chat_id -> messages not yet sent; a chat is in _ready only while nothing is in flight for it.
+        self._pending = {}
+        self._ready = []
+        self._ready_changed = None
+        self._idle = None
+        self._depth = 0
+        self._sequence = itertools.count()
+        self._next_chat = {}
+        self._next_send = 0
+        self._paused_until = 0
+        self._queue_latency = deque(maxlen=self.latency_window)
+        self._send_latency = deque(maxlen=self.latency_window)
+        self.stats = {"submitted": 0, "sent": 0, "failed": 0, "retries": 0, "retry_after": 0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="dispatcher", daemon=True)
+                self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._ready_changed = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._loop.run_until_complete(self._request.initialize())
+        self._tasks = [self._loop.create_task(self._worker()) for _ in range(self.workers)]
+        self._started.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    # Waits up to `timeout` seconds for queued messages, then closes the connection pool.
+    def stop(self, timeout=30):
+        if self._thread is None:
+            return
+        drain = asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+        try:
+            drain.result(timeout)
+        except Exception as e:
+            logging.error(f"Dispatcher stopped with {self.queue_depth()} messages queued: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._started.clear()
+        self._thread = None
+
+    async def _shutdown(self):
+        try:
+            await self._idle.wait()
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await self._request.shutdown()
+
+    # Thread-safe. Returns a concurrent.futures.Future that resolves with Telegram's
+    # response; wrap it with asyncio.wrap_future() to await delivery.
+    def submit(self, method, chat_id, **kwargs) -> Future:
+        self.start()
+        future = Future()
+        item = (method, chat_id, kwargs, future, monotonic())
+        with self._lock:
+            self.stats["submitted"] += 1
+        self._loop.call_soon_threadsafe(self._enqueue, item)
+        return future
+
+    def send_message(self, chat_id, text, **kwargs) -> Future:
+        return self.submit("send_message", chat_id, text=text, **kwargs)
+
+    def send_photo(self, chat_id, photo, **kwargs) -> Future:
+        return self.submit("send_photo", chat_id, photo=photo, **kwargs)
+
+    # `media` is a list of (photo, caption) pairs.
+    def send_media_group(self, chat_id, media, **kwargs) -> Future:
+        return self.submit("send_media_group", chat_id, media=media, **kwargs)
+
+    def queue_depth(self) -> int:
+        return self._depth
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        queue_latency = list(self._queue_latency)
+        send_latency = list(self._send_latency)
+        stats.update({
+            "queue_depth": self.queue_depth(),
+            "queue_p50": metrics.percentile(queue_latency, 50),
+            "queue_p99": metrics.percentile(queue_latency, 99),
+            "send_p50": metrics.percentile(send_latency, 50),
+            "send_p99": metrics.percentile(send_latency, 99),
+        })
+        if self.media_cache is not None:
+            stats["media"] = self.media_cache.get_stats()
+        return stats
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _enqueue(self, item):
+        chat_id = item[1]
+        self._depth += 1
+        self._idle.clear()
+        if chat_id in self._pending:
+            self._pending[chat_id].append(item)
+            return
+        self._pending[chat_id] = deque([item])
+        self._schedule(chat_id)
+
+    def _schedule(self, chat_id):
+        heapq.heappush(self._ready, (self._next_chat.get(chat_id, 0), next(self._sequence), chat_id))
+        self._ready_changed.set()
+
+    async def _next_ready_chat(self):
+        while True:
+            now = monotonic()
+            if self._ready and self._ready[0][0] <= now:
+                return heapq.heappop(self._ready)[2]
+            timeout = self._ready[0][0] - now if self._ready else None
+            self._ready_changed.clear()
+            try:
+                await asyncio.wait_for(self._ready_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._next_ready_chat()
+            queue = self._pending[chat_id]
+            method, _, kwargs, future, enqueued_at = queue.popleft()
+            self._queue_latency.append(monotonic() - enqueued_at)
+            try:
+                error = await self._send(method, chat_id, kwargs, future)
+            except Exception as e:
+                error = e
+            metrics.telegram_messages.inc(method=method, result="failed" if error is not None else "sent")
+            if error is not None:
+                self._count("failed")
+                logging.error(f"Could not {method} to {chat_id}: {error}")
+                future.set_exception(error)
+            self._next_chat[chat_id] = monotonic() + 1 / self.chat_rate
+            if queue:
+                self._schedule(chat_id)
+            else:
+                del self._pending[chat_id]
+                if len(self._next_chat) > 10000:
+                    now = monotonic()
+                    self._next_chat = {key: value for key, value in self._next_chat.items() if value > now}
+            self._depth -= 1
+            if self._depth == 0:
+                self._idle.set()
+
+    async def _wait_global_turn(self):
+        now = monotonic()
+        send_at = max(now, self._next_send, self._paused_until)
+        self._next_send = send_at + 1 / self.global_rate
+        await asyncio.sleep(send_at - now)
+
+    # Turns queued Path objects into something the Bot API accepts. With a media cache, a
+    # photo uploaded before is sent by file_id, and a single photo that another send is still
+    # uploading waits for its file_id instead of uploading it again. Media groups never wait:
+    # two groups could each be waiting on a photo the other one is uploading.
+    async def _resolve_photo(self, photo, position, uploads, cached):
+        if not isinstance(photo, Path):
+            return photo
+        if self.media_cache is None:
+            return photo.read_bytes()
+        key, media = await asyncio.to_thread(self.media_cache.resolve, photo)
+        if isinstance(media, bytes):
+            # Another send may have finished uploading it while this one was compressing.
+            media = self.media_cache.peek(key) or media
+        if isinstance(media, bytes) and position is None and key in self._uploading:
+            media = await asyncio.shield(self._uploading[key]) or media
+        if not isinstance(media, bytes):
+            self.media_cache.count("hits")
+            cached.append(key)
+            return media
+        if key not in self._uploading:
+            self._uploading[key] = self._loop.create_future()
+        uploads.append((position, key, len(media)))
+        return media
+
+    # Files are read per attempt, so a retry after a timeout re-sends the whole photo.
+    async def _prepare(self, kwargs, uploads, cached) -> dict:
+        arguments = dict(kwargs)
+        if "photo" in arguments:
+            arguments["photo"] = await self._resolve_photo(arguments["photo"], None, uploads, cached)
+        if "media" in arguments:
+            arguments["media"] = [InputMediaPhoto(await self._resolve_photo(photo, i, uploads, cached), caption=caption)
+                                  for i, (photo, caption) in enumerate(arguments["media"])]
+        return arguments
+
+    async def _finish_uploads(self, uploads, result):
+        for position, key, size in uploads:
+            file_id = None
+            message = result if position is None or result is None else result[position]
+            if message is not None and message.photo:
+                file_id = message.photo[-1].file_id
+                try:
+                    await asyncio.to_thread(self.media_cache.save_file_id, key, file_id, size)
+                except Exception as e:
+                    logging.error(e)
+            waiting = self._uploading.pop(key, None)
+            if waiting is not None and not waiting.done():
+                waiting.set_result(file_id)
+
+    async def _send(self, method, chat_id, kwargs, future):
+        attempt = 0
+        flood_waits = 0
+        forgot_cached = False
+        while True:
+            uploads = []
+            cached = []
+            result = None
+            try:
+                arguments = await self._prepare(kwargs, uploads, cached)
+                await self._wait_global_turn()
+                start = perf_counter()
+                result = await getattr(self.bot, method)(chat_id=chat_id, **arguments)
+            except RetryAfter as e:
+                if flood_waits >= self.max_retries:
+                    return e
+                flood_waits += 1
+                # Flood control applies to the whole bot, so every worker backs off.
+                self._count("retry_after")
+                self._paused_until = max(self._paused_until, monotonic() + e.retry_after)
+                logging.info(f"Flood control, pausing sends for {e.retry_after}s.")
+                continue
+            except BadRequest as e:
+                if cached and not forgot_cached:
+                    # A file_id Telegram no longer knows; upload those photos again.
+                    forgot_cached = True
+                    for key in cached:
+                        await asyncio.to_thread(self.media_cache.forget, key)
+                    continue
+                return e
+            except Forbidden as e:
+                return e
+            except NetworkError as e:
+                if attempt >= self.max_retries:
+                    return e
+                self._count("retries")
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+                continue
+            except Exception as e:
+                return e
+            finally:
+                await self._finish_uploads(uploads, result)
+            self._send_latency.append(perf_counter() - start)
+            metrics.telegram_send.observe(self._send_latency[-1], method=method)
+            self._count("sent")
+            future.set_result(result)
+            return None
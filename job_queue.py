@@ -0,0 +1,147 @@
+import os
+import json
+import logging
+from time import time
+
+import sqlalchemy as db
+
+import schema
+from database_connection import DatabaseConnection
+
+
+# Scrape jobs shared by the bot and any number of worker processes through the database.
+# Workers claim jobs with a lease and renew it while they work; a job whose lease ran out
+# (the worker died) is claimed again, up to max_attempts times.
+class JobQueue:
+    table = schema.scrape_job
+    lease_time = float(os.getenv("JOB_LEASE_SECONDS", 120))
+    max_attempts = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+
+    def __init__(self):
+        self._table_ready = False
+
+    def _get_table(self, connection: DatabaseConnection):
+        if not self._table_ready:
+            self._table_ready = connection.create_table(self.table)
+        return self.table
+
+    def enqueue(self, kind, user_id, payload=None) -> int | None:
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            query = db.insert(table).values({"kind": kind, "user_id": user_id, "payload": json.dumps(payload),
+                                             "status": "pending", "attempts": 0, "created_at": time()})
+            result = connection.execute(query)
+            if result is None:
+                return None
+            return result.inserted_primary_key[0]
+
+    def _claimable(self, table, now):
+        return db.and_(
+            table.c.attempts < self.max_attempts,
+            db.or_(table.c.status == "pending",
+                   db.and_(table.c.status == "leased", table.c.lease_expires < now)))
+
+    # SKIP LOCKED lets concurrent workers pass over each other's rows on MySQL. SQLite has no
+    # row locks, so the UPDATE re-checks that the job is still claimable and a job that
+    # another worker took in between is skipped.
+    def claim(self, worker_id, limit=1) -> list:
+        if limit < 1:
+            return []
+        now = time()
+        claimed = []
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            try:
+                with connection.transaction():
+                    query = (db.select([table]).where(self._claimable(table, now))
+                             .order_by(table.c.id).limit(limit).with_for_update(skip_locked=True))
+                    result_proxy = connection.execute(query)
+                    if result_proxy is None:
+                        raise Exception("Could not read the job table")
+                    for row in result_proxy.fetchall():
+                        query = db.update(table).where(table.c.id == row["id"]).where(self._claimable(table, now)).values({
+                            "status": "leased", "lease_owner": worker_id,
+                            "lease_expires": now + self.lease_time, "attempts": row["attempts"] + 1})
+                        result = connection.execute(query)
+                        if result is not None and result.rowcount == 1:
+                            job = dict(row)
+                            job["payload"] = json.loads(job["payload"]) if job["payload"] else None
+                            job["attempts"] += 1
+                            claimed.append(job)
+            except Exception as e:
+                logging.error(e)
+                return []
+        return claimed
+
+    # Returns how many of the jobs this worker still holds.
+    def heartbeat(self, worker_id, job_ids) -> int:
+        if not job_ids:
+            return 0
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            query = (db.update(table).where(table.c.id.in_(list(job_ids)))
+                     .where(table.c.lease_owner == worker_id).where(table.c.status == "leased")
+                     .values({"lease_expires": time() + self.lease_time}))
+            result = connection.execute(query)
+            return 0 if result is None else result.rowcount
+
+    def _finish(self, job_id, worker_id, values) -> bool:
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            query = (db.update(table).where(table.c.id == job_id).where(table.c.lease_owner == worker_id)
+                     .where(table.c.status == "leased").values(values))
+            result = connection.execute(query)
+            return result is not None and result.rowcount == 1
+
+    def complete(self, job_id, worker_id, result) -> bool:
+        return self._finish(job_id, worker_id, {"status": "done", "result": json.dumps(result)})
+
+    # Login errors are final; anything else goes back to the queue until max_attempts.
+    def fail(self, job_id, worker_id, error: Exception, attempts, retry=True) -> bool:
+        status = "pending" if retry and attempts < self.max_attempts else "failed"
+        return self._finish(job_id, worker_id, {"status": status, "lease_owner": None, "lease_expires": None,
+                                                "error": str(error), "error_type": type(error).__name__})
+
+    # Returns finished jobs among job_ids and deletes them. Jobs whose last lease ran out
+    # are marked failed first, so a crashed worker can't keep the bot waiting.
+    def collect(self, job_ids) -> list:
+        if not job_ids:
+            return []
+        now = time()
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            ids = table.c.id.in_(list(job_ids))
+            connection.execute(
+                db.update(table).where(ids).where(table.c.status == "leased").where(table.c.lease_expires < now)
+                .where(table.c.attempts >= self.max_attempts)
+                .values({"status": "failed", "error": "The job's lease expired too many times.", "error_type": "TimeoutError"}))
+            result_proxy = connection.execute(db.select([table]).where(ids).where(table.c.status.in_(["done", "failed"])))
+            if result_proxy is None:
+                return []
+            jobs = [dict(row) for row in result_proxy.fetchall()]
+            if jobs:
+                connection.execute(db.delete(table).where(table.c.id.in_([job["id"] for job in jobs])))
+        for job in jobs:
+            job["result"] = json.loads(job["result"]) if job["result"] else None
+        return jobs
+
+    def cancel(self, job_ids) -> bool:
+        if not job_ids:
+            return True
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            return connection.execute(db.delete(table).where(table.c.id.in_(list(job_ids)))) is not None
+
+    # Drops jobs nobody collected, e.g. because the bot restarted mid-cycle.
+    def purge(self, max_age=24 * 3600) -> bool:
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            return connection.execute(db.delete(table).where(table.c.created_at < time() - max_age)) is not None
+
+    def get_stats(self) -> dict:
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            result_proxy = connection.execute(db.select([table.c.status, db.func.count()]).group_by(table.c.status))
+            if result_proxy is None:
+                return {}
+            return {row[0]: row[1] for row in result_proxy.fetchall()}
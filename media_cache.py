@@ -0,0 +1,129 @@
+import io
+import os
+import logging
+import hashlib
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+import sqlalchemy as db
+from PIL import Image
+
+import schema
+from database_connection import DatabaseConnection
+
+
+# Maps a screenshot's content hash to the Telegram file_id of its first upload, so the
+# same image sent to every student of a course is uploaded once.
+class MediaCache:
+    image_format = os.getenv("MEDIA_FORMAT", "JPEG").upper()
+    quality = int(os.getenv("MEDIA_QUALITY", 85))
+    max_bytes = int(os.getenv("MEDIA_MAX_BYTES", 512 * 1024))
+    max_side = int(os.getenv("MEDIA_MAX_SIDE", 2560))
+    min_quality = 40
+    memory_size = 10000
+    table = schema.media_file
+
+    def __init__(self):
+        self._file_ids = OrderedDict()
+        self._lock = threading.Lock()
+        self._table_ready = False
+        self.stats = {"hits": 0, "uploads": 0, "bytes_in": 0, "bytes_out": 0}
+
+    # Stats are updated from the dispatcher's loop and from upload and compression threads.
+    def count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+    @staticmethod
+    def content_hash(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _remember(self, key, file_id):
+        with self._lock:
+            self._file_ids[key] = file_id
+            self._file_ids.move_to_end(key)
+            while len(self._file_ids) > self.memory_size:
+                self._file_ids.popitem(last=False)
+
+    def _get_table(self, connection: DatabaseConnection):
+        if not self._table_ready:
+            self._table_ready = connection.create_table(self.table)
+        return self.table
+
+    def peek(self, key):
+        with self._lock:
+            return self._file_ids.get(key)
+
+    def get_file_id(self, key):
+        file_id = self.peek(key)
+        if file_id is not None:
+            return file_id
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            result_proxy = connection.execute(db.select([table.c.file_id]).where(table.c.hash == key))
+            if result_proxy is None:
+                return None
+            row = result_proxy.fetchone()
+        if row is None:
+            return None
+        self._remember(key, row["file_id"])
+        return row["file_id"]
+
+    def save_file_id(self, key, file_id, size=None) -> bool:
+        self._remember(key, file_id)
+        self.count("uploads")
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            return connection.upsert(table, [{"hash": key, "file_id": file_id, "size": size, "created_at": datetime.utcnow()}],
+                                     ["file_id", "size", "created_at"])
+
+    # For file_ids Telegram no longer accepts.
+    def forget(self, key) -> bool:
+        with self._lock:
+            self._file_ids.pop(key, None)
+        with DatabaseConnection() as connection:
+            table = self._get_table(connection)
+            return connection.execute(db.delete(table).where(table.c.hash == key)) is not None
+
+    # Re-encodes a PNG screenshot, lowering the quality until it fits in max_bytes.
+    def compress(self, data: bytes) -> bytes:
+        with Image.open(io.BytesIO(data)) as image:
+            image = image.convert("RGB")
+            image.thumbnail((self.max_side, self.max_side))
+            quality = self.quality
+            while True:
+                output = io.BytesIO()
+                image.save(output, self.image_format, quality=quality, optimize=True)
+                if output.tell() <= self.max_bytes or quality <= self.min_quality:
+                    break
+                quality -= 10
+        compressed = output.getvalue()
+        # Text-heavy screenshots sometimes compress better as PNG.
+        if len(compressed) >= len(data):
+            compressed = data
+        self.count("bytes_in", len(data))
+        self.count("bytes_out", len(compressed))
+        return compressed
+
+    # Returns (key, media): media is a cached file_id, or the compressed bytes to upload.
+    def resolve(self, path) -> tuple:
+        with open(path, "rb") as f:
+            data = f.read()
+        key = self.content_hash(data)
+        try:
+            file_id = self.get_file_id(key)
+        except Exception as e:
+            logging.error(e)
+            file_id = None
+        if file_id is not None:
+            return key, file_id
+        try:
+            return key, self.compress(data)
+        except Exception as e:
+            logging.error(e)
+            return key, data
@@ -0,0 +1,269 @@
+import os
+import logging
+import threading
+from time import time, perf_counter
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# The value at the q-th percentile (0-100) of values, 0 if there are none.
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def _label_text(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(key)} {value}")
+        return lines
+
+
+class Histogram:
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name, help, buckets=None):
+        self.name = name
+        self.help = help
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    # Times the block, whether it returns or raises.
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    # (count, sum) over every label set.
+    def summary(self):
+        with self._lock:
+            return (sum(counts[-2] for counts in self._values.values()),
+                    sum(counts[-1] for counts in self._values.values()))
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_label_text(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_label_text(key + (('le', '+Inf'),))} {counts[-2]}")
+                lines.append(f"{self.name}_count{_label_text(key)} {counts[-2]}")
+                lines.append(f"{self.name}_sum{_label_text(key)} {counts[-1]:.6f}")
+        return lines
+
+
+class Registry:
+    host = os.getenv("METRICS_HOST", "127.0.0.1")
+    port = int(os.getenv("METRICS_PORT", 9464))
+
+    def __init__(self):
+        self._metrics = []
+        self._server = None
+
+    def counter(self, name, help) -> Counter:
+        metric = Counter(name, help)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=None) -> Histogram:
+        metric = Histogram(name, help, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+    # Serves render() at /metrics in the Prometheus text format. A port of 0 disables it.
+    def serve(self, host=None, port=None):
+        host = host or self.host
+        port = self.port if port is None else port
+        if self._server is not None or not port:
+            return
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            logging.error(f"Metrics endpoint not started on {host}:{port}: {e}")
+            return
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+
+# What each scrape cycle spent its time on, for /admin stats. Course timings are only
+# recorded where the scrapes run, so they are empty on a bot with SCRAPE_REMOTE=1.
+class CycleLog:
+    size = int(os.getenv("METRICS_CYCLES", 10))
+
+    def __init__(self, size=None):
+        if size is not None:
+            self.size = size
+        self._cycles = deque(maxlen=self.size)
+        self._current = None
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self._current = {"started": time(), "users": {}, "errors": {}, "courses": {}}
+            # The phase histograms count since start; each cycle keeps what was added during it.
+            self._phases = {histogram.name: histogram.summary() for histogram in phases}
+
+    def user(self, chat_id, seconds, error=None):
+        with self._lock:
+            if self._current is None:
+                return
+            self._current["users"][chat_id] = self._current["users"].get(chat_id, 0) + seconds
+            if error is not None:
+                self._current["errors"][chat_id] = type(error).__name__
+
+    # A course checked by several users keeps its slowest time.
+    def course(self, url, seconds):
+        with self._lock:
+            if self._current is None:
+                return
+            self._current["courses"][url] = max(seconds, self._current["courses"].get(url, 0))
+
+    def end(self, **extra):
+        with self._lock:
+            if self._current is None:
+                return
+            self._current["duration"] = time() - self._current["started"]
+            self._current["phases"] = {}
+            for histogram in phases:
+                count, total = histogram.summary()
+                start_count, start_total = self._phases.get(histogram.name, (0, 0))
+                self._current["phases"][histogram.name] = (count - start_count, total - start_total)
+            self._current.update(extra)
+            self._cycles.append(self._current)
+            self._current = None
+
+    def last(self, n=None) -> list:
+        with self._lock:
+            cycles = list(self._cycles)
+        return cycles[-n:] if n else cycles
+
+    def summary(self, n=None, top=5) -> str:
+        cycles = self.last(n)
+        if not cycles:
+            return "No finished cycles yet."
+        lines = [f"Last {len(cycles)} cycles:"]
+        for cycle in cycles:
+            users = len(cycle["users"])
+            rate = len(cycle["errors"]) / users * 100 if users else 0
+            lines.append(f"{cycle['duration']:.0f}s, {users} users, {len(cycle['errors'])} errors ({rate:.0f}%)")
+
+        durations = {}
+        courses = {}
+        errors = {}
+        phase_totals = {}
+        for cycle in cycles:
+            for name, (count, total) in cycle.get("phases", {}).items():
+                phase_count, phase_total = phase_totals.get(name, (0, 0))
+                phase_totals[name] = (phase_count + count, phase_total + total)
+            for chat_id, seconds in cycle["users"].items():
+                durations.setdefault(chat_id, []).append(seconds)
+            for url, seconds in cycle["courses"].items():
+                courses[url] = max(seconds, courses.get(url, 0))
+            for error in cycle["errors"].values():
+                errors[error] = errors.get(error, 0) + 1
+        averages = sorted(((sum(values) / len(values), chat_id) for chat_id, values in durations.items()), reverse=True)
+        if averages:
+            values = sorted(seconds for seconds, _ in averages)
+            lines += ["", f"Per user: median {values[len(values) // 2]:.1f}s, max {values[-1]:.1f}s"]
+            lines += [f"{chat_id}: {seconds:.1f}s" for seconds, chat_id in averages[:top]]
+        if courses:
+            lines += ["", "Slowest courses:"]
+            lines += [f"{seconds:.1f}s {url}" for url, seconds in sorted(courses.items(), key=lambda item: -item[1])[:top]]
+        if errors:
+            lines += ["", "Errors: " + ", ".join(f"{name} {count}" for name, count in sorted(errors.items(), key=lambda item: -item[1]))]
+
+        lines += ["", "Time per phase over these cycles (count, mean):"]
+        for histogram in phases:
+            count, total = phase_totals.get(histogram.name, (0, 0))
+            if count:
+                lines.append(f"{histogram.name}: {count}, {total / count * 1000:.0f}ms")
+        return "\n".join(lines)
+
+
+registry = Registry()
+cycle_log = CycleLog()
+
+browser_start = registry.histogram("elearn_browser_start_seconds", "Time to launch a browser.")
+sso_login = registry.histogram("elearn_sso_login_seconds", "Time of a Microsoft SSO login.")
+course_list = registry.histogram("elearn_course_list_seconds", "Time to fetch a user's course list.")
+course_parse = registry.histogram("elearn_course_seconds", "Time to load, parse and diff one course.")
+screenshot_capture = registry.histogram("elearn_screenshot_seconds", "Time to capture a course's screenshots.")
+diff_load = registry.histogram("elearn_diff_load_seconds", "Time to load a user's hashes.")
+diff_flush = registry.histogram("elearn_diff_flush_seconds", "Time to save a user's hashes and notifications.")
+telegram_send = registry.histogram("telegram_send_seconds", "Time of one Bot API call.")
+phases = [browser_start, sso_login, course_list, course_parse, screenshot_capture, diff_load, diff_flush, telegram_send]
+
+scrapes = registry.counter("elearn_scrapes_total", "Scrapes by result.")
+logins = registry.counter("elearn_sso_logins_total", "SSO logins by result.")
+courses_checked = registry.counter("elearn_courses_checked_total", "Courses checked, by whether they changed or could not be loaded.")
+telegram_messages = registry.counter("telegram_messages_total", "Bot API calls by method and result.")
+cycles = registry.counter("elearn_cycles_total", "Finished scrape cycles.")
@@ -0,0 +1,55 @@
+import sys
+import argparse
+import logging
+
+import sqlalchemy as db
+
+import schema
+from database_connection import make_engine, upsert_query
+
+
+def copy_table(source, target, table, batch_size):
+    copied = 0
+    order_by = list(table.primary_key.columns)
+    update_columns = [column.name for column in table.columns if not column.primary_key]
+    with source.connect() as source_connection, target.connect() as target_connection:
+        offset = 0
+        while True:
+            query = db.select([table]).order_by(*order_by).limit(batch_size).offset(offset)
+            rows = [dict(row) for row in source_connection.execute(query).fetchall()]
+            if not rows:
+                break
+            with target_connection.begin():
+                target_connection.execute(upsert_query(target.dialect.name, table, rows, update_columns))
+            copied += len(rows)
+            offset += batch_size
+            print(f"{table.name}: {copied} rows", end="\r")
+    print(f"{table.name}: {copied} rows")
+    return copied
+
+
+def migrate(source_backend, target_backend, tables=None, batch_size=1000):
+    source = make_engine(source_backend)
+    target = make_engine(target_backend)
+    schema.metadata.create_all(target)
+    for table in schema.metadata.sorted_tables:
+        if tables and table.name not in tables:
+            continue
+        copy_table(source, target, table, batch_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy the bot's tables between MySQL and SQLite.")
+    parser.add_argument("source", choices=["mysql", "sqlite"])
+    parser.add_argument("target", choices=["mysql", "sqlite"])
+    parser.add_argument("--table", action="append", help="only copy this table (repeatable)")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error("source and target must differ")
+    try:
+        migrate(args.source, args.target, args.table, args.batch_size)
+    except Exception as e:
+        print(e)
+        logging.error(e)
+        sys.exit(1)
@@ -0,0 +1,369 @@
+import json
+import argparse
+import threading
+from time import perf_counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+
+# A stand-in for learn.ejust.org that serves synthetic pages with the DOM structure
+# the scrapper XPaths expect, so backends can be exercised and benchmarked offline.
+# The "Microsoft" button on its login page leads to a fake SSO flow under /sso/ that
+# sets the session cookie; with `password` set, any other password is rejected.
+# Cookies "<session_id>.<name>" are sessions of other users, with their own completion marks.
+class MoodleFixture:
+    session_cookie = "MoodleSession"
+    sesskey = "fixturesesskey"
+    ws_token = "0123456789abcdef0123456789abcdef"
+    ws_user_id = 2
+
+    def __init__(self, courses=6, sections=10, activities=6, host="127.0.0.1", port=0, session_id="fixture-session",
+                 password=None):
+        self.courses = courses
+        self.sections = sections
+        self.activities = activities
+        self.session_id = session_id
+        self.password = password
+        self.logins = 0
+        self.revisions = {}
+        self.done = set()
+        self.user_done = {}
+        self.restricted = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def origin(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def base_url(self):
+        return f"{self.origin}/first23/"
+
+    @property
+    def courses_url(self):
+        return f"{self.base_url}my/courses.php"
+
+    def course_url(self, course_id):
+        return f"{self.base_url}course/view.php?id={course_id}"
+
+    def module_id(self, course_id, section, activity):
+        return (course_id * self.sections + section) * self.activities + activity + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Simulates a lecturer editing an activity.
+    def touch(self, course_id, section, activity):
+        key = (course_id, section, activity)
+        with self._lock:
+            self.revisions[key] = self.revisions.get(key, 0) + 1
+
+    # Marks the activity done for every user, or only in the `session` cookie's session.
+    def mark_done(self, course_id, section, activity, session=None):
+        with self._lock:
+            if session is None:
+                self.done.add((course_id, section, activity))
+            else:
+                self.user_done.setdefault(session, set()).add((course_id, section, activity))
+
+    # Restricts a section to the given sessions, like a group condition; the web service sees it restricted.
+    def restrict(self, course_id, section, sessions=()):
+        with self._lock:
+            self.restricted[(course_id, section)] = set(sessions)
+
+    def is_available(self, course_id, section, session=None) -> bool:
+        sessions = self.restricted.get((course_id, section))
+        return sessions is None or session in sessions
+
+    def render_courses_page(self):
+        cards = "".join(
+            f'<div class="card dashboard-card"><a href="{self.course_url(i)}"><span class="multiline">Course {i}</span></a></div>'
+            for i in range(1, self.courses + 1))
+        return (f'<html><head><title>My courses</title><script>M.cfg = {{"sesskey":"{self.sesskey}"}};</script></head>'
+                f'<body><div id="page-content"><div data-region="paged-content-page">{cards}</div></div></body></html>')
+
+    def render_activity(self, course_id, section, activity, session=None):
+        key = (course_id, section, activity)
+        module_id = self.module_id(course_id, section, activity)
+        name = f"Lecture {activity + 1} of week {section + 1}"
+        revision = self.revisions.get(key, 0)
+        if revision:
+            name += f" (rev {revision})"
+        if key in self.done or key in self.user_done.get(session, ()):
+            done = f'<button class="btn btn-success" title="{name} is marked as done">Done</button>'
+        else:
+            done = f'<button class="btn btn-outline-secondary" title="Mark {name} as done">Mark as done</button>'
+        return (f'<li class="activity resource modtype_resource" id="module-{module_id}">'
+                f'<div class="activity-item"><div class="activityname">'
+                f'<a href="{self.base_url}mod/resource/view.php?id={module_id}"><span class="instancename">{name}'
+                f'<span class="accesshide"> File</span></span></a></div>'
+                f'<div class="activity-information">{done}</div></div></li>')
+
+    def render_course_page(self, course_id, session=None):
+        sections = []
+        for section in range(self.sections):
+            if self.is_available(course_id, section, session):
+                activities = "".join(self.render_activity(course_id, section, activity, session)
+                                     for activity in range(self.activities))
+                availability = ""
+            else:
+                activities = ""
+                availability = '<div class="availabilityinfo">Not available unless: You belong to a group</div>'
+            sections.append(
+                f'<li id="section-{section}" class="section main">'
+                f'<div class="course-section-header"><h3 class="sectionname">Week {section + 1}</h3></div>'
+                f'{availability}<ul class="section img-text">{activities}</ul></li>')
+        return (f'<html><head><title>Course {course_id}</title><script>M.cfg = {{"sesskey":"{self.sesskey}"}};</script></head>'
+                f'<body><header id="page-header"><h1>Course {course_id}</h1></header>'
+                f'<div id="page-content"><div class="course-content"><ul class="topics">{"".join(sections)}</ul></div></div>'
+                f'</body></html>')
+
+    # Mirrors render_course_page() in the core_course_get_contents format.
+    def ws_course_contents(self, course_id):
+        sections = []
+        for section in range(self.sections):
+            if not self.is_available(course_id, section):
+                sections.append({"id": course_id * self.sections + section, "name": f"Week {section + 1}", "summary": "",
+                                 "uservisible": False, "availabilityinfo": "Not available unless: You belong to a group",
+                                 "modules": []})
+                continue
+            modules = []
+            for activity in range(self.activities):
+                key = (course_id, section, activity)
+                module_id = self.module_id(course_id, section, activity)
+                name = f"Lecture {activity + 1} of week {section + 1}"
+                revision = self.revisions.get(key, 0)
+                if revision:
+                    name += f" (rev {revision})"
+                modules.append({
+                    "id": module_id,
+                    "name": name,
+                    "modname": "resource",
+                    "url": f"{self.base_url}mod/resource/view.php?id={module_id}",
+                    "uservisible": True,
+                    "completiondata": {"state": 1 if key in self.done else 0},
+                    "contents": [{"type": "file", "filename": f"lecture{activity + 1}.pdf", "timemodified": 1700000000 + revision}],
+                })
+            sections.append({"id": course_id * self.sections + section, "name": f"Week {section + 1}", "summary": "", "modules": modules})
+        return sections
+
+    def ws_call(self, function, params):
+        if params.get("wstoken") != self.ws_token:
+            return {"exception": "moodle_exception", "errorcode": "invalidtoken", "message": "Invalid token - token not found"}
+        if function == "core_webservice_get_site_info":
+            return {"sitename": "Fixture", "userid": self.ws_user_id}
+        if function == "core_enrol_get_users_courses":
+            return [{"id": i, "shortname": f"C{i}", "fullname": f"Course {i}"} for i in range(1, self.courses + 1)]
+        if function == "core_course_get_contents":
+            course_id = int(params.get("courseid", 0))
+            if not 1 <= course_id <= self.courses:
+                return {"exception": "dml_missing_record_exception", "errorcode": "invalidrecord", "message": "Course not found"}
+            with self._lock:
+                return self.ws_course_contents(course_id)
+        return {"exception": "dml_missing_record_exception", "errorcode": "invalidrecord", "message": f"Unknown function {function}"}
+
+    def render_login_page(self):
+        return ('<html><head><title>Log in</title></head><body><div id="page-content">'
+                f'<a href="{self.origin}/sso/login" class="btn">Microsoft</a></div></body></html>')
+
+    # The three Microsoft pages the Selenium login goes through.
+    def render_sso_email_page(self):
+        return ('<html><head><title>Sign in to your account</title></head><body>'
+                '<form method="post" action="/sso/email"><div>Sign in</div>'
+                '<input type="email" name="loginfmt" placeholder="Email or phone">'
+                '<input type="submit" value="Next"></form></body></html>')
+
+    def render_sso_password_page(self, email, error=""):
+        error = f'<div id="passwordError">{error}</div>' if error else ""
+        return ('<html><head><title>Sign in to your account</title></head><body>'
+                f'<form method="post" action="/sso/password"><div>{email}</div>{error}'
+                f'<input type="hidden" name="loginfmt" value="{email}">'
+                '<input type="password" name="passwd" placeholder="Password">'
+                '<input type="submit" value="Sign in"></form></body></html>')
+
+    def render_sso_stay_signed_in_page(self):
+        return ('<html><head><title>Sign in to your account</title></head><body>'
+                '<form method="post" action="/sso/kmsi"><div>Stay signed in?</div>'
+                '<input type="submit" name="answer" value="No"><input type="submit" name="answer" value="Yes">'
+                '</form></body></html>')
+
+    def check_password(self, password) -> bool:
+        if self.password is None:
+            return bool(password)
+        return password == self.password
+
+    def _handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body="", content_type="text/html; charset=utf-8", headers=None):
+                body = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _session(self):
+                cookie = SimpleCookie(self.headers.get("Cookie", ""))
+                morsel = cookie.get(fixture.session_cookie)
+                if morsel is None:
+                    return None
+                if morsel.value == fixture.session_id or morsel.value.startswith(f"{fixture.session_id}."):
+                    return morsel.value
+                return None
+
+            def do_GET(self):
+                with fixture._lock:
+                    fixture.requests += 1
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == "/robots.txt":
+                    return self._send(200, "User-agent: *\n", "text/plain")
+                if url.path == "/first23/login/index.php":
+                    return self._send(200, fixture.render_login_page())
+                if url.path == "/sso/login":
+                    return self._send(200, fixture.render_sso_email_page())
+                if url.path.startswith("/first23/") and self._session() is None:
+                    return self._send(303, headers={"Location": f"{fixture.base_url}login/index.php"})
+                if url.path == "/first23/my/courses.php":
+                    return self._send(200, fixture.render_courses_page())
+                if url.path == "/first23/course/view.php":
+                    try:
+                        course_id = int(query["id"][0])
+                    except (KeyError, ValueError):
+                        return self._send(400, "Missing course id")
+                    if not 1 <= course_id <= fixture.courses:
+                        return self._send(404, "Course not found")
+                    with fixture._lock:
+                        page = fixture.render_course_page(course_id, self._session())
+                    return self._send(200, page)
+                return self._send(404, "Not found")
+
+            def do_POST(self):
+                with fixture._lock:
+                    fixture.requests += 1
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                params = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode("utf-8")).items()}
+                params.update({key: values[0] for key, values in parse_qs(url.query).items()})
+                if url.path == "/first23/webservice/rest/server.php":
+                    result = fixture.ws_call(params.get("wsfunction"), params)
+                    return self._send(200, json.dumps(result), "application/json")
+                if url.path == "/sso/email":
+                    return self._send(200, fixture.render_sso_password_page(params.get("loginfmt", "")))
+                if url.path == "/sso/password":
+                    if not fixture.check_password(params.get("passwd")):
+                        return self._send(200, fixture.render_sso_password_page(
+                            params.get("loginfmt", ""), "Your account or password is incorrect."))
+                    return self._send(200, fixture.render_sso_stay_signed_in_page())
+                if url.path == "/sso/kmsi":
+                    with fixture._lock:
+                        fixture.logins += 1
+                    return self._send(303, headers={
+                        "Location": fixture.courses_url,
+                        "Set-Cookie": f"{fixture.session_cookie}={fixture.session_id}; Path=/"})
+                return self._send(404, "Not found")
+
+        return Handler
+
+
+def benchmark_parser(courses, sections, activities, rounds):
+    from scrapper_backends import parse_courses_page, parse_course_page
+
+    with MoodleFixture(courses, sections, activities) as fixture:
+        session = requests.Session()
+        session.cookies.set(fixture.session_cookie, fixture.session_id)
+        fetch_time = 0
+        parse_time = 0
+        parsed = 0
+        for _ in range(rounds):
+            start = perf_counter()
+            response = session.get(fixture.courses_url)
+            fetch_time += perf_counter() - start
+            start = perf_counter()
+            urls = parse_courses_page(response.content, response.url)
+            parse_time += perf_counter() - start
+            for url in urls:
+                start = perf_counter()
+                response = session.get(url)
+                fetch_time += perf_counter() - start
+                start = perf_counter()
+                course = parse_course_page(response.content, url)
+                parse_time += perf_counter() - start
+                parsed += sum(len(section["activities"]) for section in course["sections"])
+        pages = rounds * (courses + 1)
+        print(f"{pages} pages, {parsed} activities")
+        print(f"fetch: {fetch_time * 1000 / pages:.2f} ms/page")
+        print(f"parse: {parse_time * 1000 / pages:.2f} ms/page")
+
+
+def benchmark_web_service(courses, sections, activities, rounds):
+    with MoodleFixture(courses, sections, activities) as fixture:
+        session = requests.Session()
+        server_url = f"{fixture.base_url}webservice/rest/server.php"
+
+        def call(function, **params):
+            data = {"wstoken": fixture.ws_token, "wsfunction": function, "moodlewsrestformat": "json"}
+            data.update(params)
+            return session.post(server_url, data=data).json()
+
+        start = perf_counter()
+        calls = 0
+        for _ in range(rounds):
+            for course in call("core_enrol_get_users_courses", userid=fixture.ws_user_id):
+                call("core_course_get_contents", courseid=course["id"])
+                calls += 1
+            calls += 1
+        duration = perf_counter() - start
+        print(f"{calls} web service calls")
+        print(f"web service: {duration * 1000 / calls:.2f} ms/call, {rounds * courses * 60 / duration:.0f} courses/min")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve or benchmark a synthetic Moodle site.")
+    parser.add_argument("--courses", type=int, default=6)
+    parser.add_argument("--sections", type=int, default=10)
+    parser.add_argument("--activities", type=int, default=6)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--serve", action="store_true", help="serve the fixture until interrupted")
+    parser.add_argument("--ws", action="store_true", help="benchmark the web service API instead of the HTML pages")
+    args = parser.parse_args()
+    if args.serve:
+        fixture = MoodleFixture(args.courses, args.sections, args.activities, port=args.port)
+        print(f"Serving {fixture.courses_url} with session cookie {fixture.session_cookie}={fixture.session_id} and web service token {fixture.ws_token}")
+        print(f"Point the scrapper at it with ELEARN_URL={fixture.courses_url}")
+        try:
+            fixture.server.serve_forever()
+        except KeyboardInterrupt:
+            fixture.server.server_close()
+    elif args.ws:
+        benchmark_web_service(args.courses, args.sections, args.activities, args.rounds)
+    else:
+        benchmark_parser(args.courses, args.sections, args.activities, args.rounds)
@@ -0,0 +1,88 @@
+import os
+from pathlib import Path
+
+# Bot API limits.
+MEDIA_GROUP_SIZE = 10
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+
+def first_line(text: str) -> str:
+    for line in text.splitlines():
+        if line.strip():
+            return line.strip()
+    return ""
+
+
+def truncate(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    return text[:limit - 1] + "…"
+
+
+# Splits on line boundaries; a single line longer than the limit is cut.
+def split_text(text: str, limit=MESSAGE_LIMIT) -> list:
+    chunks = []
+    chunk = ""
+    for line in text.splitlines():
+        line = truncate(line, limit)
+        if chunk and len(chunk) + len(line) + 1 > limit:
+            chunks.append(chunk)
+            chunk = ""
+        chunk = f"{chunk}\n{line}" if chunk else line
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def caption(section_name: str, activity: dict) -> str:
+    return truncate(f"{section_name}\n{first_line(activity['text'])}", CAPTION_LIMIT)
+
+
+# Turns one changed course into a summary message plus media groups of its screenshots,
+# instead of a text and a photo per activity. Returns (messages, missing_files), where each
+# message is a (dispatcher method, kwargs) pair. Activities whose screenshot is missing are
+# listed in the summary with their links instead.
+def compose_course(course: dict):
+    lines = [f"New content in {course['course_name']}"]
+    photos = []
+    missing = []
+    for section in course["course_sections"]:
+        if len(section["activities"]) == 0:
+            continue
+        lines += ["", section["section_name"]]
+        for activity in section["activities"]:
+            path = activity["screen_shot_path"]
+            if path is not None and os.path.isfile(path):
+                lines.append(f"• {first_line(activity['text'])}")
+                photos.append((Path(path), caption(section["section_name"], activity)))
+                continue
+            if path is not None:
+                missing.append(path)
+            lines.append(f"• {activity['text']}")
+            lines += [f"  {link}" for link in activity["links"]]
+
+    messages = [("send_message", {"text": text}) for text in split_text("\n".join(lines))]
+    for i in range(0, len(photos), MEDIA_GROUP_SIZE):
+        batch = photos[i:i + MEDIA_GROUP_SIZE]
+        if len(batch) == 1:
+            # A media group needs at least two items.
+            messages.append(("send_photo", {"photo": batch[0][0], "caption": batch[0][1]}))
+        else:
+            messages.append(("send_media_group", {"media": batch}))
+    return messages, missing
+
+
+# The files a composed message will upload, as passed to the dispatcher.
+def photo_paths(kwargs) -> list:
+    photos = [kwargs["photo"]] if "photo" in kwargs else [photo for photo, _ in kwargs.get("media", [])]
+    return [str(photo) for photo in photos if isinstance(photo, Path)]
+
+
+# A message whose screenshots are gone by the time it is sent, as text with its captions.
+def as_text(method, kwargs):
+    if method == "send_photo":
+        return "send_message", {"text": kwargs.get("caption") or ""}
+    if method == "send_media_group":
+        return "send_message", {"text": truncate("\n\n".join(caption for _, caption in kwargs["media"]), MESSAGE_LIMIT)}
+    return method, kwargs
@@ -0,0 +1,202 @@
+import os
+import json
+import hashlib
+import logging
+from time import time
+from pathlib import Path
+
+import sqlalchemy as db
+
+import schema
+from database_connection import DatabaseConnection
+from notifications import compose_course, photo_paths
+
+
+# Notifications are queued here by the scrape that found the change, in the transaction that
+# saves its hashes, and sent by the bot's delivery loop. Each chat gets its messages in the
+# order they were queued: a chat is only claimed from its oldest unsent message, and a
+# message that has to be retried holds back the ones after it.
+class Outbox:
+    table = schema.outbox
+    enabled = os.getenv("NOTIFY_OUTBOX", "1") == "1"
+    batch_size = int(os.getenv("OUTBOX_BATCH_SIZE", 200))
+    per_chat = int(os.getenv("OUTBOX_PER_CHAT", 20))
+    poll_interval = float(os.getenv("OUTBOX_POLL_INTERVAL", 2))
+    lease_time = float(os.getenv("OUTBOX_LEASE_SECONDS", 300))
+    max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+    retention = float(os.getenv("OUTBOX_RETENTION", 7 * 24)) * 3600
+    backoff = 30
+    _table_ready = False
+
+    @classmethod
+    def _get_table(cls, connection: DatabaseConnection):
+        if not cls._table_ready:
+            cls._table_ready = connection.create_table(cls.table)
+        return cls.table
+
+    @staticmethod
+    def encode(kwargs) -> str:
+        kwargs = dict(kwargs)
+        if "photo" in kwargs:
+            kwargs["photo"] = str(kwargs["photo"])
+        if "media" in kwargs:
+            kwargs["media"] = [[str(photo), caption] for photo, caption in kwargs["media"]]
+        return json.dumps(kwargs)
+
+    @staticmethod
+    def decode(payload) -> dict:
+        kwargs = json.loads(payload)
+        if "photo" in kwargs:
+            kwargs["photo"] = Path(kwargs["photo"])
+        if "media" in kwargs:
+            kwargs["media"] = [(Path(photo), caption) for photo, caption in kwargs["media"]]
+        return kwargs
+
+    # One row per message of the course's notification. `base` is the course's hash before
+    # this change, so two scrapes that raced on the same change queue the same keys, while
+    # content that changes back later is still reported.
+    @classmethod
+    def rows(cls, chat_id, course, base=None) -> list:
+        messages, missing = compose_course(course)
+        for path in missing:
+            logging.error(f"FileNotFoundError: {path}")
+        digest = hashlib.sha256(json.dumps(course, sort_keys=True, default=str).encode()).hexdigest()
+        now = time()
+        return [{
+            "idempotency_key": hashlib.sha256(f"{chat_id}:{base}:{digest}:{i}".encode()).hexdigest(),
+            "chat_id": chat_id, "method": method, "payload": cls.encode(kwargs),
+            "status": "pending", "attempts": 0, "available_at": now, "created_at": now,
+        } for i, (method, kwargs) in enumerate(messages)]
+
+    # Inserts for execute_in_transaction(); rows whose key is already queued are skipped.
+    @classmethod
+    def statements(cls, connection: DatabaseConnection, rows) -> list:
+        return connection.upsert_statements(cls._get_table(connection), rows, [])
+
+    @staticmethod
+    def _claimable(table, now):
+        return db.or_(db.and_(table.c.status == "pending", table.c.available_at <= now),
+                      db.and_(table.c.status == "sending", table.c.lease_expires < now))
+
+    # Returns chat_id -> rows to send now, oldest first. Chats in `exclude` are still being
+    # sent by this process and are left alone. Like JobQueue.claim(), SKIP LOCKED keeps
+    # concurrent delivery processes off each other's rows on MySQL, and every UPDATE
+    # re-checks that its row is still claimable; only the rows it matched are returned.
+    @classmethod
+    def claim(cls, limit=None, exclude=()) -> dict:
+        now = time()
+        chats = {}
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            try:
+                with connection.transaction():
+                    query = db.select([table]).where(cls._claimable(table, now))
+                    if exclude:
+                        query = query.where(table.c.chat_id.notin_(list(exclude)))
+                    query = query.order_by(table.c.id).limit(limit or cls.batch_size).with_for_update(skip_locked=True)
+                    result_proxy = connection.execute(query)
+                    if result_proxy is None:
+                        raise Exception("Could not read the outbox")
+                    rows = [dict(row) for row in result_proxy.fetchall()]
+                    if not rows:
+                        return {}
+                    # A chat whose oldest unsent message is waiting for a retry or still being sent is skipped.
+                    result_proxy = connection.execute(
+                        db.select([table.c.chat_id, db.func.min(table.c.id)])
+                        .where(table.c.status.in_(["pending", "sending"]))
+                        .where(table.c.chat_id.in_({row["chat_id"] for row in rows})).group_by(table.c.chat_id))
+                    if result_proxy is None:
+                        raise Exception("Could not read the outbox")
+                    heads = {row[0]: row[1] for row in result_proxy.fetchall()}
+                    stopped = set()
+                    for row in rows:
+                        chat_id = row["chat_id"]
+                        messages = chats.get(chat_id)
+                        if chat_id in stopped or (messages is None and heads.get(chat_id) != row["id"]):
+                            continue
+                        if messages is not None and len(messages) >= cls.per_chat:
+                            continue
+                        query = (db.update(table).where(table.c.id == row["id"]).where(cls._claimable(table, now))
+                                 .values({"status": "sending", "lease_expires": now + cls.lease_time,
+                                          "attempts": row["attempts"] + 1}))
+                        result = connection.execute(query)
+                        if result is None or result.rowcount != 1:
+                            # Taken by another process; the chat's later rows wait behind it.
+                            stopped.add(chat_id)
+                            continue
+                        row["attempts"] += 1
+                        chats.setdefault(chat_id, []).append(row)
+            except Exception as e:
+                logging.error(e)
+                return {}
+        return chats
+
+    # Rows leave "sending" only once, so a row whose lease ran out and was claimed again is not
+    # put back or marked twice.
+    @classmethod
+    def _update(cls, ids, values) -> bool:
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            query = db.update(table).where(table.c.id.in_(list(ids))).where(table.c.status == "sending").values(values)
+            return connection.execute(query) is not None
+
+    # Extends the lease of rows still being sent, like JobQueue.heartbeat().
+    @classmethod
+    def renew(cls, ids) -> bool:
+        if not ids:
+            return True
+        return cls._update(ids, {"lease_expires": time() + cls.lease_time})
+
+    @classmethod
+    def sent(cls, row_id) -> bool:
+        return cls._update([row_id], {"status": "sent", "lease_expires": None, "error": None})
+
+    @classmethod
+    def failed(cls, row_id, error) -> bool:
+        return cls._update([row_id], {"status": "failed", "lease_expires": None, "error": str(error)})
+
+    @classmethod
+    def retry(cls, row, error) -> bool:
+        if row["attempts"] >= cls.max_attempts:
+            return cls.failed(row["id"], error)
+        return cls._update([row["id"]], {"status": "pending", "lease_expires": None, "error": str(error),
+                                         "available_at": time() + cls.backoff * 2 ** (row["attempts"] - 1)})
+
+    # Gives back claimed rows that were not attempted.
+    @classmethod
+    def release(cls, rows) -> bool:
+        if not rows:
+            return True
+        table = cls.table
+        return cls._update([row["id"] for row in rows],
+                           {"status": "pending", "lease_expires": None, "attempts": table.c.attempts - 1})
+
+    # Sent and failed rows are kept for `retention`, so their keys still catch late duplicates.
+    @classmethod
+    def purge(cls) -> bool:
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            query = (db.delete(table).where(table.c.status.in_(["sent", "failed"]))
+                     .where(table.c.created_at < time() - cls.retention))
+            return connection.execute(query) is not None
+
+    # Screenshots of unsent messages, kept by the screenshot store's sweeper.
+    @classmethod
+    def pending_paths(cls) -> list:
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            query = (db.select([table.c.payload]).where(table.c.status.in_(["pending", "sending"]))
+                     .where(table.c.method != "send_message"))
+            result_proxy = connection.execute(query)
+            if result_proxy is None:
+                raise Exception("Could not read the outbox")
+            return [path for row in result_proxy.fetchall() for path in photo_paths(cls.decode(row["payload"]))]
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            result_proxy = connection.execute(db.select([table.c.status, db.func.count()]).group_by(table.c.status))
+            if result_proxy is None:
+                return {}
+            return {row[0]: row[1] for row in result_proxy.fetchall()}
@@ -0,0 +1,124 @@
+import os
+import io
+import pstats
+import cProfile
+import logging
+import threading
+from datetime import datetime
+
+# Where the time of a profiled function goes, by the file it is defined in. Built-ins are
+# matched by name: socket reads under WebDriver calls are the waits on geckodriver.
+_categories = [
+    ("webdriver", ["selenium", "webdriver_manager"]),
+    ("database", ["sqlalchemy", "pymysql", "sqlite3", "aiomysql", "aiosqlite"]),
+    ("network", ["urllib", "requests", "httpx", "httpcore", "socket", "ssl", "http/client", "http.client"]),
+    ("sleep", ["time.sleep"]),
+    ("parsing", ["lxml"]),
+    ("screenshots", ["PIL"]),
+]
+_repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def category(filename, function):
+    text = f"{filename}:{function}"
+    for name, needles in _categories:
+        if any(needle in text for needle in needles):
+            return name
+    if filename.startswith(_repo_dir) and "site-packages" not in filename:
+        return "bot code"
+    return "other"
+
+
+# Profiles scrape work with cProfile. cProfile only sees the thread it runs in, so every
+# job of a profiled cycle gets its own profiler and their stats are merged at the end.
+class ScrapeProfiler:
+    directory = "./logs/profiles"
+    # Profile every cycle, not only the ones asked for with /admin profile.
+    every_cycle = os.getenv("PROFILE_CYCLES", "0") == "1"
+    top = int(os.getenv("PROFILE_TOP", 20))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requested = False
+        self._active = False
+        self._stats = None
+
+    def request(self):
+        self._requested = True
+
+    def begin_cycle(self) -> bool:
+        with self._lock:
+            self._active = self.every_cycle or self._requested
+            self._requested = False
+            self._stats = None
+        return self._active
+
+    # Runs fn, under a profiler while a profiled cycle is going.
+    def call(self, fn, *args):
+        if not self._active:
+            return fn(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fn, *args)
+        finally:
+            self._add(profile)
+
+    def _add(self, profile):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    # Returns (path, report) of the cycle's profile, or None if it was not profiled.
+    def end_cycle(self, name="cycle"):
+        with self._lock:
+            stats, self._stats = self._stats, None
+            self._active = False
+        if stats is None:
+            return None
+        return self.save(stats, name), self.report(stats)
+
+    def profile(self, name, fn, *args):
+        profile = cProfile.Profile()
+        try:
+            result = profile.runcall(fn, *args)
+        finally:
+            stats = pstats.Stats(profile)
+        return result, self.save(stats, name), self.report(stats)
+
+    # The .pstats file opens with `python -m pstats`, snakeviz or flameprof for a flame graph.
+    def save(self, stats: pstats.Stats, name):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{datetime.now():%Y%m%d-%H%M%S}-{name}.pstats")
+        stats.dump_stats(path)
+        logging.info(f"Saved profile to {path}")
+        return path
+
+    def report(self, stats: pstats.Stats, top=None) -> str:
+        top = top or self.top
+        totals = {}
+        functions = []
+        for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+            name = category(filename, function)
+            totals[name] = totals.get(name, 0) + own
+            functions.append((own, cumulative, calls, filename, line, function))
+        total = sum(totals.values()) or 1
+        lines = [f"Total {stats.total_tt:.2f}s over {len(stats.stats)} functions", "", "Time by kind:"]
+        lines += [f"{seconds:.2f}s {seconds / total * 100:.0f}% {name}"
+                  for name, seconds in sorted(totals.items(), key=lambda item: -item[1])]
+        lines += ["", f"Top {top} functions by own time (own, cumulative, calls):"]
+        for own, cumulative, calls, filename, line, function in sorted(functions, reverse=True)[:top]:
+            where = os.path.basename(filename) if filename != "~" else ""
+            where = f"{where}:{line} " if where else ""
+            lines.append(f"{own:.2f}s {cumulative:.2f}s {calls} {where}{function}")
+        return "\n".join(lines)
+
+
+profiler = ScrapeProfiler()
+
+
+if __name__ == "__main__":
+    import sys
+    # Prints the report of a saved profile: python profiling.py ./logs/profiles/<file>.pstats [top]
+    print(profiler.report(pstats.Stats(sys.argv[1], stream=io.StringIO()), int(sys.argv[2]) if len(sys.argv) > 2 else None))
@@ -12,10 +12,15 @@ python -m pip install python-dotenv
 python -m pip install python-telegram-bot -U --pre
 python -m pip install sqlalchemy
 python -m pip install pymysql
+python -m pip install aiomysql
+python -m pip install aiosqlite
 
 python -m pip install selenium
 python -m pip install webdriver_manager
 python -m pip install cryptography
+python -m pip install requests
+python -m pip install lxml
+python -m pip install pillow
 echo "Installing required packages... Done"
 
 echo "Please make sure you have installed the following packages:"
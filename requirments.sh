@@ -11,10 +11,15 @@ python3 -m pip install python-dotenv
 python3 -m pip install python-telegram-bot -U --pre
 python3 -m pip install sqlalchemy
 python3 -m pip install pymysql
+python3 -m pip install aiomysql
+python3 -m pip install aiosqlite
 
 python3 -m pip install selenium
 python3 -m pip install webdriver_manager
 python3 -m pip install cryptography
+python3 -m pip install requests
+python3 -m pip install lxml
+python3 -m pip install pillow
 echo "Installing required packages... Done"
 
 echo "Please make sure you have installed the following packages:"
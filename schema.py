@@ -0,0 +1,100 @@
+import sqlalchemy as db
+
+
+# Every table the bot uses, declared once per process so nothing has to be reflected from the database.
+metadata = db.MetaData()
+
+user = db.Table(
+    "user", metadata,
+    db.Column("user_id", db.String(36), primary_key=True),
+    db.Column("email", db.String(255)),
+    db.Column("password", db.LargeBinary),
+    db.Column("active", db.Boolean, nullable=False, default=False),
+    db.Column("chat_id", db.BigInteger, index=True),
+    db.Column("blocked", db.Boolean, nullable=False, default=False),
+)
+
+last_updated = db.Table(
+    "last_updated", metadata,
+    db.Column("id", db.String(64), primary_key=True),
+    db.Column("user_id", db.String(36), primary_key=True),
+    db.Column("hash", db.String(64), nullable=False),
+    db.Column("type", db.String(16)),
+)
+
+user_session = db.Table(
+    "user_session", metadata,
+    db.Column("user_id", db.String(36), primary_key=True),
+    db.Column("cookies", db.LargeBinary, nullable=False),
+    db.Column("updated_at", db.DateTime, nullable=False),
+)
+
+user_token = db.Table(
+    "user_token", metadata,
+    db.Column("user_id", db.String(36), primary_key=True),
+    db.Column("token", db.LargeBinary, nullable=False),
+    db.Column("updated_at", db.DateTime, nullable=False),
+)
+
+# Telegram file_id of an uploaded screenshot, keyed by the sha256 of the original file.
+media_file = db.Table(
+    "media_file", metadata,
+    db.Column("hash", db.String(64), primary_key=True),
+    db.Column("file_id", db.String(255), nullable=False),
+    db.Column("size", db.Integer),
+    db.Column("created_at", db.DateTime, nullable=False),
+)
+
+# Which users are enrolled in which course, for scraping each shared course once.
+course_subscriber = db.Table(
+    "course_subscriber", metadata,
+    db.Column("course_url", db.String(255), primary_key=True),
+    db.Column("user_id", db.String(36), primary_key=True, index=True),
+    db.Column("updated_at", db.DateTime, nullable=False),
+)
+
+# Polling state per course for the adaptive scheduler, times are Unix timestamps.
+course_schedule = db.Table(
+    "course_schedule", metadata,
+    db.Column("course_url", db.String(255), primary_key=True),
+    db.Column("change_gap", db.Float, nullable=False),
+    db.Column("first_seen", db.Float, nullable=False),
+    db.Column("last_checked", db.Float),
+    db.Column("last_changed", db.Float),
+    db.Column("next_due", db.Float, nullable=False),
+)
+
+# Scrape work for worker nodes. A leased job belongs to lease_owner until lease_expires
+# (a Unix timestamp); after that any worker may claim it again.
+scrape_job = db.Table(
+    "scrape_job", metadata,
+    db.Column("id", db.Integer, primary_key=True, autoincrement=True),
+    db.Column("kind", db.String(16), nullable=False),
+    db.Column("user_id", db.String(36), nullable=False),
+    db.Column("payload", db.Text(2 ** 24 - 1)),
+    db.Column("status", db.String(16), nullable=False, index=True),
+    db.Column("lease_owner", db.String(64)),
+    db.Column("lease_expires", db.Float),
+    db.Column("attempts", db.Integer, nullable=False, default=0),
+    db.Column("result", db.Text(2 ** 24 - 1)),
+    db.Column("error", db.Text),
+    db.Column("error_type", db.String(64)),
+    db.Column("created_at", db.Float, nullable=False),
+)
+
+# Notifications waiting to be sent, written in the same transaction as the hashes of the
+# changes they report. idempotency_key keeps a change from being queued twice per chat.
+outbox = db.Table(
+    "outbox", metadata,
+    db.Column("id", db.Integer, primary_key=True, autoincrement=True),
+    db.Column("idempotency_key", db.String(64), nullable=False, unique=True),
+    db.Column("chat_id", db.BigInteger, nullable=False, index=True),
+    db.Column("method", db.String(32), nullable=False),
+    db.Column("payload", db.Text(2 ** 24 - 1), nullable=False),
+    db.Column("status", db.String(16), nullable=False, index=True),
+    db.Column("attempts", db.Integer, nullable=False, default=0),
+    db.Column("available_at", db.Float, nullable=False),
+    db.Column("lease_expires", db.Float),
+    db.Column("error", db.Text),
+    db.Column("created_at", db.Float, nullable=False),
+)
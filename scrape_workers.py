@@ -0,0 +1,455 @@
+import os
+import math
+import asyncio
+import logging
+import threading
+from time import perf_counter
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from users import User
+from database_connection import DatabaseConnection
+from scrapper import ElearnScrapper, LoginError
+from browser_pool import BrowserPool
+from course_index import CourseIndex
+from job_queue import JobQueue
+from outbox import Outbox
+from profiling import profiler
+import metrics
+
+
+# last_updated owner for content diffed once on behalf of every subscriber.
+SHARED_DIFF_OWNER = "shared"
+
+
+def without_done(course_data):
+    sections = []
+    for section in course_data["course_sections"]:
+        activities = [activity for activity in section["activities"] if not activity["done"]]
+        if activities:
+            sections.append(dict(section, activities=activities))
+    if not sections:
+        return None
+    return dict(course_data, course_sections=sections)
+
+
+# Who the scrapper queues a changed course for when notifications go through the outbox.
+# `subscribers` maps course_url to chat ids; without it the course goes to the user alone.
+def outbox_recipients(user: User, subscribers=None):
+    if not Outbox.enabled:
+        return None
+
+    def recipients(course_data):
+        if subscribers is None:
+            chat_ids = [user.get_chat_id()]
+        else:
+            chat_ids = subscribers.get(course_data["course_url"], [])
+        pairs = []
+        for chat_id in chat_ids:
+            course = course_data
+            # Completion marks are the fetcher's own.
+            if subscribers is not None and chat_id == user.get_chat_id():
+                course = without_done(course_data)
+            if chat_id is not None and course is not None and course["course_sections"]:
+                pairs.append((chat_id, course))
+        return pairs
+    return recipients
+
+
+class ScrapeWorkerPool:
+    # Selenium spends its time waiting on geckodriver, so threads are enough here.
+    size = int(os.getenv("SCRAPE_WORKERS", 4))
+    shared_courses = os.getenv("SHARED_COURSES", "0") == "1"
+    # Users being scraped by any pool of this process, so an /admin profile scrape and a
+    # cycle's never diff and notify the same user at once.
+    _busy_users = set()
+    _busy_lock = threading.Lock()
+
+    def __init__(self, size=None, scheduler=None):
+        if size is not None:
+            self.size = size
+        if self.size < 1:
+            raise ValueError("Worker pool size must be at least 1.")
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.size, thread_name_prefix="scrapper")
+        self.browser_pool = BrowserPool(ElearnScrapper.new_browser)
+        self.last_cycle = None
+        self.scheduler = scheduler
+        self._fetchers = set()
+        # Shared courses with restricted sections, checked per subscriber until none of them sees a restriction.
+        self._restricted = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        self.browser_pool.close_all()
+
+    @classmethod
+    def claim_user(cls, user_id) -> bool:
+        with cls._busy_lock:
+            if user_id in cls._busy_users:
+                return False
+            cls._busy_users.add(user_id)
+            return True
+
+    @classmethod
+    def release_user(cls, user_id):
+        with cls._busy_lock:
+            cls._busy_users.discard(user_id)
+
+    # Runs a cycle's job once nothing else is scraping the user.
+    async def _run_claimed(self, kind, user: User, *args):
+        while not self.claim_user(user.get_user_id()):
+            await asyncio.sleep(1)
+        try:
+            return await self.run_job(kind, user, *args)
+        finally:
+            self.release_user(user.get_user_id())
+
+    # With a scheduler, the course list cached in the course index decides whether any of the
+    # user's courses is due before a session is started; users with none due are skipped.
+    def scrape_user(self, user: User, scheduler=None):
+        scheduler = scheduler or self.scheduler
+        with DatabaseConnection.scope():
+            courses_urls = None
+            if scheduler is not None:
+                courses_urls = CourseIndex.user_courses(user.get_user_id())
+                if courses_urls is not None and not any(scheduler.should_check(url) for url in courses_urls):
+                    logging.info(f"No courses due for {user.get_chat_id()}")
+                    return []
+            print(f"Checking for new content for {user.get_chat_id()}")
+            logging.info(f"Checking for new content for {user.get_chat_id()}")
+            scrapper = ElearnScrapper(user, browser_pool=self.browser_pool, courses_urls=courses_urls, scheduler=scheduler,
+                                      recipients=outbox_recipients(user))
+            try:
+                if scheduler is not None and courses_urls is None:
+                    CourseIndex.save_user(user.get_user_id(), scrapper.list_courses())
+                return scrapper.get_all_courses_data()
+            finally:
+                scrapper.close()
+
+    # Runs one unit of scrape work: "user" checks all of a user's courses, "index" lists them
+    # and "courses" checks the given courses, shared with `subscribers` or for the user alone.
+    # RemoteScrapePool runs them on worker nodes.
+    async def run_job(self, kind, user: User, courses_urls=None, subscribers=None):
+        loop = asyncio.get_running_loop()
+        if kind == "user":
+            return await loop.run_in_executor(self._executor, profiler.call, self.scrape_user, user)
+        if kind == "index":
+            return await loop.run_in_executor(self._executor, profiler.call, self.index_user, user)
+        if kind == "courses":
+            return await loop.run_in_executor(self._executor, profiler.call, self.scrape_courses, user, courses_urls, None, subscribers)
+        raise ValueError(f"Unknown job kind: {kind}")
+
+    # Yields (user, changed_courses, error) as soon as each user is done.
+    async def scrape(self, users):
+        start = perf_counter()
+        db_stats = DatabaseConnection.get_stats()
+        metrics.cycle_log.begin()
+        done = 0
+        errors = 0
+
+        async def run(user):
+            job_start = perf_counter()
+            try:
+                result = await self._run_claimed("user", user)
+            except Exception as e:
+                self._record(user, job_start, e)
+                return user, None, e
+            self._record(user, job_start)
+            return user, result, None
+
+        tasks = [asyncio.ensure_future(run(user)) for user in users]
+        try:
+            for task in asyncio.as_completed(tasks):
+                user, result, error = await task
+                done += 1
+                if error is not None:
+                    errors += 1
+                yield user, result, error
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._end_cycle(start, db_stats, done, errors)
+
+    def _record(self, user: User, start, error=None):
+        metrics.cycle_log.user(user.get_chat_id(), perf_counter() - start, error)
+        metrics.scrapes.inc(result="ok" if error is None else "login_error" if isinstance(error, LoginError) else "error")
+
+    def _end_cycle(self, start, db_stats, done, errors, **extra):
+        duration = perf_counter() - start
+        self.last_cycle = {
+            "users": done,
+            "errors": errors,
+            "duration": duration,
+            "users_per_minute": done * 60 / duration if duration > 0 else 0,
+            "workers": self.size,
+            "db": {key: value - db_stats[key] for key, value in DatabaseConnection.get_stats().items()},
+            **extra,
+        }
+        print(f"Cycle done: {done} users in {duration:.1f}s ({self.last_cycle['users_per_minute']:.1f} users/min, {errors} errors, {self.size} workers)")
+        logging.info(f"Cycle done: {done} users in {duration:.1f}s ({self.last_cycle['users_per_minute']:.1f} users/min, {errors} errors, {self.size} workers)")
+        logging.info(f"Cycle database usage: {self.last_cycle['db']}")
+        metrics.cycles.inc()
+        metrics.cycle_log.end(workers=self.size, **extra)
+
+    def index_user(self, user: User):
+        print(f"Listing courses for {user.get_chat_id()}")
+        logging.info(f"Listing courses for {user.get_chat_id()}")
+        with DatabaseConnection.scope():
+            scrapper = ElearnScrapper(user, browser_pool=self.browser_pool)
+            try:
+                courses_urls = scrapper.list_courses()
+            finally:
+                scrapper.close()
+            CourseIndex.save_user(user.get_user_id(), courses_urls)
+        return courses_urls
+
+    # Checks courses on behalf of all their subscribers, using this user's session. The shared
+    # hashes are always computed by the default backend, so they compare whoever fetches next.
+    # Courses that per-user scrapes have diffed before are recorded silently the first time,
+    # which is what turning on SHARED_COURSES on a running bot does. Without `subscribers` the
+    # courses are diffed for the user alone, as restricted courses are.
+    # Returns (changed_courses, urls of the courses with restricted sections).
+    def scrape_courses(self, user: User, courses_urls, scheduler=None, subscribers=None):
+        shared = subscribers is not None
+        kind = "shared" if shared else "restricted"
+        print(f"Checking {len(courses_urls)} {kind} courses as {user.get_chat_id()}")
+        logging.info(f"Checking {len(courses_urls)} {kind} courses as {user.get_chat_id()}")
+        with DatabaseConnection.scope():
+            scrapper = ElearnScrapper(user, browser_pool=self.browser_pool,
+                                      backend=ElearnScrapper.default_backend if shared else None,
+                                      diff_owner=SHARED_DIFF_OWNER if shared else None, courses_urls=list(courses_urls),
+                                      scheduler=scheduler or self.scheduler, recipients=outbox_recipients(user, subscribers),
+                                      baseline_known=True)
+            # Completion marks are the fetcher's own, they are filtered per user in scrape_shared().
+            scrapper.skip_done = not shared
+            try:
+                return scrapper.get_all_courses_data(), scrapper.restricted_courses
+            finally:
+                scrapper.close()
+
+    # Picks as few users as possible to cover every course, preferring users whose session
+    # worked last cycle, but spreads the courses over at least as many users as there are workers.
+    def assign_fetchers(self, index, excluded=()):
+        remaining = {url: [user_id for user_id in subscribers if user_id not in excluded]
+                     for url, subscribers in index.items()}
+        remaining = {url: subscribers for url, subscribers in remaining.items() if subscribers}
+        per_fetcher = max(1, math.ceil(len(remaining) / self.size))
+        assignments = {}
+        while remaining:
+            counts = Counter(user_id for subscribers in remaining.values() for user_id in subscribers
+                             if user_id not in assignments)
+            if not counts:
+                break
+            user_id = max(counts, key=lambda user_id: (user_id in self._fetchers, counts[user_id]))
+            urls = [url for url, subscribers in remaining.items() if user_id in subscribers][:per_fetcher]
+            assignments[user_id] = urls
+            for url in urls:
+                del remaining[url]
+        return assignments
+
+    # Same output as scrape(), but every course is fetched and diffed once per cycle and its
+    # changes are fanned out to all of its subscribers.
+    async def scrape_shared(self, users):
+        start = perf_counter()
+        db_stats = DatabaseConnection.get_stats()
+        users_by_id = {user.get_user_id(): user for user in users}
+        metrics.cycle_log.begin()
+        done = 0
+        failed = {}
+        changed = {}
+        fetched_by = {}
+        private = {}
+        private_changes = {}
+
+        async def run(kind, user, *args):
+            job_start = perf_counter()
+            try:
+                result = await self._run_claimed(kind, user, *args)
+            except Exception as e:
+                self._record(user, job_start, e)
+                return None, e
+            self._record(user, job_start)
+            return result, None
+
+        try:
+            stale = await asyncio.to_thread(CourseIndex.stale_users, list(users_by_id))
+            results = await asyncio.gather(*[run("index", users_by_id[user_id]) for user_id in stale])
+            for user_id, (_, error) in zip(stale, results):
+                if error is not None:
+                    failed[user_id] = error
+                    done += 1
+                    yield users_by_id[user_id], None, error
+
+            index = await asyncio.to_thread(CourseIndex.load, list(users_by_id))
+            due = [url for url in index if self.scheduler is None or self.scheduler.should_check(url)]
+            pending = {url: index[url] for url in due if url not in self._restricted}
+            restricted = [url for url in due if url in self._restricted]
+            while pending:
+                assignments = self.assign_fetchers(pending, failed)
+                if not assignments:
+                    break
+                results = await asyncio.gather(*[run("courses", users_by_id[user_id], urls, {
+                    url: [users_by_id[subscriber].get_chat_id() for subscriber in index[url]] for url in urls})
+                    for user_id, urls in assignments.items()])
+                for (user_id, urls), (result, error) in zip(assignments.items(), results):
+                    if error is not None:
+                        self._fetchers.discard(user_id)
+                        failed[user_id] = error
+                        done += 1
+                        yield users_by_id[user_id], None, error
+                        continue
+                    self._fetchers.add(user_id)
+                    courses_data, restricted_urls = result
+                    for course_data in courses_data:
+                        changed[course_data["course_url"]] = course_data
+                    for url in urls:
+                        del pending[url]
+                        if url in restricted_urls:
+                            restricted.append(url)
+                        else:
+                            fetched_by[url] = user_id
+            for url in pending:
+                logging.error(f"No subscriber could check {url}")
+
+            # Subscribers of a restricted course may each see different sections, so each of
+            # them checks it against their own hashes.
+            for url in restricted:
+                for user_id in index[url]:
+                    if user_id not in failed:
+                        private.setdefault(user_id, []).append(url)
+            results = await asyncio.gather(*[run("courses", users_by_id[user_id], urls) for user_id, urls in private.items()])
+            checked = set()
+            still_restricted = set()
+            for (user_id, urls), (result, error) in zip(private.items(), results):
+                if error is not None:
+                    failed[user_id] = error
+                    done += 1
+                    yield users_by_id[user_id], None, error
+                    continue
+                courses_data, restricted_urls = result
+                private_changes[user_id] = courses_data
+                checked.update(urls)
+                still_restricted.update(restricted_urls)
+            self._restricted = (self._restricted - checked) | still_restricted
+
+            subscriptions = {}
+            for url, subscribers in index.items():
+                for user_id in subscribers:
+                    subscriptions.setdefault(user_id, []).append(url)
+            for user_id, user in users_by_id.items():
+                # Already yielded with their error.
+                if user_id in failed:
+                    continue
+                courses_data = list(private_changes.get(user_id, []))
+                for url in subscriptions.get(user_id, []):
+                    course_data = changed.get(url)
+                    if course_data is not None and fetched_by[url] == user_id:
+                        course_data = without_done(course_data)
+                    if course_data is not None:
+                        courses_data.append(course_data)
+                done += 1
+                yield user, courses_data, None
+        finally:
+            self._end_cycle(start, db_stats, done, len(failed), shared_courses=len(fetched_by), fetchers=len(set(fetched_by.values())),
+                            private=len(private))
+
+    # Relaunches recycled browsers between cycles so the next one starts warm.
+    async def warm_up(self):
+        loop = asyncio.get_running_loop()
+        try:
+            launched = await loop.run_in_executor(self._executor, self.browser_pool.warm_up)
+        except Exception as e:
+            print(e)
+            logging.error(e)
+            return 0
+        if launched:
+            logging.info(f"Launched {launched} browsers.")
+        return launched
+
+
+# Same interface as ScrapeWorkerPool, but every job goes to the scrape_job table and is run
+# by `python worker.py` on any host; this process only waits for the results.
+class RemoteScrapePool(ScrapeWorkerPool):
+    enabled = os.getenv("SCRAPE_REMOTE", "0") == "1"
+    poll_interval = float(os.getenv("JOB_POLL_INTERVAL", 2))
+    timeout = float(os.getenv("JOB_TIMEOUT", 3600))
+
+    def __init__(self, size=None, scheduler=None):
+        # No executor or browsers here, only the state scrape() and scrape_shared() use.
+        if size is not None:
+            self.size = size
+        self.scheduler = scheduler
+        self.last_cycle = None
+        self._fetchers = set()
+        self._restricted = set()
+        self.queue = JobQueue()
+        self._waiting = {}
+        self._poller = None
+        self.queue.purge()
+
+    def shutdown(self):
+        pass
+
+    async def warm_up(self):
+        return 0
+
+    async def run_job(self, kind, user: User, courses_urls=None, subscribers=None):
+        payload = {"courses_urls": courses_urls, "subscribers": subscribers}
+        # A profiled scrape checks every course, due or not.
+        if self.scheduler is not None and kind != "profile":
+            payload["schedule"] = self.scheduler.snapshot()
+        job_id = await asyncio.to_thread(self.queue.enqueue, kind, user.get_user_id(), payload)
+        if job_id is None:
+            raise Exception("Could not queue the scrape job.")
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[job_id] = future
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll())
+        try:
+            job = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            await asyncio.to_thread(self.queue.cancel, [job_id])
+            raise TimeoutError(f"No worker finished the {kind} job for {user.get_chat_id()} in {self.timeout:.0f}s.")
+        except asyncio.CancelledError:
+            # Shielded, the job is cancelled in the queue even though this task is being cancelled.
+            await asyncio.shield(asyncio.to_thread(self.queue.cancel, [job_id]))
+            raise
+        finally:
+            self._waiting.pop(job_id, None)
+
+        if job["status"] == "failed":
+            if job["error_type"] == "LoginError":
+                raise LoginError(job["error"])
+            raise Exception(f"{job['error_type']}: {job['error']}")
+        result = job["result"]
+        if self.scheduler is not None:
+            for url, changed in result.get("observed", {}).items():
+                self.scheduler.observe(url, changed)
+        if kind == "index":
+            return result["courses_urls"]
+        if kind == "courses":
+            return result["courses"], result.get("restricted", [])
+        if kind == "profile":
+            return result["courses"], result["profile_path"], result["profile"]
+        return result["courses"]
+
+    # One query per poll_interval for every job this process is waiting on.
+    async def _poll(self):
+        while self._waiting:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                jobs = await asyncio.to_thread(self.queue.collect, list(self._waiting))
+            except Exception as e:
+                logging.error(e)
+                continue
+            for job in jobs:
+                future = self._waiting.get(job["id"])
+                if future is not None and not future.done():
+                    future.set_result(job)
@@ -1,7 +1,7 @@
 import os
 import platform
 import shutil
-from time import sleep
+from time import sleep, perf_counter
 import logging
 
 from selenium import webdriver
@@ -9,13 +9,19 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.firefox.service import Service as FirfoxService
 from webdriver_manager.firefox import GeckoDriverManager
 
-import sqlalchemy as db
-from database_connection import DatabaseConnection
+from session_store import SessionStore, TokenStore
+from diff_session import DiffSession
+from outbox import Outbox
+from screenshot_store import screenshot_store
+from scrapper_backends import LoginError, SeleniumBackend, WebServiceBackend, backends
 from users import User
+import metrics
 import hashlib
+from urllib.parse import urljoin, urlparse
 
 
-_elearn_URL = r"https://learn.ejust.org/first23/my/courses.php"
+# ELEARN_URL points the scrapper at another Moodle, e.g. the one in moodle_fixture.py.
+_elearn_URL = os.getenv("ELEARN_URL", r"https://learn.ejust.org/first23/my/courses.php")
 
 
 def geckodriver_path():
@@ -35,54 +41,108 @@ def myhash(text):
     return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
-class LoginError(Exception):
-    def __init__(self, *args, **kwargs):
-        self.message = args[0] if args else None
-        Exception.__init__(self, *args, **kwargs)
-
-
 class ElearnScrapper:
-    valid_types = ["course", "section", "messages", "activity", None]
+    valid_types = ["course", "section", "messages", "activity", "format", None]
     geckodriver_path = geckodriver_path()
-    def __init__(self, user: User):
+    elearn_url = _elearn_URL
+    default_backend = os.getenv("SCRAPPER_BACKEND", SeleniumBackend.name)
+    use_web_service = os.getenv("MOODLE_WS_ENABLED", "1") == "1"
+    # Activities the user marked as done are not reported.
+    skip_done = True
+    # diff_owner: whose last_updated hashes to diff against, the user's by default. Another
+    # owner's hashes are shared by several users, so per-user controls are left out of the text.
+    # courses_urls: courses to check, instead of listing the user's courses page.
+    # scheduler: a CourseScheduler deciding which courses are due this cycle.
+    # baseline_known: record courses new to diff_owner silently if another owner has diffed
+    # them before, their subscribers have already been told about their content.
+    def __init__(self, user: User, browser_pool=None, backend=None, diff_owner=None, courses_urls=None, scheduler=None, recipients=None,
+                 baseline_known=False):
         self.set_user(user)
+        self._browser_pool = browser_pool
+        if backend is None:
+            backend = self.default_backend
+            if self.use_web_service and TokenStore.load(user.get_user_id()):
+                backend = WebServiceBackend.name
+        if backend not in backends:
+            raise ValueError(f"Unknown scrapper backend: {backend}")
+        self.backend = backends[backend](self)
         self.browser = None
+        self._pages_loaded = 0
         self.is_logged_in = False
-        self._courses_urls = None
+        self._courses_urls = courses_urls
+        self._diff_owner = diff_owner or user.get_user_id()
+        self.shared = self._diff_owner != user.get_user_id()
+        self._baseline_known = baseline_known
+        self._known_elsewhere = None
+        self._scheduler = scheduler
+        # Callable returning (chat_id, course_data) pairs to notify of a changed course through the outbox.
+        self._recipients = recipients
+        self._diff = None
+        # Courses with sections gated by availability conditions, shared scrapes leave them unchecked.
+        self.restricted_courses = []
+        # Courses that could not be loaded; the scheduler keeps them due.
+        self.failed_courses = []
 
     def set_user(self, user: User):
         if type(user) is not User:
             raise TypeError("user must be of type User")
-        valid_users = User.get_all_users()
-        if user not in valid_users:
+        if not User.exists(user.get_user_id()):
             raise ValueError("user not found")
         self._user = user
 
-    def _open_browser(self, headless=True):
-        service = FirfoxService(executable_path=self.geckodriver_path)
+    @staticmethod
+    def new_browser(headless=True):
+        service = FirfoxService(executable_path=ElearnScrapper.geckodriver_path)
         options = webdriver.FirefoxOptions()
         options.headless = headless
 
 
-        browser = webdriver.Firefox(service=service, options=options)
+        with metrics.browser_start.time():
+            browser = webdriver.Firefox(service=service, options=options)
         browser.implicitly_wait(2)
         browser.set_window_position(0, 0)
         browser.set_window_size(360, 740)
 
+        return browser
 
-        self.browser = browser
+    def _open_browser(self, headless=True):
+        if self._browser_pool is not None:
+            self.browser = self._browser_pool.acquire()
+        else:
+            self.browser = self.new_browser(headless)
+        self._pages_loaded = 0
 
     def _close_browser(self):
         if self.browser is not None:
-            self.browser.close()
+            if self._browser_pool is not None:
+                self._browser_pool.release(self.browser, self._pages_loaded)
+            else:
+                self.browser.close()
             self.browser = None
+            self.is_logged_in = False
+
+    def _get(self, url):
+        self.browser.get(url)
+        self._pages_loaded += 1
 
     def _login(self):
+        with metrics.sso_login.time():
+            try:
+                self._sso_login()
+            except LoginError:
+                metrics.logins.inc(result="rejected")
+                raise
+            except Exception:
+                metrics.logins.inc(result="error")
+                raise
+        metrics.logins.inc(result="ok")
+
+    def _sso_login(self):
         if self.browser is None:
             self._open_browser()
 
         try:
-            self.browser.get(_elearn_URL)
+            self._get(self.elearn_url)
             self.browser.find_element(
                 By.XPATH, r"//a[normalize-space()='Microsoft']").click()
             sleep(1)
@@ -128,29 +188,64 @@ class ElearnScrapper:
                 raise LoginError("Unknown error")
         else:
             self.is_logged_in = True
+            self._save_session()
+
+    def _save_session(self):
+        try:
+            if urlparse(self.browser.current_url).netloc != urlparse(self.elearn_url).netloc:
+                self._get(self.elearn_url)
+            SessionStore.save(self._user.get_user_id(), self.browser.get_cookies())
+        except Exception as e:
+            print(e)
+            logging.error(e)
+
+    def _restore_session(self):
+        cookies = SessionStore.load(self._user.get_user_id())
+        if not cookies:
+            return False
+        if self.browser is None:
+            self._open_browser()
+        try:
+            # Any cheap page on the elearn origin, cookies can only be set for the current domain.
+            self._get(urljoin(self.elearn_url, "/robots.txt"))
+            for cookie in cookies:
+                self.browser.add_cookie(cookie)
+            self._get(self.elearn_url)
+        except Exception as e:
+            print(e)
+            logging.error(e)
+            return False
+        # Moodle redirects to the login page once the session has expired.
+        if self.browser.current_url.find("login/index.php") != -1:
+            self.browser.delete_all_cookies()
+            SessionStore.delete(self._user.get_user_id())
+            return False
+        self.is_logged_in = True
+        return True
+
+    def _start_session(self):
+        if not self._restore_session():
+            self._login()
 
     def _get_courses_urls(self, force=False):
         if self._courses_urls is not None and not force:
             return self._courses_urls
-        if not self.is_logged_in:
-            self._login()
-        elif self.browser.current_url != _elearn_URL:
-            self.browser.get(_elearn_URL)
-        courses_cards = self.browser.find_elements(
-            By.XPATH, r"//div[contains(@data-region,'paged-content-page')]//a")
 
         courses_urls = []
-        for card in courses_cards:
-            url = card.get_attribute("href")
-            if url.find("course/view.php") != -1 and url not in courses_urls:
-                courses_urls.append(url)
+        with metrics.course_list.time():
+            for url in self.backend.get_courses_urls():
+                if url.find("course/view.php") != -1 and url not in courses_urls:
+                    courses_urls.append(url)
 
         self._courses_urls = courses_urls
         return courses_urls
 
+    def list_courses(self):
+        self.backend.start_session()
+        return self._get_courses_urls(force=True)
+
     def get_course_data(self, course_url):
-        if not self.is_logged_in:
-            self._login()
+        self.backend.start_session()
 
         try:
             urls = self._get_courses_urls()
@@ -158,84 +253,137 @@ class ElearnScrapper:
                 urls = self._get_courses_urls(force=True)
                 if course_url not in urls:
                     raise Exception("Invalid course URL.")
-            self.browser.get(course_url)
+            course = self.backend.load_course(course_url)
+            if course is None:
+                raise Exception(f"Could not load {course_url}")
         except Exception as e:
             print(e)
             logging.error(e)
+            self.failed_courses.append(course_url)
             return None
-        sleep(1)
-        content = self.browser.find_element(
-            By.XPATH, r"//div[@id='page-content']")
 
-        if not self._is_course_changed(course_url, content.text):
+        if any(section.get("restricted") for section in self.backend.get_sections(course)):
+            self.restricted_courses.append(course_url)
+            if self.shared:
+                logging.info(f"{course_url} has restricted sections, it has to be checked per user.")
+                return None
+
+        silent = self._is_baseline(course_url)
+        if silent:
+            logging.info(f"Recording the hashes of {course_url} silently.")
+
+        if not self._is_course_changed(course_url, course["text"]):
             return None
 
         course_data = {}
-        course_data["course_name"] = self.browser.find_element(
-            By.XPATH, r"//header[@id='page-header']").text
+        course_data["course_name"] = course["course_name"]
         course_data["course_url"] = course_url
         course_data["course_sections"] = []
+        changed = []
 
-        sections = content.find_elements(
-            By.XPATH, r"//ul[contains(@class,'topics') or contains(@class,'weeks')]//li[contains(@id,'section')]")
-
-        for section in sections:
+        for section in self.backend.get_sections(course):
             section_data = {}
-            section_data["section_name"] = section.find_element(
-                By.XPATH, r".//div[contains(@class,'course-section-header')]//h3").text
+            section_data["section_name"] = section["name"]
 
-            if not self._is_section_changed(course_url, section_data["section_name"], section.text):
+            if not self._is_section_changed(course_url, section_data["section_name"], section["text"]):
                 continue
 
             section_data["activities"] = []
-            activities_elements = section.find_elements(
-                By.XPATH, r".//li[contains(@class,'activity')]")
-
-            if len(activities_elements) == 0:
-                continue
-
-            for elem in activities_elements:
-                try:
-                    elem.find_element(By.XPATH, r".//button[contains(@title,'is marked as done')]")
-                except:
-                    pass
-                else:
+            for activity in section["activities"]:
+                if activity["done"] and self.skip_done:
                     continue
 
-                if not self._is_activity_changed(course_url, section_data["section_name"], elem.text):
+                if not self._is_activity_changed(course_url, section_data["section_name"], activity["text"]):
+                    continue
+                if silent:
                     continue
 
                 activity_data = {}
-                activity_data["text"] = elem.text
-                activity_data["links"] = []
-                links = elem.find_elements(By.XPATH, r".//a")
-                for link in links:
-                    activity_data["links"].append(link.get_attribute("href"))
-
-                activity_data["screen_shot_path"] = f"./tmp/{myhash(activity_data['text'] + section.text + content.text)}.png"
-                elem.screenshot(activity_data['screen_shot_path'])
+                activity_data["text"] = activity["text"]
+                activity_data["links"] = activity["links"]
+                activity_data["done"] = activity["done"]
+                activity_data["screen_shot_path"] = screenshot_store.staging_path()
                 section_data["activities"].append(activity_data)
+                changed.append((activity, activity_data))
 
             if len(section_data["activities"]) != 0:
                 course_data["course_sections"].append(section_data)
 
         if len(course_data["course_sections"]) == 0:
             return None
+        with metrics.screenshot_capture.time():
+            self.backend.capture(course, changed)
+        for activity, activity_data in changed:
+            if activity_data["screen_shot_path"] is None:
+                continue
+            try:
+                activity_data["screen_shot_path"] = screenshot_store.put(activity_data["screen_shot_path"])
+            except OSError as e:
+                print(e)
+                logging.error(e)
+                activity_data["screen_shot_path"] = None
         return course_data
 
     def get_all_courses_data(self):
         courses_urls = self._get_courses_urls()
         courses_data = []
+        observed = []
         number_of_courses = len(courses_urls)
         for i, url in enumerate(courses_urls):
+            if self._scheduler is not None and not self._scheduler.should_check(url):
+                continue
+            start = perf_counter()
             course_data = self.get_course_data(url)
+            duration = perf_counter() - start
+            metrics.course_parse.observe(duration)
+            if url in self.failed_courses:
+                metrics.courses_checked.inc(changed="error")
+            else:
+                metrics.courses_checked.inc(changed="yes" if course_data is not None else "no")
+                if not (self.shared and url in self.restricted_courses):
+                    observed.append((url, course_data is not None))
+            metrics.cycle_log.course(url, duration)
             if course_data is not None:
                 courses_data.append(course_data)
             print(f"Course {i+1}/{number_of_courses} done.")
             logging.info(f"Course {i+1}/{number_of_courses} done.")
-        self._close_browser()
+        if not self.flush(self._notifications(courses_data)):
+            # Nothing was saved, the same changes are found again next cycle; the courses stay due.
+            courses_data = []
+            observed = []
+        if self._scheduler is not None:
+            for url, changed in observed:
+                self._scheduler.observe(url, changed)
+        self.close()
         return courses_data
 
+    def close(self):
+        self.backend.close()
+        self._close_browser()
+
+    # Whether the course's hashes are recorded without reporting anything: they were computed
+    # from another text format, e.g. by another backend, or with baseline_known the course is
+    # new to this owner but not to others. Records the format the hashes are now in.
+    def _is_baseline(self, course_url):
+        text_format = self.backend.text_format
+        if self.shared:
+            text_format += "-shared"
+        item_id = myhash(course_url + "#format")
+        previous = self.get_hash(item_id)
+        course_id = myhash(course_url)
+        known = self.get_hash(course_id) is not None
+        self.set_hash(item_id, myhash(text_format), "format")
+        if not known:
+            return self._baseline_known and course_id in self._courses_known_elsewhere()
+        # Hashes written before the format was recorded all come from the HTML backends.
+        return (previous or myhash("html")) != myhash(text_format)
+
+    def _courses_known_elsewhere(self):
+        if self._known_elsewhere is None:
+            item_ids = [myhash(url) for url in self._get_courses_urls()]
+            self._known_elsewhere = DiffSession.known_to_others(self._diff_owner, item_ids)
+        return self._known_elsewhere
+
     def _is_course_changed(self, course_url, course_text):
         course_hash = myhash(course_text)
         item_id = myhash(course_url)
@@ -257,37 +405,34 @@ class ElearnScrapper:
             return True
         return False
 
-    def get_hash(self, item_id):
-        with DatabaseConnection() as connection:
+    def _diff_session(self):
+        if self._diff is None:
+            self._diff = DiffSession(self._diff_owner)
+        return self._diff
 
-            table = connection.get_table("last_updated")
-            query = db.select([table.c.hash]).where(
-                table.columns.id == item_id, table.columns.user_id == self._user.get_user_id())
-            result_proxy = connection.execute(query)
-            if result_proxy is None:
-                return None
-            row = result_proxy.fetchone()
-            if row is None:
-                return None
-            return row["hash"]
+    def get_hash(self, item_id):
+        return self._diff_session().get_hash(item_id)
 
+    # Changes are kept in memory until flush().
     def set_hash(self, item_id, hash, type=None):
         if type not in self.valid_types:
             type = None
-        with DatabaseConnection() as connection:
-            old_hash = self.get_hash(item_id)
-            if old_hash == hash:
-                return False
-            table = connection.get_table("last_updated")
-            if old_hash is None:
-                query = db.insert(table).values(
-                    id=item_id, user_id=self._user.get_user_id(), hash=hash, type=type)
-                connection.execute(query)
-            else:
-                query = db.update(table).where(table.columns.id == item_id,
-                                               table.columns.user_id == self._user.get_user_id()).values(hash=hash)
-                connection.execute(query)
+        return self._diff_session().is_changed(item_id, hash, type)
+
+    def _notifications(self, courses_data):
+        if self._recipients is None:
+            return None
+        rows = []
+        for course_data in courses_data:
+            base = self._diff_session().previous_hash(myhash(course_data["course_url"]))
+            for chat_id, course in self._recipients(course_data):
+                rows += Outbox.rows(chat_id, course, base)
+        return rows
+
+    def flush(self, notifications=None):
+        if self._diff is None:
             return True
+        return self._diff.flush(notifications)
 
     def __del__(self):
         self._close_browser()
@@ -0,0 +1,569 @@
+import os
+import re
+import json
+import io
+import logging
+from abc import ABC, abstractmethod
+from time import sleep
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from lxml import html
+from PIL import Image
+from selenium.webdriver.common.by import By
+
+from session_store import SessionStore, TokenStore
+
+
+# Shared by every HTML backend so the Selenium and lxml views of a page stay in sync.
+COURSES_LINKS_XPATH = r"//div[contains(@data-region,'paged-content-page')]//a"
+CONTENT_XPATH = r"//div[@id='page-content']"
+HEADER_XPATH = r"//header[@id='page-header']"
+SECTIONS_XPATH = r"//ul[contains(@class,'topics') or contains(@class,'weeks')]//li[contains(@id,'section')]"
+SECTION_NAME_XPATH = r".//div[contains(@class,'course-section-header')]//h3"
+ACTIVITIES_XPATH = r".//li[contains(@class,'activity')]"
+DONE_XPATH = r".//button[contains(@title,'is marked as done')]"
+LINKS_XPATH = r".//a"
+# Completion buttons and other per-user controls, left out of the text of shared courses.
+CONTROLS_XPATH = r".//*[contains(@class,'completion') or contains(@class,'activity-information') or self::button]"
+# Moodle tells a user why a section or activity is not available to them yet.
+RESTRICTED_XPATH = r".//*[contains(@class,'availabilityinfo')]"
+
+
+# "page" takes one full-page screenshot per course and crops the activities from it,
+# "element" asks the browser for one screenshot per activity.
+SCREENSHOT_MODE = os.getenv("SCREENSHOT_MODE", "page")
+SCREENSHOT_WORKERS = int(os.getenv("SCREENSHOT_WORKERS", 4))
+# Below this many changed activities cropping in the calling thread is faster than handing off.
+SCREENSHOT_PARALLEL_THRESHOLD = 4
+_crop_executor = ThreadPoolExecutor(max_workers=SCREENSHOT_WORKERS, thread_name_prefix="crop")
+
+_RECTS_SCRIPT = r"""
+return {
+    device_pixel_ratio: window.devicePixelRatio,
+    rects: arguments[0].map(id => {
+        const element = id === null ? null : document.getElementById(id);
+        if (element === null) {
+            return null;
+        }
+        const r = element.getBoundingClientRect();
+        return {x: r.left + window.scrollX, y: r.top + window.scrollY, width: r.width, height: r.height};
+    }),
+};
+"""
+
+
+def _crop(image, rect, scale, path):
+    box = (round(rect["x"] * scale), round(rect["y"] * scale),
+           round((rect["x"] + rect["width"]) * scale), round((rect["y"] + rect["height"]) * scale))
+    if box[2] <= box[0] or box[3] <= box[1]:
+        raise Exception(f"activity is not visible, can't crop {path}")
+    image.crop(box).save(path)
+
+
+class LoginError(Exception):
+    def __init__(self, *args, **kwargs):
+        self.message = args[0] if args else None
+        Exception.__init__(self, *args, **kwargs)
+
+
+class ScrapperBackend(ABC):
+    name = None
+    # Hashes only compare between backends that render a course to the same text.
+    text_format = "html"
+
+    def __init__(self, scrapper):
+        self.scrapper = scrapper
+
+    @abstractmethod
+    def start_session(self):
+        ...
+
+    @abstractmethod
+    def get_courses_urls(self) -> list:
+        ...
+
+    # Returns {"course_name", "course_url", "text"} or None if the page can't be loaded.
+    @abstractmethod
+    def load_course(self, course_url) -> dict | None:
+        ...
+
+    # Returns [{"name", "text", "restricted", "activities": [{"id", "text", "links", "done", "rect" (browser backends only)}]}]
+    # "restricted": some of the section is gated by availability conditions, so other users may see it differently.
+    @abstractmethod
+    def get_sections(self, course) -> list:
+        ...
+
+    # Fills activity_data["screen_shot_path"] for every (activity, activity_data) pair, None on failure.
+    @abstractmethod
+    def capture(self, course, changed):
+        ...
+
+    def close(self):
+        pass
+
+    # Screenshots activities by their "module-<id>" element on the course page.
+    def _capture_with_browser(self, course, changed):
+        try:
+            if not self.scrapper.is_logged_in:
+                self.scrapper._start_session()
+            self.scrapper._get(course["course_url"])
+        except Exception as e:
+            for activity, activity_data in changed:
+                self._screenshot_failed(activity_data, e)
+            return
+        self._screenshot(course, changed)
+
+    def _screenshot(self, course, changed):
+        if not changed:
+            return
+        if SCREENSHOT_MODE == "page":
+            try:
+                self._screenshot_page(course, changed)
+                return
+            except Exception as e:
+                print(e)
+                logging.error(e)
+        self._screenshot_by_id(course, changed)
+
+    def _screenshot_page(self, course, changed):
+        browser = self.scrapper.browser
+        if all("rect" in activity for activity, activity_data in changed):
+            rects = [activity["rect"] for activity, activity_data in changed]
+            scale = course.get("device_pixel_ratio") or 1
+        else:
+            result = browser.execute_script(_RECTS_SCRIPT, [activity["id"] for activity, activity_data in changed])
+            rects = result["rects"]
+            scale = result["device_pixel_ratio"] or 1
+        image = Image.open(io.BytesIO(browser.get_full_page_screenshot_as_png()))
+        image.load()
+
+        jobs = []
+        for (activity, activity_data), rect in zip(changed, rects):
+            if rect is None:
+                self._screenshot_failed(activity_data, Exception(f"activity {activity['id']} not found in {course['course_url']}"))
+                continue
+            jobs.append((activity_data, rect))
+
+        if len(jobs) < SCREENSHOT_PARALLEL_THRESHOLD:
+            for activity_data, rect in jobs:
+                try:
+                    _crop(image, rect, scale, activity_data["screen_shot_path"])
+                except Exception as e:
+                    self._screenshot_failed(activity_data, e)
+            return
+        futures = [(activity_data, _crop_executor.submit(_crop, image, rect, scale, activity_data["screen_shot_path"]))
+                   for activity_data, rect in jobs]
+        for activity_data, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                self._screenshot_failed(activity_data, e)
+
+    def _screenshot_by_id(self, course, changed):
+        browser = self.scrapper.browser
+        for activity, activity_data in changed:
+            try:
+                if not activity["id"]:
+                    raise Exception(f"activity in {course['course_url']} has no id")
+                browser.find_element(By.ID, activity["id"]).screenshot(activity_data["screen_shot_path"])
+            except Exception as e:
+                self._screenshot_failed(activity_data, e)
+
+    @staticmethod
+    def _screenshot_failed(activity_data, e):
+        print(e)
+        logging.error(e)
+        activity_data["screen_shot_path"] = None
+
+
+# Walks the course page in the browser and returns the whole tree in one WebDriver round trip.
+# Rects are page coordinates in CSS pixels. With controlsXPath, those elements are hidden while
+# the text is read and shown again before the rects are taken.
+_COURSE_TREE_SCRIPT = r"""
+const [contentXPath, headerXPath, sectionsXPath, sectionNameXPath, activitiesXPath, doneXPath, linksXPath, controlsXPath, restrictedXPath] = arguments;
+function all(xpath, root) {
+    const result = document.evaluate(xpath, root, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+    const nodes = [];
+    for (let i = 0; i < result.snapshotLength; i++) {
+        nodes.push(result.snapshotItem(i));
+    }
+    return nodes;
+}
+function first(xpath, root) {
+    return document.evaluate(xpath, root, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+}
+function text(element) {
+    return element.innerText.trim();
+}
+function rect(element) {
+    const r = element.getBoundingClientRect();
+    return {x: r.left + window.scrollX, y: r.top + window.scrollY, width: r.width, height: r.height};
+}
+const content = first(contentXPath, document);
+const header = first(headerXPath, document);
+if (content === null || header === null) {
+    return null;
+}
+const controls = controlsXPath === null ? [] : all(controlsXPath, content);
+const display = controls.map(element => element.style.display);
+controls.forEach(element => element.style.display = "none");
+const elements = [];
+const course = {
+    course_name: text(header),
+    text: text(content),
+    device_pixel_ratio: window.devicePixelRatio,
+    sections: all(sectionsXPath, content).map(section => {
+        const name = first(sectionNameXPath, section);
+        return {
+            name: name === null ? "" : text(name),
+            text: text(section),
+            restricted: first(restrictedXPath, section) !== null,
+            activities: all(activitiesXPath, section).map(activity => {
+                elements.push(activity);
+                return {
+                    id: activity.id || null,
+                    text: text(activity),
+                    links: all(linksXPath, activity).map(link => link.href).filter(href => href),
+                    done: first(doneXPath, activity) !== null,
+                };
+            }),
+        };
+    }),
+};
+controls.forEach((element, i) => element.style.display = display[i]);
+let i = 0;
+course.sections.forEach(section => section.activities.forEach(activity => activity.rect = rect(elements[i++])));
+return course;
+"""
+
+
+class SeleniumBackend(ScrapperBackend):
+    name = "selenium"
+
+    def start_session(self):
+        if not self.scrapper.is_logged_in:
+            self.scrapper._start_session()
+
+    def get_courses_urls(self):
+        self.start_session()
+        browser = self.scrapper.browser
+        if browser.current_url != self.scrapper.elearn_url:
+            self.scrapper._get(self.scrapper.elearn_url)
+        courses_cards = browser.find_elements(By.XPATH, COURSES_LINKS_XPATH)
+        return [card.get_attribute("href") for card in courses_cards]
+
+    def load_course(self, course_url):
+        self.start_session()
+        self.scrapper._get(course_url)
+        sleep(1)
+        course = self.scrapper.browser.execute_script(
+            _COURSE_TREE_SCRIPT, CONTENT_XPATH, HEADER_XPATH, SECTIONS_XPATH, SECTION_NAME_XPATH,
+            ACTIVITIES_XPATH, DONE_XPATH, LINKS_XPATH, CONTROLS_XPATH if self.scrapper.shared else None, RESTRICTED_XPATH)
+        if course is None:
+            return None
+        course["course_url"] = course_url
+        return course
+
+    def get_sections(self, course):
+        return course["sections"]
+
+    def capture(self, course, changed):
+        self._screenshot(course, changed)
+
+
+_block_tags = {"address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt", "figcaption",
+               "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li",
+               "nav", "ol", "p", "pre", "section", "table", "tr", "ul"}
+
+
+def _collect_text(element, parts):
+    # Comments and processing instructions have a non-string tag.
+    if not isinstance(element.tag, str):
+        return
+    block = element.tag in _block_tags
+    if block:
+        parts.append("\n")
+    if element.text:
+        parts.append(element.text)
+    for child in element:
+        _collect_text(child, parts)
+        if child.tail:
+            parts.append(child.tail)
+    if block:
+        parts.append("\n")
+
+
+# Approximates WebElement.text: one line per block element, collapsed whitespace.
+def _element_text(element) -> str:
+    parts = []
+    _collect_text(element, parts)
+    lines = (" ".join(line.split()) for line in "".join(parts).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def _parse_document(page, url):
+    doc = html.fromstring(page)
+    # Drop what Firefox would not render as text, so hashes stay close to the Selenium ones.
+    for elem in doc.xpath(r"//script | //style | //*[contains(@class,'sr-only') or contains(@class,'accesshide')]"):
+        elem.drop_tree()
+    doc.make_links_absolute(url)
+    return doc
+
+
+def parse_courses_page(page, url) -> list:
+    doc = _parse_document(page, url)
+    return [link.get("href") for link in doc.xpath(COURSES_LINKS_XPATH) if link.get("href")]
+
+
+# With strip_controls, per-user controls are left out of the text, like in the browser.
+def parse_course_page(page, url, strip_controls=False) -> dict | None:
+    doc = _parse_document(page, url)
+    content = doc.xpath(CONTENT_XPATH)
+    header = doc.xpath(HEADER_XPATH)
+    if not content or not header:
+        return None
+    # Completion is read before the buttons that show it are dropped.
+    done = {elem: len(elem.xpath(DONE_XPATH)) != 0 for elem in content[0].xpath(ACTIVITIES_XPATH)}
+    if strip_controls:
+        for elem in content[0].xpath(CONTROLS_XPATH):
+            elem.drop_tree()
+    course = {
+        "course_name": _element_text(header[0]),
+        "course_url": url,
+        "text": _element_text(content[0]),
+        "sections": [],
+    }
+    for section in content[0].xpath(SECTIONS_XPATH):
+        name = section.xpath(SECTION_NAME_XPATH)
+        section_data = {
+            "name": _element_text(name[0]) if name else "",
+            "text": _element_text(section),
+            "restricted": len(section.xpath(RESTRICTED_XPATH)) != 0,
+            "activities": [],
+        }
+        for elem in section.xpath(ACTIVITIES_XPATH):
+            section_data["activities"].append({
+                "id": elem.get("id"),
+                "text": _element_text(elem),
+                "links": [link.get("href") for link in elem.xpath(LINKS_XPATH) if link.get("href")],
+                "done": done.get(elem, False),
+            })
+        course["sections"].append(section_data)
+    return course
+
+
+class HTTPBackend(ScrapperBackend):
+    name = "http"
+    pool_size = int(os.getenv("HTTP_POOL_SIZE", 4))
+    timeout = int(os.getenv("HTTP_TIMEOUT", 30))
+    screenshots = os.getenv("HTTP_SCREENSHOTS", "1") == "1"
+    user_agent = "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0"
+
+    def __init__(self, scrapper):
+        super().__init__(scrapper)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=2)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = self.user_agent
+        self.is_logged_in = False
+        self._courses_page = None
+
+    def _set_cookies(self, cookies):
+        for cookie in cookies:
+            self.session.cookies.set(cookie["name"], cookie["value"],
+                                     domain=cookie.get("domain", ""), path=cookie.get("path", "/"))
+
+    def _fetch(self, url):
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        # Moodle redirects to the login page once the session has expired.
+        if response.url.find("login/index.php") != -1:
+            return None
+        return response
+
+    def start_session(self):
+        if self.is_logged_in:
+            return
+        cookies = SessionStore.load(self.scrapper._user.get_user_id())
+        if cookies:
+            self._set_cookies(cookies)
+            self._courses_page = self._fetch(self.scrapper.elearn_url)
+        if self._courses_page is None:
+            # The Microsoft SSO flow still needs a real browser.
+            self.session.cookies.clear()
+            self.scrapper._login()
+            self._set_cookies(self.scrapper.browser.get_cookies())
+            self.scrapper._close_browser()
+            self._courses_page = self._fetch(self.scrapper.elearn_url)
+            if self._courses_page is None:
+                raise Exception("elearn session was rejected after login")
+        self.is_logged_in = True
+
+    def get_courses_urls(self):
+        self.start_session()
+        if self._courses_page is None:
+            self._courses_page = self._fetch(self.scrapper.elearn_url)
+        response, self._courses_page = self._courses_page, None
+        urls = parse_courses_page(response.content, response.url)
+        if not urls:
+            # Moodle 4 renders the course cards with JS, ask the same AJAX service the page uses.
+            urls = self._get_enrolled_courses_urls(response.text, response.url)
+        return urls
+
+    def _get_enrolled_courses_urls(self, page, url):
+        match = re.search(r'"sesskey":"([^"]+)"', page)
+        if match is None:
+            return []
+        service_url = urljoin(url, f"../lib/ajax/service.php?sesskey={match.group(1)}")
+        payload = [{
+            "index": 0,
+            "methodname": "core_course_get_enrolled_courses_by_timeline_classification",
+            "args": {"offset": 0, "limit": 0, "classification": "all", "sort": "fullname"},
+        }]
+        response = self.session.post(service_url, data=json.dumps(payload), timeout=self.timeout,
+                                     headers={"Content-Type": "application/json"})
+        response.raise_for_status()
+        result = response.json()[0]
+        if result.get("error"):
+            logging.error(result.get("exception"))
+            return []
+        return [course["viewurl"] for course in result["data"]["courses"]]
+
+    def load_course(self, course_url):
+        self.start_session()
+        response = self._fetch(course_url)
+        if response is None:
+            self.is_logged_in = False
+            return None
+        return parse_course_page(response.content, course_url, self.scrapper.shared)
+
+    def get_sections(self, course):
+        return course["sections"]
+
+    def capture(self, course, changed):
+        # Screenshots are the only thing left that needs the browser.
+        if self.screenshots:
+            self._capture_with_browser(course, changed)
+            return
+        for activity, activity_data in changed:
+            activity_data["screen_shot_path"] = None
+
+    def close(self):
+        self.session.close()
+
+
+def _html_to_text(text) -> str:
+    if not text:
+        return ""
+    return _element_text(html.fragment_fromstring(text, create_parent="div"))
+
+
+class WebServiceBackend(ScrapperBackend):
+    name = "ws"
+    # Names and descriptions only, none of the buttons and widgets of the HTML pages.
+    text_format = "ws"
+    timeout = HTTPBackend.timeout
+    screenshots = os.getenv("MOODLE_WS_SCREENSHOTS", "0") == "1"
+    # Completion states that mean the activity is done (complete, complete with pass).
+    done_states = [1, 2]
+
+    def __init__(self, scrapper):
+        super().__init__(scrapper)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTPBackend.pool_size, max_retries=2)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.server_url = urljoin(scrapper.elearn_url, "../webservice/rest/server.php")
+        self.course_view_url = urljoin(scrapper.elearn_url, "../course/view.php")
+        self._token = None
+        self._user_id = None
+        self._courses = {}
+
+    def _call(self, function, **params):
+        data = {"wstoken": self._token, "wsfunction": function, "moodlewsrestformat": "json"}
+        data.update(params)
+        response = self.session.post(self.server_url, data=data, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        if isinstance(result, dict) and "exception" in result:
+            if result.get("errorcode") == "invalidtoken":
+                TokenStore.delete(self.scrapper._user.get_user_id())
+                raise LoginError(f"Moodle web service token rejected: {result.get('message')}")
+            raise Exception(f"{function}: {result.get('message')}")
+        return result
+
+    def start_session(self):
+        if self._user_id is not None:
+            return
+        self._token = TokenStore.load(self.scrapper._user.get_user_id())
+        if not self._token:
+            raise LoginError("No Moodle web service token")
+        self._user_id = self._call("core_webservice_get_site_info")["userid"]
+
+    def get_courses_urls(self):
+        self.start_session()
+        self._courses = {}
+        for course in self._call("core_enrol_get_users_courses", userid=self._user_id):
+            self._courses[f"{self.course_view_url}?id={course['id']}"] = course
+        return list(self._courses)
+
+    def load_course(self, course_url):
+        self.start_session()
+        if not self._courses:
+            # Courses given to the scrapper are not listed first.
+            self.get_courses_urls()
+        course = self._courses.get(course_url)
+        if course is None:
+            return None
+        sections = []
+        for section in self._call("core_course_get_contents", courseid=course["id"]):
+            section_data = {"name": section["name"], "restricted": self._restricted(section), "activities": []}
+            lines = [section["name"], _html_to_text(section.get("summary"))]
+            for module in section.get("modules", []):
+                text = "\n".join(filter(None, [module["name"], _html_to_text(module.get("description"))]))
+                completion = module.get("completiondata") or {}
+                links = [module["url"]] if module.get("url") else []
+                section_data["activities"].append({
+                    "id": f"module-{module['id']}",
+                    "text": text,
+                    "links": links,
+                    "done": completion.get("state") in self.done_states,
+                })
+                lines.append(text)
+                section_data["restricted"] = section_data["restricted"] or self._restricted(module)
+            section_data["text"] = "\n".join(filter(None, lines))
+            sections.append(section_data)
+        return {
+            "course_name": course.get("fullname", ""),
+            "course_url": course_url,
+            "text": "\n".join(section["text"] for section in sections),
+            "sections": sections,
+        }
+
+    @staticmethod
+    def _restricted(item):
+        return bool(item.get("availabilityinfo")) or item.get("uservisible") is False
+
+    def get_sections(self, course):
+        return course["sections"]
+
+    def capture(self, course, changed):
+        if self.screenshots:
+            self._capture_with_browser(course, changed)
+            return
+        for activity, activity_data in changed:
+            activity_data["screen_shot_path"] = None
+
+    def close(self):
+        self.session.close()
+
+
+backends = {
+    SeleniumBackend.name: SeleniumBackend,
+    HTTPBackend.name: HTTPBackend,
+    WebServiceBackend.name: WebServiceBackend,
+}
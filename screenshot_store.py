@@ -0,0 +1,167 @@
+import os
+import shutil
+import logging
+import hashlib
+import threading
+from time import time
+from uuid import uuid4
+
+
+# Screenshots stored once per image, named by the sha256 of their bytes. Files referenced
+# by a pending notification are never evicted; the rest are evicted least recently used
+# first once the store is over its quota, or when they are older than max_age.
+class ScreenshotStore:
+    staging_dir = "./tmp"
+    root = os.getenv("SCREENSHOT_STORE", "./tmp/screenshots")
+    quota = int(float(os.getenv("SCREENSHOT_QUOTA_MB", 500)) * 1024 * 1024)
+    max_age = float(os.getenv("SCREENSHOT_MAX_AGE", 7 * 24)) * 3600
+    sweep_interval = float(os.getenv("SCREENSHOT_SWEEP_INTERVAL", 600))
+    # Freshly stored files are kept at least this long, so nothing is evicted between
+    # the scrape that stored it and the notification that acquires it.
+    min_age = 600
+
+    def __init__(self, root=None, quota=None, max_age=None):
+        if root is not None:
+            self.root = root
+        if quota is not None:
+            self.quota = quota
+        if max_age is not None:
+            self.max_age = max_age
+        self._refs = {}
+        # Optional callable returning more paths to keep, e.g. screenshots of queued notifications.
+        self.pinned = None
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._stop = threading.Event()
+        self.stats = {"stored": 0, "deduplicated": 0, "evicted": 0, "bytes": 0, "files": 0}
+
+    # Where a backend should write a screenshot before it is stored.
+    def staging_path(self):
+        os.makedirs(self.staging_dir, exist_ok=True)
+        return os.path.join(self.staging_dir, f"{uuid4().hex}.png")
+
+    def path_for(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.png")
+
+    # Moves a staged screenshot into the store and returns its stored path.
+    def put(self, staged_path):
+        with open(staged_path, "rb") as f:
+            key = hashlib.sha256(f.read()).hexdigest()
+        path = self.path_for(key)
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(staged_path)
+                os.utime(path)
+                self.stats["deduplicated"] += 1
+                return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.move(staged_path, path)
+            self.stats["stored"] += 1
+        return path
+
+    def acquire(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            self._refs[path] = self._refs.get(path, 0) + 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def release(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            count = self._refs.get(path, 0) - 1
+            if count > 0:
+                self._refs[path] = count
+            else:
+                self._refs.pop(path, None)
+
+    # Removes the file unless it is referenced or was touched after `older_than`. Its mtime is
+    # read again under the lock: put() may have stored the same image since the sweep's scan.
+    def _remove(self, path, older_than, pinned=()) -> bool:
+        with self._lock:
+            if os.path.abspath(path) in self._refs or os.path.abspath(path) in pinned:
+                return False
+            try:
+                if os.stat(path).st_mtime >= older_than:
+                    return False
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(e)
+                return False
+        return True
+
+    def _scan(self):
+        files = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    # Returns the number of files removed.
+    def sweep(self) -> int:
+        now = time()
+        removed = 0
+        # Staged files that were never stored, left behind by a failed scrape.
+        if os.path.isdir(self.staging_dir):
+            for entry in os.scandir(self.staging_dir):
+                if entry.is_file() and entry.name.endswith(".png") and entry.stat().st_mtime < now - self.min_age:
+                    if self._remove(entry.path, now - self.min_age):
+                        removed += 1
+
+        pinned = set()
+        if self.pinned is not None:
+            try:
+                pinned = {os.path.abspath(path) for path in self.pinned()}
+            except Exception as e:
+                # Without the list nothing can be evicted safely.
+                logging.error(e)
+                return removed
+        files = sorted(self._scan())
+        total = sum(size for _, size, _ in files)
+        kept = []
+        for mtime, size, path in files:
+            expired = mtime < now - self.max_age
+            over_quota = total > self.quota and mtime < now - self.min_age
+            older_than = now - self.min_age if over_quota else now - self.max_age
+            if (expired or over_quota) and self._remove(path, older_than, pinned):
+                total -= size
+                removed += 1
+                self.stats["evicted"] += 1
+                continue
+            kept.append(path)
+        self.stats["bytes"] = total
+        self.stats["files"] = len(kept)
+        if total > self.quota:
+            logging.error(f"Screenshot store is {total // 1024 // 1024} MB, over its {self.quota // 1024 // 1024} MB quota.")
+        return removed
+
+    def start_sweeper(self):
+        if self._sweeper is not None:
+            return
+        self._sweeper = threading.Thread(target=self._sweep_forever, name="screenshot-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+
+    def _sweep_forever(self):
+        while not self._stop.is_set():
+            try:
+                removed = self.sweep()
+                if removed:
+                    logging.info(f"Removed {removed} screenshots, {self.stats['files']} files ({self.stats['bytes'] // 1024} KB) kept.")
+            except Exception as e:
+                logging.error(e)
+            self._stop.wait(self.sweep_interval)
+
+
+screenshot_store = ScreenshotStore()
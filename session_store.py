@@ -0,0 +1,72 @@
+import json
+import logging
+from datetime import datetime
+
+import sqlalchemy as db
+from cryptography.fernet import InvalidToken
+
+import schema
+from database_connection import DatabaseConnection
+from users import encrypt_data, decrypt_data
+
+
+# One encrypted JSON value per user, stored in its own table.
+class EncryptedUserStore:
+    table = None
+    column = None
+    _table_ready = False
+
+    @classmethod
+    def _get_table(cls, connection: DatabaseConnection):
+        if not cls._table_ready:
+            cls._table_ready = connection.create_table(cls.table)
+        return cls.table
+
+    @classmethod
+    def load(cls, user_id):
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            query = db.select([table.c[cls.column]]).where(table.c.user_id == user_id)
+            result_proxy = connection.execute(query)
+            if result_proxy is None:
+                return None
+            row = result_proxy.fetchone()
+            if row is None:
+                return None
+        try:
+            return json.loads(decrypt_data(row[cls.column]))
+        except (InvalidToken, ValueError) as e:
+            logging.error(e)
+            return None
+
+    @classmethod
+    def save(cls, user_id, value) -> bool:
+        value = encrypt_data(json.dumps(value).encode())
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            query = db.select([table.c.user_id]).where(table.c.user_id == user_id)
+            result_proxy = connection.execute(query)
+            if result_proxy is not None and result_proxy.fetchone() is not None:
+                query = db.update(table).where(table.c.user_id == user_id).values(
+                    {cls.column: value, "updated_at": datetime.utcnow()})
+            else:
+                query = db.insert(table).values(
+                    {"user_id": user_id, cls.column: value, "updated_at": datetime.utcnow()})
+            return connection.execute(query) is not None
+
+    @classmethod
+    def delete(cls, user_id) -> bool:
+        with DatabaseConnection() as connection:
+            table = cls._get_table(connection)
+            query = db.delete(table).where(table.c.user_id == user_id)
+            return connection.execute(query) is not None
+
+
+class SessionStore(EncryptedUserStore):
+    table = schema.user_session
+    column = "cookies"
+
+
+class TokenStore(EncryptedUserStore):
+    table = schema.user_token
+    column = "token"
@@ -1,14 +1,30 @@
 import asyncio
 import os
+import re
 import logging
 import threading
+from time import time
+from pathlib import Path
 from telegram import Update
-from telegram import Bot as BotAPI
+from telegram.error import Forbidden, BadRequest
 from telegram.ext import (ApplicationBuilder, CommandHandler, ContextTypes,
                           MessageHandler, filters)
 from dotenv import load_dotenv
 from users import User
-from scrapper import ElearnScrapper, LoginError
+from async_users import AsyncUser
+from async_database_connection import AsyncDatabaseConnection
+from scrapper import LoginError
+from session_store import SessionStore, TokenStore
+from scrape_workers import ScrapeWorkerPool, RemoteScrapePool
+from course_index import CourseIndex
+from course_scheduler import CourseScheduler
+from dispatcher import MessageDispatcher
+from notifications import compose_course, photo_paths, as_text, split_text
+from outbox import Outbox
+from screenshot_store import screenshot_store
+from media_cache import MediaCache
+from profiling import profiler
+import metrics
 
 
 load_dotenv()
@@ -20,48 +36,62 @@ if __name__ == "__main__":
 class TelegramBot:
     token = os.getenv("TELEGRAM_TOKEN")
     admin_chat_id = int(os.getenv("TELEGRAM_ADMIN_ID"))
-    botapi = BotAPI(token=token)
+    dispatcher = MessageDispatcher(token, media_cache=MediaCache())
     update_timer = {"remaining": 0, "interval": 15}  # in minutes
 
     notifier_is_running = True
+    scheduler = None
 
     def __init__(self, **kwargs):
 
-        self.app = ApplicationBuilder().token(self.token).build()
+        self.app = (ApplicationBuilder().token(self.token).base_url(MessageDispatcher.base_url)
+                    .post_shutdown(self._post_shutdown).build())
 
         self.attach_handlers()
         self.app.add_handler(MessageHandler(filters.COMMAND, self._unknown))
 
     def attach_handlers(self):
-        self.app.add_handler(CommandHandler("start", self._start))
-        self.app.add_handler(CommandHandler("email", self._email))
-        self.app.add_handler(CommandHandler("password", self._password))
+        self.app.add_handler(CommandHandler("start", self._scoped(self._start)))
+        self.app.add_handler(CommandHandler("email", self._scoped(self._email)))
+        self.app.add_handler(CommandHandler("password", self._scoped(self._password)))
+        self.app.add_handler(CommandHandler("token", self._scoped(self._token)))
         self.app.add_handler(CommandHandler("help", self._help))
         self.app.add_handler(CommandHandler(
-            "toggle_notifications", self._toggle_active))
+            "toggle_notifications", self._scoped(self._toggle_active)))
         self.app.add_handler(CommandHandler(
             "next_update", self._remaining_time))
-        self.app.add_handler(CommandHandler("admin", self._admin))
+        self.app.add_handler(CommandHandler("admin", self._scoped(self._admin)))
+
+    # Runs every query of one command on a single pooled connection.
+    @staticmethod
+    def _scoped(callback):
+        async def scoped_callback(update: Update, context: ContextTypes):
+            async with AsyncDatabaseConnection.scope():
+                await callback(update, context)
+        return scoped_callback
 
     async def _start(self, update: Update, context: ContextTypes):
         await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Welcome to Elearning Bot.\nThis bot will notify you when new content is available on elearning.\nType /help for a list of commands.")
-        user = TelegramBot.get_user(update.effective_chat.id)
+        user = await TelegramBot.get_user(update.effective_chat.id)
         if user.get_email() is None:
             await context.bot.send_message(chat_id=user.get_chat_id(), text="Please set your email address using the /email command.")
-        if user.get_password() is None:
+        if not user.has_password():
             await context.bot.send_message(chat_id=user.get_chat_id(), text="Please set your password using the /password command.")
 
     # User related commands
 
     async def _email(self, update: Update, context: ContextTypes):
-        user = TelegramBot.get_user(update.effective_chat.id)
+        user = await TelegramBot.get_user(update.effective_chat.id)
 
         if len(context.args) > 0:
             try:
                 user.set_email(context.args[0])
-                if user.get_password() is not None:
+                if user.has_password():
                     user.set_is_active(True)
-                User.update_user(user)
+                await AsyncUser.update_user(user)
+                await asyncio.to_thread(SessionStore.delete, user.get_user_id())
+                await asyncio.to_thread(TokenStore.delete, user.get_user_id())
+                await asyncio.to_thread(CourseIndex.remove_user, user.get_user_id())
             except ValueError or TypeError as e:
                 await context.bot.send_message(chat_id=user.get_chat_id(), text=f"Invalid email address. {e}")
                 return
@@ -72,26 +102,43 @@ class TelegramBot:
             await context.bot.send_message(chat_id=user.get_chat_id(), text=f"Email address: {user.get_email()}")
 
     async def _password(self, update: Update, context: ContextTypes):
-        user = TelegramBot.get_user(update.effective_chat.id)
+        user = await TelegramBot.get_user(update.effective_chat.id)
         if len(context.args) > 0:
             try:
                 user.set_password(context.args[0])
                 if user.get_email() is not None:
                     user.set_is_active(True)
-                User.update_user(user)
+                await AsyncUser.update_user(user)
             except ValueError or TypeError as e:
                 await context.bot.send_message(chat_id=user.get_chat_id(), text=f"Invalid password: {e}")
                 return
             await context.bot.send_message(chat_id=user.get_chat_id(), text="Password updated.\n For your security, please delete the password from the chat.")
-        elif user.get_password() is None:
+        elif not user.has_password():
             await context.bot.send_message(chat_id=user.get_chat_id(), text="No password set.")
         else:
             await context.bot.send_message(chat_id=user.get_chat_id(), text="Password set.")
 
+    async def _token(self, update: Update, context: ContextTypes):
+        user = await TelegramBot.get_user(update.effective_chat.id)
+        if len(context.args) > 0:
+            if context.args[0] == "delete":
+                await asyncio.to_thread(TokenStore.delete, user.get_user_id())
+                await context.bot.send_message(chat_id=user.get_chat_id(), text="Token deleted.")
+                return
+            if re.fullmatch(r"[0-9a-f]{32}", context.args[0]) is None:
+                await context.bot.send_message(chat_id=user.get_chat_id(), text="Invalid token. A Moodle token is 32 hexadecimal characters.")
+                return
+            await asyncio.to_thread(TokenStore.save, user.get_user_id(), context.args[0])
+            await context.bot.send_message(chat_id=user.get_chat_id(), text="Token updated.\n For your security, please delete the token from the chat.")
+        elif await asyncio.to_thread(TokenStore.load, user.get_user_id()) is None:
+            await context.bot.send_message(chat_id=user.get_chat_id(), text="No token set.")
+        else:
+            await context.bot.send_message(chat_id=user.get_chat_id(), text="Token set.")
+
     async def _toggle_active(self, update: Update, context: ContextTypes):
-        user = TelegramBot.get_user(update.effective_chat.id)
+        user = await TelegramBot.get_user(update.effective_chat.id)
         user.set_is_active(not user.get_is_active())
-        User.update_user(user)
+        await AsyncUser.update_user(user)
         if user.get_is_active():
             text = "You are now active. You will receive notifications from the bot."
         else:
@@ -101,7 +148,7 @@ class TelegramBot:
     # General commands
 
     async def _help(self, update: Update, context: ContextTypes):
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="Commands:\n/start - Start the bot.\n/email - Get or Set your email address.\n   example: /email myemail@just.edu.jo\n/password - Get or Set your password.\n   example: /password mypassword\n/toggle_notifications - Toggle notifications on or off.\n/next_update - Get the time remaining until the next update.\n/help - Get a list of commands.")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Commands:\n/start - Start the bot.\n/email - Get or Set your email address.\n   example: /email myemail@just.edu.jo\n/password - Get or Set your password.\n   example: /password mypassword\n/token - Get, Set or delete your Moodle mobile web service token (faster updates).\n   example: /token 0123456789abcdef0123456789abcdef\n/toggle_notifications - Toggle notifications on or off.\n/next_update - Get the time remaining until the next update.\n/help - Get a list of commands.")
 
     async def _remaining_time(self, update: Update, context: ContextTypes):
         if not self.notifier_is_running:
@@ -122,7 +169,7 @@ class TelegramBot:
             await context.bot.send_message(chat_id=update.effective_chat.id, text="Unknown command.")
             return
         if len(context.args) == 0 or context.args[0] == "help":
-            await TelegramBot.send_message_to_admin("Admin commands:\n/admin help - Show help message.\n/admin start - Start the notifier.\n/admin stop - Stop the notifier.\n/admin update - Force an update.\n/admin current_interval - show the current update interval.\n/admin change_interval [minutes] - change the update interval.\n/admin users - Show the list of users.\n/admin user [chat_id/email] [value] - show user info.\n/admin block [chat_id/email] [value] - block user.\n/admin unblock [chat_id/email] [value] - unblock user.\n/admin broadcast [message] - broadcast a message to all users.\n/admin send [chat_id/email] [value] [message] - send a message to a user.")
+            await TelegramBot.send_message_to_admin("Admin commands:\n/admin help - Show help message.\n/admin start - Start the notifier.\n/admin stop - Stop the notifier.\n/admin update - Force an update.\n/admin current_interval - show the current update interval.\n/admin change_interval [minutes] - change the update interval.\n/admin users - Show the list of users.\n/admin user [chat_id/email] [value] - show user info.\n/admin block [chat_id/email] [value] - block user.\n/admin unblock [chat_id/email] [value] - unblock user.\n/admin broadcast [message] - broadcast a message to all users.\n/admin send [chat_id/email] [value] [message] - send a message to a user.\n/admin dispatcher - show the outgoing message queue.\n/admin stats [cycles] - show timings and errors of the last scrape cycles.\n/admin profile - profile the next scrape cycle.\n/admin profile [chat_id/email] [value] - profile a scrape of one user now.")
 
         elif context.args[0] == "start":
             if TelegramBot.notifier_is_running:
@@ -150,7 +197,12 @@ class TelegramBot:
             await TelegramBot.send_message_to_admin("Updating now...")
 
         elif context.args[0] == "current_interval":
-            await TelegramBot.send_message_to_admin(f"Current interval: {TelegramBot.update_timer['interval']} minutes.")
+            text = f"Current interval: {TelegramBot.update_timer['interval']} minutes."
+            if TelegramBot.scheduler is not None:
+                stats = TelegramBot.scheduler.get_stats()
+                text += (f"\nAdaptive schedule: {stats['courses']} courses, checked every {stats['min_interval'] / 60:.0f}"
+                         f" to {stats['max_interval'] / 60:.0f} minutes ({stats['checks_per_hour']:.1f} checks/hour).")
+            await TelegramBot.send_message_to_admin(text)
 
         elif context.args[0] == "change_interval":
             if len(context.args) > 1:
@@ -168,7 +220,7 @@ class TelegramBot:
 
         elif context.args[0] == "users":
             if len(context.args) == 1 or context.args[1] == "all":
-                users = User.get_all_users()
+                users = await AsyncUser.get_all_users()
                 try:
                     if len(context.args) > 3:
                         end = min(int(context.args[3]), len(users))
@@ -192,7 +244,7 @@ class TelegramBot:
                         active_users += 1
                     if user.get_is_blocked():
                         blocked_users += 1
-                    if user.get_password() is not None:
+                    if user.has_password():
                         password = "Set"
                     else:
                         password = "Not set"
@@ -201,7 +253,7 @@ class TelegramBot:
                 text += f"Total users: {total_users}\nActive users: {active_users}\nBlocked users: {blocked_users}"
                 await TelegramBot.send_message_to_admin(text)
             elif context.args[1] == "active":
-                users = User.get_users_by("active", True)
+                users = await AsyncUser.get_users_by("active", True)
                 try:
                     if len(context.args) > 3:
                         end = min(int(context.args[3]), len(users))
@@ -222,7 +274,7 @@ class TelegramBot:
                 text += f"Total active users: {len(users)}"
                 await TelegramBot.send_message_to_admin(text)
             elif context.args[1] == "inactive":
-                users = User.get_users_by("active", False)
+                users = await AsyncUser.get_users_by("active", False)
                 try:
                     if len(context.args) > 3:
                         end = min(int(context.args[3]), len(users))
@@ -243,7 +295,7 @@ class TelegramBot:
                 text += f"Total inactive users: {len(users)}"
                 await TelegramBot.send_message_to_admin(text)
             elif context.args[1] == "blocked":
-                users = User.get_users_by("blocked", True)
+                users = await AsyncUser.get_users_by("blocked", True)
                 try:
                     if len(context.args) > 3:
                         end = min(int(context.args[3]), len(users))
@@ -264,7 +316,7 @@ class TelegramBot:
                 text += f"Total blocked users: {len(users)}"
                 await TelegramBot.send_message_to_admin(text)
             elif context.args[1] == "unblocked":
-                users = User.get_users_by("blocked", False)
+                users = await AsyncUser.get_users_by("blocked", False)
                 try:
                     if len(context.args) > 3:
                         end = min(int(context.args[3]), len(users))
@@ -299,12 +351,12 @@ class TelegramBot:
                     except ValueError:
                         await TelegramBot.send_message_to_admin("Invalid chat_id.")
                         return
-                res = User.get_user_by(key, value)
+                res = await AsyncUser.get_users_by(key, value)
                 if res is None or len(res) == 0:
                     await TelegramBot.send_message_to_admin("User not found.")
                     return
                 user = res[0]
-                if user.get_password() is None:
+                if not user.has_password():
                     password = "Not set"
                 else:
                     password = "Set"
@@ -325,7 +377,7 @@ class TelegramBot:
                         await TelegramBot.send_message_to_admin("Invalid chat_id.")
                         return
                 try:
-                    res = User.get_users_by(key, value)
+                    res = await AsyncUser.get_users_by(key, value)
                     if res is None or len(res) == 0:
                         await TelegramBot.send_message_to_admin("User not found.")
                         return
@@ -334,7 +386,7 @@ class TelegramBot:
                         await TelegramBot.send_message_to_admin("User is already blocked.")
                         return
                     user.set_is_blocked(True)
-                    User.update_user(user)
+                    await AsyncUser.update_user(user)
                     await TelegramBot.send_message_to_admin(f"User {value} blocked.")
                 except Exception as e:
                     await TelegramBot.send_message_to_admin(f"Invalid user ID.\n{e}")
@@ -355,7 +407,7 @@ class TelegramBot:
                         await TelegramBot.send_message_to_admin("Invalid chat_id.")
                         return
                 try:
-                    res = User.get_users_by(key, value)
+                    res = await AsyncUser.get_users_by(key, value)
                     if res is None or len(res) == 0:
                         await TelegramBot.send_message_to_admin("User not found.")
                         return
@@ -364,7 +416,7 @@ class TelegramBot:
                         await TelegramBot.send_message_to_admin("User is already unblocked.")
                         return
                     user.set_is_blocked(False)
-                    User.update_user(user)
+                    await AsyncUser.update_user(user)
                     await TelegramBot.send_message_to_admin(f"User {value} unblocked.")
                 except Exception as e:
                     await TelegramBot.send_message_to_admin(f"Invalid user ID.\n{e}")
@@ -374,8 +426,8 @@ class TelegramBot:
         elif context.args[0] == "broadcast":
             if len(context.args) > 1:
                 text = " ".join(context.args[1:])
-                TelegramBot.broadcast(text)
-                TelegramBot.send_message_to_admin("Broadcast sent.")
+                count = await TelegramBot.broadcast(text)
+                await TelegramBot.send_message_to_admin(f"Broadcast queued for {count} users.")
             else:
                 await TelegramBot.send_message_to_admin("Please specify a message. Use /admin broadcast [message]")
 
@@ -393,7 +445,7 @@ class TelegramBot:
                         await TelegramBot.send_message_to_admin("Invalid chat_id.")
                         return
                 try:
-                    res = User.get_users_by(key, value)
+                    res = await AsyncUser.get_users_by(key, value)
                     if res is None or len(res) == 0:
                         await TelegramBot.send_message_to_admin("User not found.")
                         return
@@ -405,49 +457,194 @@ class TelegramBot:
                 except Exception as e:
                     await TelegramBot.send_message_to_admin(f"Invalid user ID.\n{e}")
 
+        elif context.args[0] == "dispatcher":
+            stats = TelegramBot.dispatcher.get_stats()
+            text = (f"Queued: {stats['queue_depth']}\nSubmitted: {stats['submitted']}\nSent: {stats['sent']}\nFailed: {stats['failed']}\n"
+                    f"Retries: {stats['retries']}\nFlood waits: {stats['retry_after']}\n"
+                    f"Queue wait p50/p99: {stats['queue_p50']:.2f}s / {stats['queue_p99']:.2f}s\n"
+                    f"Send latency p50/p99: {stats['send_p50'] * 1000:.0f}ms / {stats['send_p99'] * 1000:.0f}ms\n"
+                    f"Photos reused/uploaded: {stats['media']['hits']} / {stats['media']['uploads']} "
+                    f"({stats['media']['bytes_in'] // 1024} KB compressed to {stats['media']['bytes_out'] // 1024} KB)")
+            if Outbox.enabled:
+                outbox = await asyncio.to_thread(Outbox.get_stats)
+                text += "\nOutbox: " + ", ".join(f"{status} {count}" for status, count in sorted(outbox.items()))
+            await TelegramBot.send_message_to_admin(text)
+
+        elif context.args[0] == "stats":
+            try:
+                cycles = int(context.args[1]) if len(context.args) > 1 else None
+            except ValueError:
+                await TelegramBot.send_message_to_admin("Invalid number of cycles.")
+                return
+            await TelegramBot.send_message_to_admin(metrics.cycle_log.summary(cycles))
+
+        elif context.args[0] == "profile":
+            if len(context.args) == 1:
+                if RemoteScrapePool.enabled:
+                    await TelegramBot.send_message_to_admin("Scrapes run on worker nodes, profile a user instead. Use /admin profile [chat_id/email] [value]")
+                    return
+                profiler.request()
+                await TelegramBot.send_message_to_admin("The next scrape cycle will be profiled.")
+                return
+            if len(context.args) < 3 or context.args[1] not in ["chat_id", "email"]:
+                await TelegramBot.send_message_to_admin("Invalid argument. Use /admin profile [chat_id/email] [value]")
+                return
+            key = context.args[1]
+            value = context.args[2]
+            if key == "chat_id":
+                try:
+                    value = int(value)
+                except ValueError:
+                    await TelegramBot.send_message_to_admin("Invalid chat_id.")
+                    return
+            res = await AsyncUser.get_users_by(key, value)
+            if res is None or len(res) == 0:
+                await TelegramBot.send_message_to_admin("User not found.")
+                return
+            user = res[0]
+            if not ScrapeWorkerPool.claim_user(user.get_user_id()):
+                await TelegramBot.send_message_to_admin(f"{user.get_chat_id()} is being scraped by the current cycle, try again once it is done.")
+                return
+            await TelegramBot.send_message_to_admin(f"Profiling a scrape of {user.get_chat_id()}...")
+            # A scrape takes minutes; other commands are handled meanwhile.
+            context.application.create_task(TelegramBot.run_profile(user))
+
         else:
             await context.bot.send_message(chat_id=update.effective_chat.id, text="Unknown command.")
 
     def run(self):
         self.app.run_polling()
 
+    # aiosqlite runs each connection in a non-daemon thread that would keep the process alive.
+    @staticmethod
+    async def _post_shutdown(app):
+        await AsyncDatabaseConnection.dispose()
+
     def stop(self):
         self.app.stop()
 
     @staticmethod
     async def broadcast(text):
-        users = User.get_all_users()
+        users = await AsyncUser.get_all_users()
         for user in users:
             await TelegramBot.send_message(user.get_chat_id(), text)
+        return len(users)
 
+    # Sends are queued on the dispatcher; await the returned future with asyncio.wrap_future() to wait for delivery.
     @staticmethod
     async def send_message(chat_id, text):
-        async with TelegramBot.botapi:
-            await TelegramBot.botapi.send_message(chat_id=chat_id, text=text)
+        return TelegramBot.dispatcher.send_message(chat_id, text)
 
     @staticmethod
     async def send_photo(chat_id, photo_path):
-        with open(photo_path, "rb") as f:
-            async with TelegramBot.botapi:
-                await TelegramBot.botapi.send_photo(chat_id=chat_id, photo=f)
+        if not os.path.isfile(photo_path):
+            raise FileNotFoundError(f"No such file: '{photo_path}'")
+        return TelegramBot.dispatcher.send_photo(chat_id, Path(photo_path))
+
+    # Queues a course's notifications; its screenshots stay in the store until they are sent.
+    @staticmethod
+    def send_course(chat_id, course):
+        messages, missing = compose_course(course)
+        for method, kwargs in messages:
+            paths = photo_paths(kwargs)
+            for path in paths:
+                screenshot_store.acquire(path)
+            future = TelegramBot.dispatcher.submit(method, chat_id, **kwargs)
+            future.add_done_callback(lambda future, paths=paths: [screenshot_store.release(path) for path in paths])
+        return missing
+
+    # Sends one chat's claimed outbox rows in order. A row that has to be retried stops the
+    # chat here; the rest go back to the outbox behind it.
+    @staticmethod
+    async def deliver_chat(chat_id, rows):
+        for i, row in enumerate(rows):
+            method, kwargs = row["method"], Outbox.decode(row["payload"])
+            paths = photo_paths(kwargs)
+            missing = [path for path in paths if not os.path.isfile(path)]
+            if missing:
+                await TelegramBot.send_message_to_admin(f"FileNotFoundError: {', '.join(missing)}")
+                method, kwargs = as_text(method, kwargs)
+                paths = []
+            for path in paths:
+                screenshot_store.acquire(path)
+            try:
+                await asyncio.wrap_future(TelegramBot.dispatcher.submit(method, chat_id, **kwargs))
+            except (Forbidden, BadRequest) as e:
+                await asyncio.to_thread(Outbox.failed, row["id"], e)
+                continue
+            except Exception as e:
+                await asyncio.to_thread(Outbox.retry, row, e)
+                await asyncio.to_thread(Outbox.release, rows[i + 1:])
+                return
+            finally:
+                for path in paths:
+                    screenshot_store.release(path)
+            await asyncio.to_thread(Outbox.sent, row["id"])
 
     @staticmethod
     async def send_message_to_admin(text):
         await TelegramBot.send_message(TelegramBot.admin_chat_id, text)
 
+    # Profiles a scrape of a user claimed with ScrapeWorkerPool.claim_user() and sends the report.
+    @staticmethod
+    async def run_profile(user: User):
+        try:
+            changed_courses, path, report = await TelegramBot.profile_user(user)
+        except Exception as e:
+            logging.error(e)
+            await TelegramBot.send_message_to_admin(f"Profiled scrape of {user.get_chat_id()} failed: {e}")
+            return
+        finally:
+            ScrapeWorkerPool.release_user(user.get_user_id())
+        if not Outbox.enabled:
+            await TelegramBot.send_changed_courses(user.get_chat_id(), changed_courses)
+        await TelegramBot.send_profile(f"Scrape of {user.get_chat_id()}, {len(changed_courses)} changed courses", path, report)
+
+    # Scrapes all of the user's courses, due or not, in a pool of its own so the profile only
+    # has this user's work in it. Its changes are saved and notified like any other scrape's.
+    # With SCRAPE_REMOTE=1 a worker node runs and profiles it, the bot has no browsers.
     @staticmethod
-    def get_user(chat_id: int) -> User:
-        res = User.get_users_by("chat_id", chat_id)
+    async def profile_user(user: User):
+        if RemoteScrapePool.enabled:
+            pool = await asyncio.to_thread(RemoteScrapePool)
+            return await pool.run_job("profile", user)
+        return await asyncio.to_thread(TelegramBot._profile_user, user)
+
+    @staticmethod
+    def _profile_user(user: User):
+        with ScrapeWorkerPool(1) as pool:
+            return profiler.profile(f"user-{user.get_chat_id()}", pool.scrape_user, user)
+
+    # Queues changed courses on the dispatcher, for when notifications don't go through the outbox.
+    @staticmethod
+    async def send_changed_courses(chat_id, changed_courses):
+        for course in changed_courses:
+            if len(course["course_sections"]) == 0:
+                continue
+            missing = TelegramBot.send_course(chat_id, course)
+            for path in missing:
+                await TelegramBot.send_message_to_admin(f"FileNotFoundError: {path}")
+
+    @staticmethod
+    async def send_profile(title, path, report):
+        for text in split_text(f"{title}\nSaved to {path}\n\n{report}"):
+            await TelegramBot.send_message_to_admin(text)
+
+    @staticmethod
+    async def get_user(chat_id: int) -> User:
+        res = await AsyncUser.get_users_by("chat_id", chat_id)
         if res is None or len(res) == 0:
             res = User(chat_id=chat_id, is_active=True)
-            User.insert_user(res)
+            await AsyncUser.insert_user(res)
         else:
             res = res[0]
         return res
 
     @staticmethod
-    async def countdown(pretext="", posttext=""):
+    async def countdown(pretext="", posttext="", seconds=None):
         count = TelegramBot.update_timer["interval"] * 60
+        if seconds is not None:
+            count = min(count, int(seconds))
 
         logging.info(f"Updating in {count} seconds.")
 
@@ -466,50 +663,85 @@ class TelegramBot:
 
 
 async def notify_users():
+    scheduler = CourseScheduler() if CourseScheduler.enabled else None
+    TelegramBot.scheduler = scheduler
+    # With SCRAPE_REMOTE=1 the browsers run in `python worker.py` processes, possibly on other hosts.
+    pool = RemoteScrapePool(scheduler=scheduler) if RemoteScrapePool.enabled else ScrapeWorkerPool(scheduler=scheduler)
+    screenshot_store.start_sweeper()
+    if Outbox.enabled:
+        screenshot_store.pinned = Outbox.pending_paths
+        asyncio.ensure_future(deliver_outbox())
     while True:
         if TelegramBot.notifier_is_running:
-            active_users = User.get_users_by("active", True)
-            for user in active_users:
-                if user.get_is_blocked():
-                    continue
-                scrapper = ElearnScrapper(user)
-                try:
-                    print(f"Checking for new content for {user.get_chat_id()}")
-                    logging.info(f"Checking for new content for {user.get_chat_id()}")
-                    changed_courses = scrapper.get_all_courses_data()
-                except LoginError as e:
-                    print(e)
-                    logging.error(e)
+            if scheduler is not None:
+                due = scheduler.begin_cycle()
+                logging.info(f"{len(due)} scheduled courses due.")
+            profiled = profiler.begin_cycle()
+            active_users = [user for user in User.get_users_by("active", True) if not user.get_is_blocked()]
+            scrape = pool.scrape_shared if ScrapeWorkerPool.shared_courses else pool.scrape
+            async for user, changed_courses, error in scrape(active_users):
+                if isinstance(error, LoginError):
+                    print(error)
+                    logging.error(error)
                     logging.error(f"Login error for user {user.get_chat_id()}")
-                    await TelegramBot.send_message_to_admin(f"Login error for user {user.get_chat_id()}\n{e}")
-                    await TelegramBot.send_message(user.get_chat_id(), f"Login failed. {e}.")
+                    await TelegramBot.send_message_to_admin(f"Login error for user {user.get_chat_id()}\n{error}")
+                    await TelegramBot.send_message(user.get_chat_id(), f"Login failed. {error}.")
                     continue
-                except Exception as e:
-                    print(e)
-                    print(e.args)
-                    logging.error(e)
-                    await TelegramBot.send_message_to_admin(f"Scrapper Error: {e}")
+                elif error is not None:
+                    print(error)
+                    print(error.args)
+                    logging.error(error)
+                    await TelegramBot.send_message_to_admin(f"Scrapper Error: {error}")
                     continue
                 print(f"Found {len(changed_courses)} changed courses for {user.get_chat_id()}")
                 logging.info(f"Found {len(changed_courses)} changed courses for {user.get_chat_id()}")
-                for course in changed_courses:
-                    if len(course["course_sections"]) == 0:
-                        continue
-                    await TelegramBot.send_message(user.get_chat_id(), f"New content in {course['course_name']}")
-                    for section in course["course_sections"]:
-                        for activity in section["activities"]:
-                            await TelegramBot.send_message(user.get_chat_id(), f"New activity in ({section['section_name']})")
-                            try:
-                                await TelegramBot.send_photo(user.get_chat_id(), activity["screen_shot_path"])
-                            except FileNotFoundError as e:
-                                await TelegramBot.send_message_to_admin(f"FileNotFoundError: {e}")
-
-                del scrapper
-            await TelegramBot.countdown("Next check in ", " seconds")
+                if Outbox.enabled:
+                    # Already queued by the scrape, deliver_outbox() sends them.
+                    continue
+                await TelegramBot.send_changed_courses(user.get_chat_id(), changed_courses)
+
+            logging.info(f"Dispatcher: {TelegramBot.dispatcher.get_stats()}")
+            profile = profiler.end_cycle() if profiled else None
+            if profile is not None:
+                await TelegramBot.send_profile(f"Scrape cycle of {len(active_users)} users", *profile)
+            # The admin's update interval is the longest the notifier sleeps between cycles.
+            wait = None
+            if scheduler is not None:
+                scheduler.end_cycle()
+                wait = max(60, scheduler.seconds_until_next_due())
+            await pool.warm_up()
+            await TelegramBot.countdown("Next check in ", " seconds", wait)
         else:
             await asyncio.sleep(30)
 
 
+# Runs next to the scrape loop: new outbox rows are sent while the cycle that found them is
+# still going, and rows left over by a restart are sent first.
+async def deliver_outbox():
+    chats = {}
+    leased = {}
+    purged_at = 0
+    renewed_at = time()
+    while True:
+        try:
+            if time() - purged_at > 3600:
+                await asyncio.to_thread(Outbox.purge)
+                purged_at = time()
+            # Chats still being sent keep their rows leased, however long their back-off lasts.
+            if time() - renewed_at > Outbox.lease_time / 3:
+                await asyncio.to_thread(Outbox.renew, [row["id"] for rows in leased.values() for row in rows])
+                renewed_at = time()
+            claimed = await asyncio.to_thread(Outbox.claim, None, list(chats))
+        except Exception as e:
+            logging.error(e)
+            claimed = {}
+        for chat_id, rows in claimed.items():
+            leased[chat_id] = rows
+            chats[chat_id] = asyncio.ensure_future(TelegramBot.deliver_chat(chat_id, rows))
+            chats[chat_id].add_done_callback(lambda task, chat_id=chat_id: (chats.pop(chat_id, None), leased.pop(chat_id, None)))
+        await asyncio.sleep(Outbox.poll_interval)
+
+
 def run():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
@@ -518,15 +750,17 @@ def run():
 
 if __name__ == "__main__":
     logging.info("Starting...")
+    metrics.registry.serve()
     try:
         mythread = threading.Thread(target=run, daemon=True)
         mythread.start()
 
         bot = TelegramBot()
         bot.run()
+        TelegramBot.dispatcher.stop()
     except Exception as e:
         print(e)
         logging.error(e)
-        TelegramBot.send_message_to_admin(f"Uncaught Error: {e}\nBot stopped.")
-        bot.stop()
+        TelegramBot.dispatcher.send_message(TelegramBot.admin_chat_id, f"Uncaught Error: {e}\nBot stopped.")
+        TelegramBot.dispatcher.stop()
         exit(1)
@@ -0,0 +1,225 @@
+import json
+import random
+import argparse
+import threading
+from time import time, sleep, monotonic
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# What call() returns instead of a result when a request is refused with a 429.
+class FloodError:
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+# A stand-in for the Telegram Bot API that answers sendMessage, sendPhoto and sendMediaGroup
+# like Telegram does, after `latency` (+/- `jitter`) seconds. It enforces Telegram's flood
+# limits, about `global_rate` messages per second overall and `chat_rate` per chat, with
+# 429 responses, and can also answer a random `flood_probability` of requests with a 429.
+# Point the bot at it with TELEGRAM_BASE_URL=<base_url>.
+class TelegramFixture:
+    def __init__(self, latency=0.05, jitter=0.02, global_rate=30, chat_rate=1, flood_probability=0, retry_after=1,
+                 host="127.0.0.1", port=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.flood_probability = flood_probability
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._file_id = 0
+        self._next_global = 0
+        self._next_chat = {}
+        # chat_id -> texts and captions in the order they were accepted.
+        self.received = {}
+        self.stats = {"requests": 0, "messages": 0, "uploads": 0, "flood": 0, "errors": 0}
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    # Returns the seconds to wait before retrying, or None if `count` messages may be sent now.
+    def _flood_wait(self, chat_id, count):
+        if self._random.random() < self.flood_probability:
+            return self.retry_after
+        now = monotonic()
+        with self._lock:
+            # A little slack, like Telegram allows short bursts.
+            if self.global_rate and self._next_global > now + 1:
+                return max(1, round(self._next_global - now))
+            if self.chat_rate and self._next_chat.get(chat_id, 0) > now + 0.5:
+                return max(1, round(self._next_chat[chat_id] - now))
+            if self.global_rate:
+                self._next_global = max(self._next_global, now) + count / self.global_rate
+            if self.chat_rate:
+                self._next_chat[chat_id] = max(self._next_chat.get(chat_id, 0), now) + count / self.chat_rate
+        return None
+
+    def _message(self, chat_id, **fields):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        return {"message_id": message_id, "date": int(time()), "chat": {"id": chat_id, "type": "private"}, **fields}
+
+    def _photo(self, photo):
+        # A file_id sent back is reused as is; anything else is an upload.
+        if isinstance(photo, str) and photo.startswith("fixture-file-"):
+            file_id = photo
+        else:
+            with self._lock:
+                self._file_id += 1
+                file_id = f"fixture-file-{self._file_id}"
+            self._count("uploads")
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 360, "height": 740}]
+
+    def _receive(self, chat_id, texts):
+        with self._lock:
+            self.received.setdefault(chat_id, []).extend(texts)
+            self.stats["messages"] += len(texts)
+
+    def call(self, method, params, files):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fixture", "username": "fixture_bot"}
+        try:
+            chat_id = int(params["chat_id"])
+        except (KeyError, ValueError):
+            raise ValueError("Bad Request: chat_id is empty")
+        if method == "sendMessage":
+            messages = [("text", params.get("text", ""))]
+        elif method == "sendPhoto":
+            messages = [("photo", params.get("photo"), params.get("caption", ""))]
+        elif method == "sendMediaGroup":
+            media = params.get("media")
+            media = json.loads(media) if isinstance(media, str) else media
+            if not isinstance(media, list) or not 2 <= len(media) <= 10:
+                raise ValueError("Bad Request: wrong number of media in the group")
+            messages = [("photo", item.get("media"), item.get("caption", "")) for item in media]
+        else:
+            raise LookupError("Not Found")
+
+        retry_after = self._flood_wait(chat_id, len(messages))
+        if retry_after is not None:
+            self._count("flood")
+            return FloodError(retry_after)
+        self._receive(chat_id, [message[-1] for message in messages])
+        results = []
+        for message in messages:
+            if message[0] == "text":
+                results.append(self._message(chat_id, text=message[1]))
+            else:
+                photo = message[1]
+                # attach://name refers to a file uploaded in the same request.
+                if isinstance(photo, str) and photo.startswith("attach://"):
+                    photo = files.get(photo[len("attach://"):])
+                elif photo is None and "photo" in files:
+                    photo = files["photo"]
+                results.append(self._message(chat_id, photo=self._photo(photo), caption=message[2]))
+        return results if method == "sendMediaGroup" else results[0]
+
+    def _handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body):
+                body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _params(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                content_type = self.headers.get("Content-Type", "")
+                params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                files = {}
+                if content_type.startswith("application/json"):
+                    params.update(json.loads(body or b"{}"))
+                elif content_type.startswith("multipart/form-data"):
+                    message = BytesParser(policy=HTTP).parsebytes(
+                        f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body)
+                    for part in message.iter_parts():
+                        name = part.get_param("name", header="content-disposition")
+                        if part.get_filename() is not None:
+                            files[name] = part.get_payload(decode=True)
+                        else:
+                            params[name] = part.get_payload(decode=True).decode("utf-8")
+                else:
+                    params.update({key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()})
+                return params, files
+
+            def do_POST(self):
+                fixture._count("requests")
+                parts = urlparse(self.path).path.strip("/").split("/")
+                method = parts[-1] if len(parts) == 2 and parts[0].startswith("bot") else None
+                params, files = self._params()
+                delay = fixture.latency + fixture._random.uniform(-fixture.jitter, fixture.jitter)
+                if delay > 0:
+                    sleep(delay)
+                try:
+                    result = fixture.call(method, params, files)
+                except LookupError as e:
+                    fixture._count("errors")
+                    return self._send(404, {"ok": False, "error_code": 404, "description": str(e)})
+                except ValueError as e:
+                    fixture._count("errors")
+                    return self._send(400, {"ok": False, "error_code": 400, "description": str(e)})
+                if isinstance(result, FloodError):
+                    return self._send(429, {"ok": False, "error_code": 429,
+                                            "description": f"Too Many Requests: retry after {result.retry_after}",
+                                            "parameters": {"retry_after": result.retry_after}})
+                return self._send(200, {"ok": True, "result": result})
+
+            do_GET = do_POST
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake Telegram Bot API.")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--global-rate", type=float, default=30)
+    parser.add_argument("--chat-rate", type=float, default=1)
+    parser.add_argument("--flood", type=float, default=0, help="share of requests answered with a 429")
+    args = parser.parse_args()
+    fixture = TelegramFixture(args.latency, args.jitter, args.global_rate, args.chat_rate, args.flood, port=args.port)
+    print(f"Serving the Bot API at {fixture.base_url}, set TELEGRAM_BASE_URL={fixture.base_url}")
+    try:
+        fixture.server.serve_forever()
+    except KeyboardInterrupt:
+        fixture.server.server_close()
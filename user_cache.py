@@ -0,0 +1,88 @@
+import os
+import copy
+import threading
+from time import monotonic
+from collections import OrderedDict
+
+
+# In-process LRU of users keyed by user_id, with a chat_id index on top.
+# Entries expire after `ttl` seconds so other processes' writes show up eventually.
+class UserCache:
+    ttl = float(os.getenv("USER_CACHE_TTL", 300))
+    max_size = int(os.getenv("USER_CACHE_SIZE", 10000))
+
+    def __init__(self, ttl=None, max_size=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if max_size is not None:
+            self.max_size = max_size
+        self._users = OrderedDict()
+        self._chat_ids = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._users)
+
+    def _get(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is None:
+            return None
+        expires, user = entry
+        if expires < monotonic():
+            self._remove(user_id)
+            return None
+        self._users.move_to_end(user_id)
+        return user
+
+    def _remove(self, user_id):
+        expires, user = self._users.pop(user_id)
+        if self._chat_ids.get(user.get_chat_id()) == user_id:
+            del self._chat_ids[user.get_chat_id()]
+
+    # Callers get copies, so mutating a user before update_user() can't leak into the cache.
+    def get(self, user_id):
+        with self._lock:
+            user = self._get(user_id)
+            if user is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return copy.copy(user)
+
+    def get_by_chat_id(self, chat_id):
+        with self._lock:
+            user_id = self._chat_ids.get(chat_id)
+            user = None if user_id is None else self._get(user_id)
+            if user is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return copy.copy(user)
+
+    def put(self, user):
+        if user is None:
+            return
+        user = copy.copy(user)
+        with self._lock:
+            if user.get_user_id() in self._users:
+                self._remove(user.get_user_id())
+            self._users[user.get_user_id()] = (monotonic() + self.ttl, user)
+            if user.get_chat_id() is not None:
+                self._chat_ids[user.get_chat_id()] = user.get_user_id()
+            while len(self._users) > self.max_size:
+                self._remove(next(iter(self._users)))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if user_id in self._users:
+                self._remove(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._chat_ids.clear()
+
+
+user_cache = UserCache()
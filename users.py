@@ -1,4 +1,3 @@
-import os
 import logging
 import re
 from random import randrange
@@ -6,9 +5,10 @@ from uuid import uuid4
 from dotenv import load_dotenv
 
 import sqlalchemy as db
-from cryptography.fernet import Fernet
 
 from database_connection import DatabaseConnection
+from user_cache import user_cache
+from credentials import CredentialVault
 
 
 load_dotenv()
@@ -18,21 +18,27 @@ def main():
 
 
 def encrypt_password(password: str) -> bytes:
-    key = os.getenv("ENCRYPTION_KEY").encode()
     salt = str(randrange(0, int(1e10))).zfill(10)
-    encPassword = Fernet(key).encrypt(f"{password}{salt}".encode())
+    encPassword = CredentialVault.encrypt(f"{password}{salt}".encode())
     return encPassword
 
 
 def dycrypt_password(encPassword: bytes) -> str:
     if type(encPassword) != bytes:
         return None
-    key = os.getenv("ENCRYPTION_KEY").encode()
-    decPassword = Fernet(key).decrypt(encPassword).decode()
+    decPassword = CredentialVault.decrypt_cached(encPassword).decode()
     decPassword = decPassword[:-10]
     return decPassword
 
 
+def encrypt_data(data: bytes) -> bytes:
+    return CredentialVault.encrypt(data)
+
+
+def decrypt_data(encData: bytes) -> bytes:
+    return CredentialVault.decrypt(encData)
+
+
 class User:
     def __init__(self, **kwargs):
         self.set_user_id(str(uuid4()))
@@ -121,6 +127,9 @@ class User:
     def get_password(self):
         return dycrypt_password(self._password)
 
+    def has_password(self) -> bool:
+        return self._password is not None
+
     def set_is_active(self, is_active):
         if is_active in [0, 1]:
             self._is_active = bool(is_active)
@@ -152,6 +161,16 @@ class User:
     def get_is_blocked(self):
         return self._is_blocked
 
+    @staticmethod
+    def from_row(row):
+        user = User(**row)
+        user.set_user_id(row["user_id"])
+        return user
+
+    def to_row(self) -> dict:
+        return {"user_id": self._user_id, "email": self._email, "password": self._password,
+                "active": self._is_active, "chat_id": self._chat_id, "blocked": self._is_blocked}
+
     @staticmethod
     def get_all_users():
         with DatabaseConnection() as connection:
@@ -162,15 +181,25 @@ class User:
                 return []
             result_set = result_proxy.fetchall()
 
-        user_list = []
-        for row in result_set:
-            user = User(**row)
-            user.set_user_id(row["user_id"])
-            user_list.append(user)
-        return user_list
+        return [User.from_row(row) for row in result_set]
+
+    @staticmethod
+    def exists(user_id) -> bool:
+        if user_cache.get(user_id) is not None:
+            return True
+        with DatabaseConnection() as connection:
+            users = connection.get_table("user")
+            query = db.select([users.c.user_id]).where(users.columns.user_id == user_id).limit(1)
+            result_proxy = connection.execute(query)
+            if result_proxy is None:
+                return False
+            return result_proxy.fetchone() is not None
 
     @staticmethod
     def get_user(user_id):
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
         with DatabaseConnection() as connection:
             users = connection.get_table("user")
             query = db.select([users]).where(users.columns.user_id == user_id)
@@ -181,12 +210,16 @@ class User:
             if row is None:
                 return None
 
-        user = User(**row)
-        user.set_user_id(row["user_id"])
+        user = User.from_row(row)
+        user_cache.put(user)
         return user
 
     @staticmethod
     def get_users_by(key, value):
+        if key == "chat_id":
+            user = user_cache.get_by_chat_id(value)
+            if user is not None:
+                return [user]
         with DatabaseConnection() as connection:
             users = connection.get_table("user")
             query = db.select([users]).where(users.columns[key] == value)
@@ -195,35 +228,37 @@ class User:
                 return None
             result_set = result_proxy.fetchall()
 
-        user_list = []
-        for row in result_set:
-            user = User(**row)
-            user.set_user_id(row["user_id"])
-            user_list.append(user)
+        user_list = [User.from_row(row) for row in result_set]
+        if key == "chat_id" and len(user_list) == 1:
+            user_cache.put(user_list[0])
         return user_list
 
     @staticmethod
     def insert_user(user):
         with DatabaseConnection() as connection:
             users = connection.get_table("user")
-            query = db.insert(users).values(
-                user_id=user._user_id, email=user._email, password=user._password, active=user._is_active, chat_id=user._chat_id, blocked=user._is_blocked)
+            query = db.insert(users).values(user.to_row())
             result = connection.execute(query)
 
         if result is None:
+            user_cache.invalidate(user.get_user_id())
             return False
+        user_cache.put(user)
         return True
 
     @staticmethod
     def update_user(user) -> int:
         with DatabaseConnection() as connection:
             users = connection.get_table("user")
-            query = db.update(users).where(users.columns.user_id == user._user_id).values(
-                email=user._email, password=user._password, active=user._is_active, chat_id=user._chat_id, blocked=user._is_blocked)
+            row = user.to_row()
+            del row["user_id"]
+            query = db.update(users).where(users.columns.user_id == user._user_id).values(row)
             result = connection.execute(query)
 
         if result is None:
+            user_cache.invalidate(user.get_user_id())
             return 0
+        user_cache.put(user)
         return result.rowcount
 
 
@@ -0,0 +1,121 @@
+import os
+import sys
+import signal
+import socket
+import logging
+import threading
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+
+from users import User
+from scrapper import LoginError
+from job_queue import JobQueue
+from course_scheduler import ScheduleSnapshot
+from scrape_workers import ScrapeWorkerPool, RemoteScrapePool
+from screenshot_store import screenshot_store
+from profiling import profiler
+import metrics
+
+
+# Runs scrape jobs queued by a bot with SCRAPE_REMOTE=1. Start as many of these as needed,
+# on any host that reaches the database and shares SCREENSHOT_STORE with the bot.
+class ScrapeWorker:
+    poll_interval = float(os.getenv("JOB_POLL_INTERVAL", 2))
+
+    def __init__(self, size=None):
+        self.pool = ScrapeWorkerPool(size)
+        self.queue = JobQueue()
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:8]}"
+        self._executor = ThreadPoolExecutor(max_workers=self.pool.size, thread_name_prefix="job")
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._finished = threading.Event()
+
+    def stop(self, *args):
+        logging.info(f"Worker {self.worker_id} stopping after {len(self._running)} running jobs.")
+        self._stop.set()
+
+    def execute(self, job):
+        payload = job["payload"] or {}
+        schedule = ScheduleSnapshot(**payload["schedule"]) if payload.get("schedule") else None
+        try:
+            user = User.get_user(job["user_id"])
+            if user is None:
+                raise LoginError(f"User {job['user_id']} no longer exists")
+            if job["kind"] == "user":
+                result = {"courses": self.pool.scrape_user(user, schedule)}
+            elif job["kind"] == "profile":
+                courses, path, report = profiler.profile(f"user-{user.get_chat_id()}", self.pool.scrape_user, user)
+                result = {"courses": courses, "profile_path": f"{path} on {self.worker_id}", "profile": report}
+            elif job["kind"] == "index":
+                result = {"courses_urls": self.pool.index_user(user)}
+            elif job["kind"] == "courses":
+                courses, restricted = self.pool.scrape_courses(user, payload["courses_urls"], schedule, payload.get("subscribers"))
+                result = {"courses": courses, "restricted": restricted}
+            else:
+                raise ValueError(f"Unknown job kind: {job['kind']}")
+            if schedule is not None:
+                result["observed"] = schedule.observed
+        except LoginError as e:
+            logging.error(f"Job {job['id']} failed: {e}")
+            self.queue.fail(job["id"], self.worker_id, e, job["attempts"], retry=False)
+        except Exception as e:
+            logging.error(f"Job {job['id']} failed: {e}")
+            self.queue.fail(job["id"], self.worker_id, e, job["attempts"])
+        else:
+            if not self.queue.complete(job["id"], self.worker_id, result):
+                logging.error(f"Job {job['id']} finished after its lease was lost.")
+        finally:
+            with self._lock:
+                self._running.discard(job["id"])
+
+    def _heartbeat(self):
+        while not self._finished.wait(self.queue.lease_time / 3):
+            with self._lock:
+                job_ids = list(self._running)
+            try:
+                held = self.queue.heartbeat(self.worker_id, job_ids)
+                if held < len(job_ids):
+                    logging.error(f"Lost the lease on {len(job_ids) - held} jobs.")
+            except Exception as e:
+                logging.error(e)
+
+    def run(self):
+        logging.info(f"Worker {self.worker_id} started with {self.pool.size} slots.")
+        heartbeat = threading.Thread(target=self._heartbeat, name="heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    free = self.pool.size - len(self._running)
+                jobs = self.queue.claim(self.worker_id, free) if free > 0 else []
+                for job in jobs:
+                    with self._lock:
+                        self._running.add(job["id"])
+                    self._executor.submit(self.execute, job)
+                # Claim again right away while jobs keep coming.
+                if not jobs or len(jobs) < free:
+                    self._stop.wait(self.poll_interval)
+        finally:
+            # Running jobs finish and report; their leases are renewed until then.
+            self._executor.shutdown(wait=True)
+            self._finished.set()
+            self.pool.shutdown()
+            logging.info(f"Worker {self.worker_id} stopped.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, encoding="utf-8", filename="worker.log",
+                        format=f"%(levelname)s   %(asctime)s  %(threadName)s  %(message)s")
+    if RemoteScrapePool.enabled and not os.path.isabs(screenshot_store.root):
+        # A relative store is local to each host, the bot would not find the workers' screenshots.
+        message = f"SCREENSHOT_STORE must be an absolute path on a volume shared with the bot, not {screenshot_store.root}"
+        print(message)
+        logging.error(message)
+        sys.exit(1)
+    metrics.registry.serve()
+    worker = ScrapeWorker(int(sys.argv[1]) if len(sys.argv) > 1 else None)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()